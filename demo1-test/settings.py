@@ -31,6 +31,7 @@ MIDDLEWARE_CLASSES = (
     'google.appengine.ext.appstats.recording.AppStatsDjangoMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.http.ConditionalGetMiddleware',
+    'demo.middleware.ClearIdentityMapMiddleware',
     'demo.middleware.AddUserToRequestMiddleware',
 )
 ROOT_URLCONF = 'urls'
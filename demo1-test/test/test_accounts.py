@@ -23,6 +23,7 @@ import unittest
 
 # AppEngine imports
 from google.appengine.ext import db
+from google.appengine.api import memcache
 from google.appengine.api import users
 
 # local imports
@@ -32,6 +33,11 @@ from demo import models
 class AccountTest(unittest.TestCase):
   """Tests the Account model."""
 
+  def setUp(self):
+    # Accounts are cached in memcache, which outlives the test datastore.
+    memcache.flush_all()
+    models.Account.current_user_account = None
+
   def testAccountForCurrentUser(self):
     q = db.Query(models.Account)
     self.assertEquals(0, q.count())
@@ -233,6 +239,45 @@ class AccountTest(unittest.TestCase):
     self.assertEquals(user.email(), a1.email)
     logging.info(a1.email)
 
+  def testAccountLookupIsCached(self):
+    user = users.User('joe@somedomain.com', _user_id='299910294181029')
+    account = models.Account.get_account_for_user(user)
+    account.nickname = 'Joseph'
+    account.put()
+
+    # Gone from the datastore, but still served from memcache.
+    db.delete(account.key())
+    cached = models.Account.get_account_for_id('299910294181029')
+    self.assertEquals('Joseph', cached.nickname)
+    self.assertEquals('joseph', cached.lower_nickname)
+
+  def testDeleteDropsCachedAccount(self):
+    user = users.User('joe@somedomain.com', _user_id='299910294181029')
+    account = models.Account.get_account_for_user(user)
+    account.put()
+    account.delete()
+    self.assertEquals(None, models.Account.get_account_for_id('299910294181029'))
+
+  def testNicknameIsClaimedInIndex(self):
+    user = users.User('joe@somedomain.com', _user_id='299910294181029')
+    models.Account.get_account_for_user(user)
+
+    entry = models.NicknameIndex.get_by_key_name(
+        models.NicknameIndex.key_name_for('Joe'))
+    self.assertEquals('299910294181029', entry.user_id)
+    self.assertTrue(models.NicknameIndex.claim('joe', '299910294181029'))
+    self.assertFalse(models.NicknameIndex.claim('JOE', '20005762003'))
+
+  def testNicknameSkipsAccountsMissingFromIndex(self):
+    legacy = users.User('joe@another.com', _user_id='20005762003')
+    models.Account(key_name='<20005762003>', user=legacy,
+                   user_id='20005762003', email='joe@another.com',
+                   nickname='joe').put()
+
+    user = users.User('joe@somedomain.com', _user_id='299910294181029')
+    account = models.Account.get_account_for_user(user)
+    self.assertEquals('joe1', account.nickname)
+
 
 class ProvisionalAccountTest(unittest.TestCase):
   """Tests the ProvisionalAccount model."""
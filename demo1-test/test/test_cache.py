@@ -0,0 +1,92 @@
+#!/usr/bin/python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the two-tier cache."""
+
+# Python imports
+import unittest
+
+# local imports
+from common import cache
+
+
+class CacheTest(unittest.TestCase):
+  """Tests the local and remote tiers of the cache."""
+
+  def setUp(self):
+    cache.register('test_both')
+    cache.register('test_local', remote=False, local_max_age=None)
+    cache.register('test_pinned', remote=False, local_max_age=None,
+                   pinned=True)
+    cache.invalidate('test_both')
+    cache.clear_local()
+
+  def testSetThenGet(self):
+    cache.set_value('test_both', 'a', 1)
+    self.assertEquals(1, cache.get('test_both', 'a'))
+    self.assertEquals(None, cache.get('test_both', 'missing'))
+    self.assertEquals(1, cache.stats()['local_hits'])
+
+  def testRemoteTierRefillsLocal(self):
+    cache.set_multi('test_both', {'a': 1, 'b': 2})
+    cache.clear_local()
+    self.assertEquals({'a': 1, 'b': 2},
+                      cache.get_multi('test_both', ['a', 'b', 'c']))
+    self.assertEquals(2, cache.stats()['remote_hits'])
+    self.assertEquals(1, cache.get('test_both', 'a'))
+    self.assertEquals(1, cache.stats()['local_hits'])
+
+  def testInvalidateDropsNamespace(self):
+    cache.set_value('test_both', 'a', 1)
+    cache.set_value('test_local', 'a', 1)
+    cache.invalidate('test_both')
+    self.assertEquals(None, cache.get('test_both', 'a'))
+    self.assertEquals(1, cache.get('test_local', 'a'))
+    cache.invalidate('test_local')
+    self.assertEquals(None, cache.get('test_local', 'a'))
+
+  def testDelete(self):
+    cache.set_value('test_both', 'a', 1)
+    cache.delete('test_both', 'a')
+    self.assertEquals(None, cache.get('test_both', 'a'))
+
+  def testLocalTierEvictsLeastRecentlyUsed(self):
+    capacity = cache.stats()['capacity']
+    for i in range(capacity):
+      cache.set_value('test_local', str(i), i)
+    cache.get('test_local', '0')
+    cache.set_value('test_local', 'one more', -1)
+    self.assertEquals(1, cache.stats()['evictions'])
+    self.assertEquals(0, cache.get('test_local', '0'))
+    self.assertEquals(None, cache.get('test_local', '1'))
+
+  def testPinnedNamespaceIsNotEvicted(self):
+    cache.set_value('test_pinned', 'a', 1)
+    for i in range(cache.stats()['capacity'] + 1):
+      cache.set_value('test_local', str(i), i)
+    self.assertEquals(1, cache.stats()['evictions'])
+    self.assertEquals(1, cache.get('test_pinned', 'a'))
+    self.assertEquals(1, cache.stats()['pinned_size'])
+
+  def testLongKeys(self):
+    key = 'x' * 500
+    cache.set_value('test_both', key, 'long')
+    cache.clear_local()
+    self.assertEquals('long', cache.get('test_both', key))
+
+
+if __name__ == "__main__":
+  unittest.main()
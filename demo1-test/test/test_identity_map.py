@@ -0,0 +1,100 @@
+#!/usr/bin/python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the request-scoped identity map."""
+
+# Python imports
+import unittest
+
+# AppEngine imports
+from google.appengine.ext import db
+
+# local imports
+from demo import identity_map
+from demo import library
+from demo import models
+
+
+class IdentityMapTest(unittest.TestCase):
+  """Tests identity_map.get() and its bookkeeping."""
+
+  def setUp(self):
+    identity_map.clear()
+
+  def testRepeatedGetIsAHit(self):
+    trunk = library.insert_with_new_key(models.TrunkModel)
+    identity_map.clear()
+
+    first = identity_map.get(str(trunk.key()))
+    second = identity_map.get(trunk.key())
+    self.assertTrue(first is second)
+    stats = identity_map.stats()
+    self.assertEquals(1, stats['misses'])
+    self.assertEquals(1, stats['hits'])
+
+  def testListGetPreservesOrderAndMissing(self):
+    trunk1 = library.insert_with_new_key(models.TrunkModel)
+    trunk2 = library.insert_with_new_key(models.TrunkModel)
+    missing = db.Key.from_path('TrunkModel', 'no-such-trunk')
+    identity_map.clear()
+
+    result = identity_map.get([trunk2.key(), missing, trunk1.key()])
+    self.assertEquals(trunk2.key(), result[0].key())
+    self.assertEquals(None, result[1])
+    self.assertEquals(trunk1.key(), result[2].key())
+
+    # Missing keys are remembered too.
+    self.assertEquals(None, identity_map.get(missing))
+    self.assertEquals(3, identity_map.stats()['misses'])
+
+  def testPutRefreshesMap(self):
+    trunk = library.insert_with_new_key(models.TrunkModel)
+    identity_map.clear()
+    self.assertEquals(None, identity_map.get(trunk.key()).title)
+
+    other = db.get(trunk.key())
+    other.title = 'Updated'
+    other.put()
+    self.assertEquals('Updated', identity_map.get(trunk.key()).title)
+
+  def testInvalidKeyRaises(self):
+    self.assertRaises(db.BadKeyError, identity_map.get, 'not a key')
+
+  def testRefKeyDoesNotFetch(self):
+    trunk = library.insert_with_new_key(models.TrunkModel)
+    doc = library.create_new_doc(trunk.key())
+    identity_map.clear()
+
+    self.assertEquals(trunk.key(), identity_map.ref_key(doc, 'trunk_ref'))
+    self.assertEquals(0, identity_map.stats()['misses'])
+    self.assertEquals(trunk.key(), identity_map.get_ref(doc, 'trunk_ref').key())
+
+  def testPrefetchRefsBatchesGets(self):
+    doc1 = library.create_new_doc()
+    doc2 = library.create_new_doc()
+    docs = db.get([doc1.key(), doc2.key()])
+    identity_map.clear()
+
+    identity_map.prefetch_refs(docs + [None], 'trunk_ref')
+    self.assertEquals(2, identity_map.stats()['misses'])
+    self.assertEquals(identity_map.ref_key(doc1, 'trunk_ref'),
+                      docs[0].trunk_ref.key())
+    self.assertTrue(docs[1].trunk_ref is
+                    identity_map.peek(identity_map.ref_key(doc2, 'trunk_ref')))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -17,6 +17,7 @@
 """Tests for the Lantern library functions."""
 
 # Python imports
+import datetime
 import logging
 import unittest
 import os
@@ -31,6 +32,7 @@ from google.appengine.api import users
 from demo import library
 from demo import models
 import settings
+import utils
 
 ROOT_PATH = settings.ROOT_PATH
 _INVALID_FILE_PATH = os.path.join(ROOT_PATH, "non-existent-file")
@@ -42,10 +44,21 @@ _VALID_LEAF_FILE = os.path.join(ROOT_PATH, "valid-leaf-file")
 
 
 class InsertWithNewKeyTest(unittest.TestCase):
-  """Test insertion of object with new random key.
+  """Test insertion of object with new allocated key."""
 
-  TODO(mukundjha): Add test cases for function insert_with_new_key.
-  """
+  def testKeysAreUnique(self):
+    trunk1 = library.insert_with_new_key(models.TrunkModel)
+    trunk2 = library.insert_with_new_key(models.TrunkModel)
+    self.assertNotEquals(trunk1.key(), trunk2.key())
+    self.assertTrue(trunk1.key().name().startswith('k.'))
+    self.assertEquals(trunk1.key(), db.get(trunk1.key()).key())
+
+  def testInsertMany(self):
+    trunks = library.insert_many_with_new_keys(
+        models.TrunkModel, [{'title': 'one'}, {'title': 'two'}])
+    self.assertEquals(2, len(set([str(t.key()) for t in trunks])))
+    self.assertEquals(['one', 'two'],
+                      [t.title for t in db.get([t.key() for t in trunks])])
 
 
 class UpdateVisitStackTest(unittest.TestCase):
@@ -254,6 +267,93 @@ class GetPathTillCourseTest(unittest.TestCase):
     self.assertEquals([docs[4].title, docs[3].title, docs[2].title,
                        docs[1].title], [db.get(k).title for k in path])
 
+  def testCoursePathIsShortest(self):
+    docs = [library.create_new_doc() for i in range(5)]
+    docs[4].label = models.AllowedLabels.COURSE
+    docs[4].put()
+    # 4 -> 3 -> 2 -> 0, then 4 -> 1 -> 0 linked most recently.
+    for from_doc, to_doc in [(2, 0), (3, 2), (4, 3), (1, 0), (4, 1)]:
+      library.insert_with_new_key(models.DocLinkModel,
+        trunk_ref=docs[to_doc].trunk_ref.key(), doc_ref=docs[to_doc].key(),
+        from_trunk_ref=docs[from_doc].trunk_ref.key(),
+        from_doc_ref=docs[from_doc].key())
+
+    self.assertEquals([docs[4].key(), docs[1].key()],
+                      library.get_course_path(docs[0]))
+    entry = models.TrunkParents.get_by_key_name(str(docs[0].trunk_ref.key()))
+    self.assertEquals([docs[1].trunk_ref.key(), docs[2].trunk_ref.key()],
+                      entry.parent_trunks)
+    self.assertEquals([docs[4].key(), docs[1].key()], entry.course_path)
+
+    # A new parent makes the path be searched again.
+    library.insert_with_new_key(models.DocLinkModel,
+      trunk_ref=docs[0].trunk_ref.key(), doc_ref=docs[0].key(),
+      from_trunk_ref=docs[4].trunk_ref.key(), from_doc_ref=docs[4].key())
+    self.assertEquals([docs[4].key()], library.get_course_path(docs[0]))
+
+
+class PrevNextLinksTest(unittest.TestCase):
+  """Test navigating the reading order of a course."""
+
+  def _link(self, from_doc, to_doc):
+    link = library.insert_with_new_key(models.DocLinkModel,
+      trunk_ref=to_doc.trunk_ref.key(), doc_ref=to_doc.key(),
+      from_trunk_ref=from_doc.trunk_ref.key(), from_doc_ref=from_doc.key())
+    from_doc.content.append(link.key())
+    from_doc.put()
+
+  def testSequenceRevisitsParentAndSkipsCycles(self):
+    course, lesson1, lesson2, module = [library.create_new_doc()
+                                        for i in range(4)]
+    # course: [lesson1, text, lesson2]; lesson1: [module]; module: [course]
+    self._link(course, lesson1)
+    text = library.insert_with_new_key(models.RichTextModel)
+    course.content.append(text.key())
+    course.put()
+    self._link(course, lesson2)
+    self._link(lesson1, module)
+    self._link(module, course)
+
+    entries, positions = models.get_course_sequence(course)
+    key = lambda doc: doc and str(doc.key())
+    self.assertEquals(
+        [(key(course), None), (key(lesson1), None), (key(module), None),
+         (key(course), key(lesson1)), (key(lesson2), None)],
+        [(entry[1], entry[4]) for entry in entries])
+    self.assertEquals(key(lesson1), entries[2][3])
+
+    visit = models.TraversalPath.new_for(users.User('test1@gmail.com'),
+      module.trunk_ref, current_doc=module,
+      path=[course.key(), lesson1.key()])
+    prev_param, next_param = library.getPrevNextLinks(module, visit, None)
+    self.assertEquals(key(lesson1), dict(prev_param)['doc_id'])
+    self.assertEquals(key(lesson1), dict(next_param)['came_from'])
+    prev_param, next_param = library.getPrevNextLinks(course, None, lesson1)
+    self.assertEquals(key(module), dict(prev_param)['doc_id'])
+    self.assertEquals(key(lesson2), dict(next_param)['doc_id'])
+    self.assertEquals(key(course), dict(next_param)['parent_id'])
+
+  def testSharedModuleFollowsVisitPath(self):
+    course, lesson1, lesson2, module = [library.create_new_doc()
+                                        for i in range(4)]
+    self._link(course, lesson1)
+    self._link(course, lesson2)
+    self._link(lesson1, module)
+    self._link(lesson2, module)
+
+    entries, positions = models.get_course_sequence(course)
+    key = lambda doc: doc and str(doc.key())
+    self.assertEquals(
+        [key(course), key(lesson1), key(module), key(lesson2), key(module)],
+        [entry[1] for entry in entries])
+
+    visit = models.TraversalPath.new_for(users.User('test1@gmail.com'),
+      module.trunk_ref, current_doc=module,
+      path=[course.key(), lesson2.key()])
+    prev_param, next_param = library.getPrevNextLinks(module, visit, None)
+    self.assertEquals(key(lesson2), dict(prev_param)['doc_id'])
+    self.assertEquals(None, next_param)
+
 
 class GetOrCreateSessionIdTest(unittest.TestCase):
   """Test for updating recent course entries."""
@@ -272,9 +372,9 @@ class GetOrCreateSessionIdTest(unittest.TestCase):
   def testValidGet(self):
     temp_user = users.User('test1@gmail.com')
     widget = library.insert_with_new_key(models.WidgetModel, widget_url='xx')
-    vs = library.insert_with_new_key(models.WidgetProgressState,
-                                     widget_ref=widget, user=temp_user,
-                                     progress_score=2)
+    vs = models.WidgetProgressState.new_for(temp_user, widget,
+                                            progress_score=2)
+    vs.put()
     id = str(library.get_or_create_session(widget, temp_user).key())
     self.assertEquals(id, str(vs.key()))
 
@@ -305,8 +405,8 @@ class UpdateRecentCourseEntryTest(unittest.TestCase):
     doc2.label = models.AllowedLabels.MODULE
     doc2.put()
 
-    library.insert_with_new_key(models.DocVisitState, trunk_ref=doc1.trunk_ref,
-      doc_ref=doc1, user=temp_user, progress_score=50)
+    models.DocVisitState.new_for(temp_user, doc1.trunk_ref,
+      doc_ref=doc1, progress_score=50).put()
 
     e1 = library.update_recent_course_entry(doc2, doc1, temp_user)
     self.assertEquals(e1.course_trunk_ref.key(), trunk1.key())
@@ -334,9 +434,9 @@ class UpdateRecentCourseEntryTest(unittest.TestCase):
     doc2.label = models.AllowedLabels.MODULE
     doc2.put()
 
-    visit_state = library.insert_with_new_key(
-        models.DocVisitState, trunk_ref=doc1.trunk_ref,
-        doc_ref=doc1, user=temp_user, progress_score=50)
+    visit_state = models.DocVisitState.new_for(
+        temp_user, doc1.trunk_ref, doc_ref=doc1, progress_score=50)
+    visit_state.put()
 
     e1 = library.update_recent_course_entry(doc2, doc1, temp_user)
     self.assertEquals(e1.course_trunk_ref.key(), trunk1.key())
@@ -393,11 +493,11 @@ class GetRecentInProgressCoursesTest(unittest.TestCase):
     doc2.put()
 
     #making entry for visit
-    library.insert_with_new_key(models.DocVisitState, trunk_ref=doc1.trunk_ref,
-      doc_ref=doc1, user=temp_user, progress_score=100)
+    models.DocVisitState.new_for(temp_user, doc1.trunk_ref,
+      doc_ref=doc1, progress_score=100).put()
 
-    library.insert_with_new_key(models.DocVisitState, trunk_ref=doc2.trunk_ref,
-      doc_ref=doc2, user=temp_user, progress_score=100)
+    models.DocVisitState.new_for(temp_user, doc2.trunk_ref,
+      doc_ref=doc2, progress_score=100).put()
 
     library.update_recent_course_entry(doc1, doc1, temp_user)
     library.update_recent_course_entry(doc2, doc2, temp_user)
@@ -416,12 +516,12 @@ class GetRecentInProgressCoursesTest(unittest.TestCase):
     doc2.label = models.AllowedLabels.COURSE
     doc2.put()
     #making entry for visit
-    library.insert_with_new_key(models.DocVisitState, trunk_ref=doc1.trunk_ref,
-      doc_ref=doc1, user=temp_user, progress_score=0)
+    models.DocVisitState.new_for(temp_user, doc1.trunk_ref,
+      doc_ref=doc1, progress_score=0).put()
 
-    entry = library.insert_with_new_key(
-        models.DocVisitState, trunk_ref=doc2.trunk_ref,
-        doc_ref=doc2, user=temp_user, progress_score=10)
+    entry = models.DocVisitState.new_for(
+        temp_user, doc2.trunk_ref, doc_ref=doc2, progress_score=10)
+    entry.put()
 
     e1 = library.update_recent_course_entry(doc1, doc1, temp_user)
     e2 = library.update_recent_course_entry(doc2, doc2, temp_user)
@@ -451,8 +551,8 @@ class GetDocForUserTest(unittest.TestCase):
     doc1 = library.create_new_doc(trunk.key())
     doc2 = library.create_new_doc(trunk.key())
 
-    library.insert_with_new_key(models.DocVisitState, trunk_ref=trunk,
-      doc_ref = doc1)
+    models.DocVisitState.new_for(users.get_current_user(), trunk,
+      doc_ref = doc1).put()
     doc = library.get_doc_for_user(trunk.key(), users.get_current_user())
     self.assertEquals(str(doc.key()), str(doc1.key()))
 
@@ -471,11 +571,9 @@ class GetDocForUserTest(unittest.TestCase):
     doc3 = library.create_new_doc(trunk.key())
 
     new_user1 = users.User('test1@gmail.com')
-    library.insert_with_new_key(models.DocVisitState, trunk_ref=trunk,
-      doc_ref = doc1, user=new_user1)
+    models.DocVisitState.new_for(new_user1, trunk, doc_ref = doc1).put()
     new_user2 = users.User('test2@gmail.com')
-    library.insert_with_new_key(models.DocVisitState, trunk_ref=trunk,
-      doc_ref = doc2, user=new_user2)
+    models.DocVisitState.new_for(new_user2, trunk, doc_ref = doc2).put()
 
     new_user3 = users.User('test3@gmail.com')
     doc = library.get_doc_for_user(trunk.key(), new_user1)
@@ -492,6 +590,71 @@ class GetDocForUserTest(unittest.TestCase):
       users.get_current_user())
 
 
+class ExpandPathsTest(unittest.TestCase):
+  """Test expanding several traversal paths at once."""
+
+  def testHistoryAndHeads(self):
+    user = users.User('expand@gmail.com')
+    trunk = library.insert_with_new_key(models.TrunkModel)
+    old = library.create_new_doc(trunk.key())
+    head = library.create_new_doc(trunk.key())
+    other = library.create_new_doc()
+    models.DocVisitState.new_for(user, trunk, doc_ref=old).put()
+    visit_stacks = [
+        models.TraversalPath.new_for(user, other.trunk_ref,
+                                     path=[old.key(), other.key()]),
+        models.TraversalPath.new_for(user, trunk, path=[other.key()])]
+
+    key = lambda doc: str(doc.key())
+    paths = library.expand_paths(visit_stacks, user, True)
+    self.assertEquals([[key(old), key(other)], [key(other)]],
+                      [map(key, path) for path in paths])
+    paths = library.expand_paths(visit_stacks, user, False)
+    self.assertEquals([[key(head), key(other)], [key(other)]],
+                      [map(key, path) for path in paths])
+    self.assertEquals([key(old), key(other)],
+                      map(key, library.get_docs_for_user(
+                          [trunk.key(), other.trunk_ref.key()], user)))
+
+  def testMissingDocsCutPaths(self):
+    user = users.User('expand@gmail.com')
+    course, lesson, page = [library.create_new_doc() for i in range(3)]
+    headless = library.insert_with_new_key(models.TrunkModel)
+    missing = library.insert_with_new_key(models.DocModel, trunk_ref=headless)
+    visit_stacks = [
+        models.TraversalPath.new_for(user, page.trunk_ref,
+                                     path=[course.key(), missing.key()]),
+        models.TraversalPath.new_for(user, lesson.trunk_ref,
+                                     path=[course.key()])]
+    missing.delete()
+
+    key = lambda doc: str(doc.key())
+    for use_history in (False, True):
+      paths = library.expand_paths(visit_stacks, user, use_history)
+      self.assertEquals([[key(course)], [key(course)]],
+                        [map(key, path) for path in paths])
+    self.assertRaises(models.InvalidDocumentError, library.expand_path,
+                      visit_stacks[0].path, user, False, False)
+
+  def testViewDocBreadcrumbShowsHeads(self):
+    # view_doc expands the path to heads, or to the user's revisions with
+    # use_history, and only to the revisions on the path with abs_path.
+    user = users.User('expand@gmail.com')
+    course = library.create_new_doc()
+    old = library.create_new_doc()
+    head = library.create_new_doc(old.trunk_ref.key())
+    path = [course.key(), old.key()]
+
+    key = lambda doc: str(doc.key())
+    self.assertEquals([key(course), key(head)],
+                      map(key, library.expand_path(path, user, False, False)))
+    self.assertEquals([key(course), key(old)],
+                      map(key, library.expand_path(path, user, False, True)))
+    library.put_doc_score(old, user, 50)
+    self.assertEquals([key(course), key(old)],
+                      map(key, library.expand_path(path, user, True, False)))
+
+
 class GetParentTest(unittest.TestCase):
   """Test for fetching parent for a doc."""
 
@@ -607,8 +770,8 @@ class GetAccumulatedScoreTest(unittest.TestCase):
     # creating a doc
     doc = library.create_new_doc()
     # registering score for doc
-    library.insert_with_new_key(models.DocVisitState, trunk_ref=doc.trunk_ref,
-      doc_ref = doc, user=users.get_current_user(), progress_score=4)
+    models.DocVisitState.new_for(users.get_current_user(), doc.trunk_ref,
+      doc_ref = doc, progress_score=4).put()
     # creating another doc
     doc1 = library.create_new_doc()
     # creating link to previous doc
@@ -620,8 +783,8 @@ class GetAccumulatedScoreTest(unittest.TestCase):
     widget = library.insert_with_new_key(models.WidgetModel,
       widget_url='http://quiz')
     # registering score for quiz
-    library.insert_with_new_key(models.WidgetProgressState, widget_ref=widget,
-      user=users.get_current_user(), progress_score=8)
+    models.WidgetProgressState.new_for(users.get_current_user(), widget,
+      progress_score=8).put()
     # adding link and quiz to doc
     doc1.content.append(link.key())
     doc1.content.append(widget.key())
@@ -640,6 +803,279 @@ class GetAccumulatedScoreTest(unittest.TestCase):
     self.assertEquals(6, score_for_doc)
 
 
+class AddToDocScoreTest(unittest.TestCase):
+  """Test pushing score changes up the visit path."""
+
+  def setUp(self):
+    self.user = users.User('test1@gmail.com')
+    self.course = library.create_new_doc()
+    self.course.label = models.AllowedLabels.COURSE
+    self.lesson = library.create_new_doc()
+    self.widgets = []
+    for i in range(2):
+      widget = library.insert_with_new_key(models.WidgetModel,
+        widget_url='http://quiz')
+      self.widgets.append(widget)
+      self.lesson.content.append(widget.key())
+    self.lesson.put()
+    link = library.insert_with_new_key(models.DocLinkModel,
+      trunk_ref=self.lesson.trunk_ref.key(), doc_ref=self.lesson.key(),
+      from_trunk_ref=self.course.trunk_ref.key(),
+      from_doc_ref=self.course.key())
+    self.course.content.append(link.key())
+    self.course.put()
+    library.update_visit_stack(self.lesson, self.course, self.user)
+
+  def _score(self, widget, score):
+    previous = library.put_widget_score(widget, self.user, score)
+    return library.add_to_doc_score(self.lesson, self.user, previous, score)
+
+  def testScoresStartUnknown(self):
+    self.assertEquals(25, self._score(self.widgets[0], 50))
+    self.assertEquals(25, self.course.get_score(self.user))
+
+  def testDeltaIsPropagated(self):
+    library.get_accumulated_score(self.lesson, self.user,
+      library.get_doc_contents_simple(self.lesson, self.user))
+    library.get_accumulated_score(self.course, self.user,
+      library.get_doc_contents_simple(self.course, self.user))
+
+    self.assertEquals(25, self._score(self.widgets[0], 50))
+    self.assertEquals(75, self._score(self.widgets[1], 100))
+    self.assertEquals(50, self._score(self.widgets[0], 0))
+    visit_state = models.DocVisitState.get_for(self.user,
+                                               self.course.trunk_ref)
+    self.assertEquals(50, visit_state.progress_score)
+    self.assertEquals(50, visit_state.score_total)
+    self.assertEquals(1, visit_state.score_count)
+
+  def testWidgetWithoutScoreJoinsCount(self):
+    session = library.get_or_create_session(self.widgets[0], self.user)
+    self.assertEquals(None, session.progress_score)
+    library.get_accumulated_score(self.lesson, self.user,
+      library.get_doc_contents_simple(self.lesson, self.user))
+
+    self.assertEquals(40, self._score(self.widgets[0], 80))
+    self.assertEquals(40, self.course.get_score(self.user))
+
+
+class GetCourseProgressTest(unittest.TestCase):
+  """Test computing the scores of a whole course at once."""
+
+  def _link(self, from_doc, to_doc):
+    link = library.insert_with_new_key(models.DocLinkModel,
+      trunk_ref=to_doc.trunk_ref.key(), doc_ref=to_doc.key(),
+      from_trunk_ref=from_doc.trunk_ref.key(), from_doc_ref=from_doc.key())
+    from_doc.content.append(link.key())
+    from_doc.put()
+
+  def testNoUser(self):
+    course = library.create_new_doc()
+    self.assertEquals({str(course.trunk_ref.key()): 0},
+                      library.get_course_progress(None, course))
+
+  def testSharedModuleAndCycle(self):
+    user = users.User('test1@gmail.com')
+    course, lesson1, lesson2, module = [library.create_new_doc()
+                                        for i in range(4)]
+    widget = library.insert_with_new_key(models.WidgetModel,
+      widget_url='http://quiz')
+    module.content.append(widget.key())
+    module.put()
+    # course -> lesson1 -> module, course -> lesson2 -> module -> course
+    self._link(course, lesson1)
+    self._link(course, lesson2)
+    self._link(lesson1, module)
+    self._link(lesson2, module)
+    self._link(module, course)
+    library.put_widget_score(widget, user, 60)
+    models.DocVisitState.new_for(user, lesson1.trunk_ref, doc_ref=lesson1,
+      progress_score=5, dirty_bit=True).put()
+
+    scores = library.get_course_progress(user, course)
+    # The module averages the widget and the course, scored 0 so far.
+    self.assertEquals(30, scores[str(module.trunk_ref.key())])
+    self.assertEquals(30, scores[str(lesson1.trunk_ref.key())])
+    self.assertEquals(30, scores[str(course.trunk_ref.key())])
+
+    visit_state = models.DocVisitState.get_for(user, lesson1.trunk_ref)
+    self.assertEquals(30, visit_state.progress_score)
+    self.assertFalse(visit_state.dirty_bit)
+    self.assertEquals(None,
+                      models.DocVisitState.get_for(user, lesson2.trunk_ref))
+
+  def testHistoryScoresVisitedRevision(self):
+    user = users.User('test1@gmail.com')
+    course, module = library.create_new_doc(), library.create_new_doc()
+    widget = library.insert_with_new_key(models.WidgetModel,
+      widget_url='http://quiz')
+    module.content.append(widget.key())
+    module.put()
+    self._link(course, module)
+    library.put_widget_score(widget, user, 60)
+    library.put_doc_score(module, user, 60)
+    # A newer revision without the widget becomes the head.
+    library.create_new_doc(str(module.trunk_ref.key()))
+
+    module_trunk = str(module.trunk_ref.key())
+    self.assertEquals(
+        0, library.get_course_progress(user, course)[module_trunk])
+    scores = library.get_course_progress(user, course, use_history=True)
+    self.assertEquals(60, scores[module_trunk])
+    self.assertEquals(60, scores[str(course.trunk_ref.key())])
+
+  def testQuizzesScoredByLatestState(self):
+    user = users.User('test1@gmail.com')
+    course, module = library.create_new_doc(), library.create_new_doc()
+    quiz = library.insert_with_new_key(models.QuizModel,
+      quiz_url='http://quiz')
+    module.content.append(quiz.key())
+    module.put()
+    self._link(course, module)
+    models.QuizProgressState(user=user, quiz_ref=quiz, progress_score=20).put()
+    models.QuizProgressState(user=user, quiz_ref=quiz, progress_score=80).put()
+    models.QuizProgressState(user=users.User('test2@gmail.com'),
+                             quiz_ref=quiz, progress_score=10).put()
+
+    self.assertEquals({str(quiz.key()): 80},
+                      models.QuizModel.get_scores(user, [quiz]))
+    scores = library.get_course_progress(user, course)
+    self.assertEquals(80, scores[str(module.trunk_ref.key())])
+
+  def testQuizScoresSpanQueries(self):
+    user = users.User('test1@gmail.com')
+    quizzes = [library.insert_with_new_key(models.QuizModel,
+                                           quiz_url='http://quiz/%d' % i)
+               for i in range(models.QuizModel._SCORES_QUERY_SIZE + 1)]
+    for quiz in quizzes[::10]:
+      models.QuizProgressState(user=user, quiz_ref=quiz,
+                               progress_score=50).put()
+    other = library.insert_with_new_key(models.QuizModel,
+                                        quiz_url='http://other')
+    models.QuizProgressState(user=user, quiz_ref=other,
+                             progress_score=90).put()
+
+    expected = dict((str(quiz.key()), 0) for quiz in quizzes)
+    for quiz in quizzes[::10]:
+      expected[str(quiz.key())] = 50
+    self.assertEquals(expected, models.QuizModel.get_scores(user, quizzes))
+
+
+class ProgressRecordTest(unittest.TestCase):
+  """Test the packed per-course progress record."""
+
+  def testRecordFollowsScoreChanges(self):
+    user = users.User('test1@gmail.com')
+    course, lesson = library.create_new_doc(), library.create_new_doc()
+    course.label = models.AllowedLabels.COURSE
+    widget = library.insert_with_new_key(models.WidgetModel,
+      widget_url='http://quiz')
+    lesson.content.append(widget.key())
+    lesson.put()
+    link = library.insert_with_new_key(models.DocLinkModel,
+      trunk_ref=lesson.trunk_ref.key(), doc_ref=lesson.key(),
+      from_trunk_ref=course.trunk_ref.key(), from_doc_ref=course.key())
+    course.content.append(link.key())
+    course.put()
+    models.TraversalPath.new_for(user, lesson.trunk_ref, current_doc=lesson,
+      path=[course.key()]).put()
+
+    progress = library.get_progress_record(user, course)
+    self.assertEquals(None, progress.get_entry(lesson.trunk_ref.key())[0])
+    self.assertEquals(lesson.key(),
+                      library.get_doc_for_user(lesson.trunk_ref.key(), user,
+                                               progress=progress).key())
+
+    previous = library.put_widget_score(widget, user, 80)
+    library.add_to_doc_score(lesson, user, previous, 80)
+    progress = library.get_progress_record(user, course)
+    doc_id, score, last_visit, dirty_bit = progress.get_entry(
+        lesson.trunk_ref.key())
+    self.assertEquals(str(lesson.key()), doc_id)
+    self.assertEquals(80, score)
+    self.assertFalse(dirty_bit)
+    self.assertEquals(80, progress.get_entry(course.trunk_ref.key())[1])
+    self.assertEquals(80, library.get_score_for_link(link, user,
+                                                     progress=progress))
+
+    # Scores pushed up the course are copied into the record.
+    previous = library.put_widget_score(widget, user, 40)
+    library.add_to_doc_score(lesson, user, previous, 40)
+    progress = models.CourseProgress.get_for(user, course.trunk_ref)
+    self.assertEquals(40, progress.get_entry(lesson.trunk_ref.key())[1])
+    self.assertEquals(40, progress.get_entry(course.trunk_ref.key())[1])
+
+  def testRecordSeesChangesMadeElsewhere(self):
+    user = users.User('test1@gmail.com')
+    course, lesson = library.create_new_doc(), library.create_new_doc()
+    course.label = models.AllowedLabels.COURSE
+    link = library.insert_with_new_key(models.DocLinkModel,
+      trunk_ref=lesson.trunk_ref.key(), doc_ref=lesson.key(),
+      from_trunk_ref=course.trunk_ref.key(), from_doc_ref=course.key())
+    course.content.append(link.key())
+    course.put()
+    progress = library.get_progress_record(user, course)
+    self.assertEquals(0, library.get_score_for_link(link, user,
+                                                    progress=progress))
+
+    # The lesson is read without a visit path; its course is found through
+    # the parent index.
+    old_revision = lesson
+    library.create_new_doc(lesson.trunk_ref.key())
+    library.put_doc_score(old_revision, user, 100)
+
+    progress = models.CourseProgress.get_for(user, course.trunk_ref)
+    self.assertEquals(100, library.get_score_for_link(link, user,
+                                                      progress=progress))
+    self.assertEquals(old_revision.key(),
+                      library.get_doc_for_user(lesson.trunk_ref.key(), user,
+                                               progress=progress).key())
+
+  def testOtherCourseKeepsRecord(self):
+    user = users.User('test1@gmail.com')
+    course, other, lesson = [library.create_new_doc() for i in range(3)]
+    for doc in course, other:
+      doc.label = models.AllowedLabels.COURSE
+      doc.put()
+    library.get_progress_record(user, course)
+
+    models.TraversalPath.new_for(user, lesson.trunk_ref, current_doc=lesson,
+      path=[other.key()]).put()
+    library.put_doc_score(lesson, user, 100)
+    self.assertEquals(
+        None, models.CourseProgress.get_for(user, course.trunk_ref).get_entry(
+            lesson.trunk_ref.key()))
+
+
+  def testSharedModuleScoredThroughOtherCourse(self):
+    user = users.User('test1@gmail.com')
+    course, other, module = [library.create_new_doc() for i in range(3)]
+    links = []
+    for doc in course, other:
+      doc.label = models.AllowedLabels.COURSE
+      link = library.insert_with_new_key(models.DocLinkModel,
+        trunk_ref=module.trunk_ref.key(), doc_ref=module.key(),
+        from_trunk_ref=doc.trunk_ref.key(), from_doc_ref=doc.key())
+      doc.content.append(link.key())
+      doc.put()
+      links.append(link)
+    progress = library.get_progress_record(user, course)
+    self.assertEquals(0, library.get_score_for_link(links[0], user,
+                                                    progress=progress))
+
+    models.TraversalPath.new_for(user, module.trunk_ref, current_doc=module,
+      path=[other.key()]).put()
+    library.put_doc_score(module, user, 100)
+
+    progress = library.get_progress_record(user, course)
+    self.assertEquals(100, progress.get_entry(module.trunk_ref.key())[1])
+    self.assertEquals(100, library.get_score_for_link(links[0], user,
+                                                      progress=progress))
+    self.assertEquals(module.key(),
+                      library.get_doc_for_user(module.trunk_ref.key(), user,
+                                               progress=progress).key())
+
+
 class AppendToTrunkTest(unittest.TestCase):
   """Test appending document to trunk."""
 
@@ -988,5 +1424,132 @@ class BaseUrlTest(unittest.TestCase):
     self.assertTrue(isinstance(result, urlparse.ParseResult))
 
 
+
+class SitemapTest(unittest.TestCase):
+  """Tests the sitemap files rendered from the course catalog."""
+
+  def testIndexFollowsCatalog(self):
+    page_size = models.CATALOG_PAGE_SIZE
+    models.CATALOG_PAGE_SIZE = 1
+    try:
+      for title in (u'a', u'b'):
+        utils.new_head(title=title, label=models.AllowedLabels.COURSE)
+      index = library.get_sitemap()
+      parts = index.count('sitemap.xml?part=')
+      self.assertTrue(parts >= 2)
+      self.assertEquals(index, library.get_sitemap())
+
+      utils.new_head(title=u'c', label=models.AllowedLabels.COURSE)
+      self.assertEquals(parts + 1,
+                        library.get_sitemap().count('sitemap.xml?part='))
+    finally:
+      models.CATALOG_PAGE_SIZE = page_size
+
+
+class RekeyUserStatesTest(unittest.TestCase):
+  """Tests moving user states to their deterministic key names."""
+
+  def _rekey(self, model_class, batch_size=100):
+    start = None
+    while True:
+      start, moved = library.rekey_user_states(model_class, start, batch_size)
+      if not start:
+        break
+
+  def testTimestampsAreKept(self):
+    temp_user = users.User('rekey@gmail.com')
+    doc = library.create_new_doc()
+    old = library.insert_with_new_key(models.RecentCourseState,
+      course_trunk_ref=doc.trunk_ref, course_doc_ref=doc, user=temp_user)
+
+    self._rekey(models.RecentCourseState)
+
+    state = models.RecentCourseState.get_for(temp_user, doc.trunk_ref)
+    self.assertEquals(old.time_stamp, state.time_stamp)
+
+  def testDuplicatesInDifferentBatches(self):
+    temp_user = users.User('rekey@gmail.com')
+    doc = library.create_new_doc()
+    library.insert_with_new_key(models.DocVisitState, trunk_ref=doc.trunk_ref,
+      doc_ref=doc, user=temp_user, progress_score=10)
+    latest = library.insert_with_new_key(models.DocVisitState,
+      trunk_ref=doc.trunk_ref, doc_ref=doc, user=temp_user, progress_score=20)
+
+    self._rekey(models.DocVisitState, batch_size=1)
+
+    state = models.DocVisitState.get_for(temp_user, doc.trunk_ref)
+    self.assertEquals(20, state.progress_score)
+    self.assertEquals(latest.last_visit, state.last_visit)
+
+  def testDuplicatesCollapseToLatest(self):
+    temp_user = users.User('rekey@gmail.com')
+    doc = library.create_new_doc()
+    library.insert_with_new_key(models.DocVisitState, trunk_ref=doc.trunk_ref,
+      doc_ref=doc, user=temp_user, progress_score=10)
+    library.insert_with_new_key(models.DocVisitState, trunk_ref=doc.trunk_ref,
+      doc_ref=doc, user=temp_user, progress_score=20)
+    self.assertEquals(None,
+                      models.DocVisitState.get_for(temp_user, doc.trunk_ref))
+
+    self._rekey(models.DocVisitState)
+
+    state = models.DocVisitState.get_for(temp_user, doc.trunk_ref)
+    self.assertEquals(20, state.progress_score)
+    self.assertEquals(1, models.DocVisitState.all().filter(
+        'user =', temp_user).count())
+
+
+class BackfillPathTrunksTest(unittest.TestCase):
+  """Tests storing the trunks of paths written without them."""
+
+  def testPathTrunksAreStored(self):
+    temp_user = users.User('backfill@gmail.com')
+    course, lesson, page = [library.create_new_doc() for i in range(3)]
+    # Bypasses TraversalPath.put(), like paths stored before path_trunks.
+    db.put(models.TraversalPath.new_for(temp_user, page.trunk_ref,
+      current_doc=page, path=[course.key(), lesson.key()]))
+
+    start = None
+    while True:
+      start, updated = library.backfill_path_trunks(start)
+      if not start:
+        break
+
+    visit_stack = models.TraversalPath.get_for(temp_user, page.trunk_ref)
+    self.assertEquals([course.trunk_ref.key(), lesson.trunk_ref.key()],
+                      visit_stack.path_trunks)
+
+
+class BackfillTrunkMetadataTest(unittest.TestCase):
+  """Tests copying head metadata onto trunks saved without it."""
+
+  def _backfill(self):
+    """Runs the backfill over all trunks, returns the number saved."""
+    start = None
+    total = 0
+    while True:
+      start, updated = library.backfill_trunk_metadata(start)
+      total += updated
+      if not start:
+        return total
+
+  def testUpToDateTrunksAreNotSaved(self):
+    library.create_new_doc()
+    self._backfill()
+    self.assertEquals(0, self._backfill())
+
+  def testTrunksAreDatedByFirstRevision(self):
+    doc = library.create_new_doc()
+    trunk = db.get(doc.trunk_ref.key())
+    first = models.TrunkRevisionModel.all().ancestor(trunk).get()
+    # Saved after TrunkModel.created was deployed, but before the backfill.
+    trunk.created = first.created + datetime.timedelta(days=30)
+    trunk.put()
+
+    self._backfill()
+
+    self.assertEquals(first.created, db.get(trunk.key()).created)
+
+
 if __name__ == "__main__":
   unittest.main()
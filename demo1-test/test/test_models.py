@@ -25,7 +25,10 @@ from google.appengine.ext import db
 from google.appengine.api import users
 
 # local imports
+from demo import identity_map
+from demo import library
 from demo import models
+import utils
 
 class ModelsHashTest(unittest.TestCase):
   """Tests the underlying hashing used to create keys for referenced content.
@@ -69,6 +72,377 @@ class ModelsHashTest(unittest.TestCase):
 
     self.assertTrue(obj.is_shared)
 
+  def testInsertManyMatchesInsert(self):
+    existing = models.RichTextModel.insert(data='insert_many existing')
+    objects = models.BaseContentModel.insert_many([
+        (models.RichTextModel, {'data': 'insert_many new'}),
+        (models.RichTextModel, {'data': 'insert_many existing'}),
+        (models.WidgetModel, {'widget_url': 'http://w', 'title': 'W',
+                              'is_shared': False, 'widget_index': 1}),
+        (models.RichTextModel, {'data': 'insert_many new'}),
+        ])
+    self.assertEquals(existing.key(), objects[1].key())
+    self.assertEquals(objects[0].key(), objects[3].key())
+    self.assertEquals(
+        models.RichTextModel.insert(data='insert_many new').key(),
+        objects[0].key())
+    self.assertEquals(
+        models.WidgetModel.insert(widget_url='http://w', title='W',
+                                  is_shared=False, widget_index=1).key(),
+        objects[2].key())
+
+
+class TrunkHeadTest(unittest.TestCase):
+  """Tests the memcache-backed trunk to head resolution."""
+
+  def setUp(self):
+    identity_map.clear()
+
+  def testResolvesLatestHead(self):
+    doc1 = library.create_new_doc()
+    trunk_key = identity_map.ref_key(doc1, 'trunk_ref')
+    self.assertEquals(doc1.key(), models.get_trunk_head(trunk_key).key())
+
+    doc2 = library.create_new_doc(str(trunk_key))
+    identity_map.clear()
+    self.assertEquals(doc2.key(), models.get_trunk_head(trunk_key).key())
+
+  def testCachedHeadCostsNoDatastoreGet(self):
+    doc = library.create_new_doc()
+    trunk_key = identity_map.ref_key(doc, 'trunk_ref')
+    models.get_trunk_head(trunk_key)
+    identity_map.clear()
+
+    head = models.get_trunk_head(str(trunk_key))
+    self.assertEquals(doc.key(), head.key())
+    self.assertEquals(0, identity_map.stats()['misses'])
+
+  def testDocPutInvalidatesCachedHead(self):
+    doc = library.create_new_doc()
+    trunk_key = identity_map.ref_key(doc, 'trunk_ref')
+    models.get_trunk_head(trunk_key)
+
+    doc.title = 'Renamed'
+    doc.put()
+    identity_map.clear()
+    self.assertEquals('Renamed', models.get_trunk_head(trunk_key).title)
+
+  def testBatchPreservesOrder(self):
+    doc1 = library.create_new_doc()
+    doc2 = library.create_new_doc()
+    missing = db.Key.from_path('TrunkModel', 'no-such-trunk')
+    heads = models.get_trunk_heads([
+        identity_map.ref_key(doc2, 'trunk_ref'), missing,
+        identity_map.get_ref(doc1, 'trunk_ref')])
+    self.assertEquals(doc2.key(), heads[0].key())
+    self.assertEquals(None, heads[1])
+    self.assertEquals(doc1.key(), heads[2].key())
+
+
+class TrunkTitleIndexTest(unittest.TestCase):
+  """Tests listing trunks by title through TrunkTitleIndex."""
+
+  def _new_head(self, title, trunk_id=None):
+    return utils.new_head(trunk_id, title=title)
+
+  def testPagesFollowCursor(self):
+    docs = [self._new_head('Indexed %d' % i) for i in range(3)]
+    self._new_head('Not indexed')
+
+    entries, cursor, at_end = models.TrunkTitleIndex.fetch_page('Indexed', 2)
+    self.assertEquals(['Indexed 0', 'Indexed 1'], [e[0] for e in entries])
+    self.assertEquals((str(docs[0].trunk_ref.key()), str(docs[0].key())),
+                      entries[0][1:])
+    self.assertFalse(at_end)
+
+    entries, cursor, at_end = models.TrunkTitleIndex.fetch_page(
+        'Indexed', 2, cursor=cursor)
+    self.assertEquals(['Indexed 2'], [e[0] for e in entries])
+    self.assertTrue(at_end)
+
+  def testNewHeadReplacesEntry(self):
+    doc = self._new_head('Retitled old')
+    trunk_id = str(doc.trunk_ref.key())
+    new_doc = self._new_head('Retitled new', trunk_id)
+
+    self.assertEquals(
+        [], models.TrunkTitleIndex.fetch_page('Retitled old', 5)[0])
+    self.assertEquals(
+        [('Retitled new', trunk_id, str(new_doc.key()))],
+        models.TrunkTitleIndex.fetch_page('Retitled', 5)[0])
+
+  def testUnchangedTrunkKeepsEntry(self):
+    doc = self._new_head('Unchanged')
+    trunk = db.get(doc.trunk_ref.key())
+    entry = models.TrunkTitleIndex.get_by_key_name(
+        models.TrunkTitleIndex.KEY_NAME, parent=trunk)
+    entry.title = 'Not rewritten'
+    entry.put()
+
+    trunk.fork_list.append(trunk.key())
+    trunk.put()
+    self.assertEquals('Not rewritten', models.TrunkTitleIndex.get_by_key_name(
+        models.TrunkTitleIndex.KEY_NAME, parent=trunk).title)
+
+
+class TrunkListTest(unittest.TestCase):
+  """Tests listing trunks from the metadata cached on them."""
+
+  def testPagesNewestFirst(self):
+    docs = []
+    for i in range(3):
+      doc = library.create_new_doc()
+      doc.title = 'Listed %d' % i
+      doc.put()
+      library.create_new_doc(str(doc.trunk_ref.key()))
+      docs.append(doc)
+    library.insert_with_new_key(models.TrunkModel)
+
+    entries, cursor, at_end = models.get_trunk_list('created', count=2)
+    self.assertEquals([str(docs[2].trunk_ref.key()),
+                       str(docs[1].trunk_ref.key())],
+                      [e['trunk_id'] for e in entries])
+    self.assertFalse(at_end)
+    self.assertEquals(
+        (entries, cursor, at_end), models.get_trunk_list('created', count=2))
+
+    entries = models.get_trunk_list('created', count=2, cursor=cursor)[0]
+    self.assertEquals(str(docs[0].trunk_ref.key()), entries[0]['trunk_id'])
+    head = models.get_trunk_head(docs[0].trunk_ref.key())
+    self.assertEquals(head.key(), db.Key(entries[0]['doc_id']))
+    self.assertEquals(head.title, entries[0]['title'])
+
+  def testUnknownOrderRaises(self):
+    self.assertRaises(ValueError, models.get_trunk_list, 'modified')
+
+
+class CourseCatalogTest(unittest.TestCase):
+  """Tests the course catalog built from the trunks."""
+
+  def testHeadChangesUpdateCatalog(self):
+    course = library.create_new_doc()
+    library.create_new_doc()
+    models.get_course_catalog()
+
+    utils.put_head(course, label=models.AllowedLabels.COURSE)
+    catalog = models.get_course_catalog()
+    self.assertTrue(str(course.key()) in
+                    [entry['doc_id'] for entry in catalog])
+    self.assertEquals(catalog, models.get_course_catalog())
+
+    utils.put_head(course, label=models.AllowedLabels.MODULE)
+    self.assertFalse(str(course.key()) in
+                     [entry['doc_id'] for entry in models.get_course_catalog()])
+
+  def testPagesResumeFromCursors(self):
+    page_size = models.CATALOG_PAGE_SIZE
+    models.CATALOG_PAGE_SIZE = 2
+    try:
+      for title in (u'a', u'b', u'c'):
+        utils.new_head(title=title, label=models.AllowedLabels.COURSE)
+      entries = []
+      number = 0
+      at_end = False
+      while not at_end:
+        number += 1
+        page = models.get_course_catalog_page(number)
+        self.assertEquals(page, models.get_course_catalog_page(number))
+        self.assertTrue(len(page[0]) <= 2)
+        entries.extend(page[0])
+        at_end = page[2]
+      self.assertTrue(number >= 2)
+      self.assertEquals(entries, models.get_course_catalog())
+      self.assertEquals(([], None, True),
+                        models.get_course_catalog_page(number + 1))
+    finally:
+      models.CATALOG_PAGE_SIZE = page_size
+
+
+class CourseTagsTest(unittest.TestCase):
+  """Tests the tag index kept on trunk heads."""
+
+  def _new_head(self, tags, trunk_id=None, label=models.AllowedLabels.COURSE):
+    return utils.new_head(trunk_id, label=label,
+                          tags=[db.Category(tag) for tag in tags])
+
+  def _count(self, tag):
+    # As the task queued by TrunkModel.put() does.
+    models.update_tag_counts([db.Category(tag)])
+    return dict(models.get_tag_counts()).get(tag, 0)
+
+  def testOnlyHeadsAreListed(self):
+    course = self._new_head(['tagged algebra'])
+    trunk_id = str(course.trunk_ref.key())
+    self._new_head(['tagged algebra'], label=models.AllowedLabels.MODULE)
+    self.assertEquals(1, self._count('tagged algebra'))
+
+    # A new revision of the same course is listed once.
+    new_head = self._new_head(['tagged algebra', 'tagged geometry'],
+                              trunk_id)
+    entries = models.get_tagged_courses('tagged algebra')[0]
+    self.assertEquals([(trunk_id, str(new_head.key()))],
+                      [(e['trunk_id'], e['doc_id']) for e in entries])
+    self.assertEquals(1, self._count('tagged algebra'))
+    self.assertEquals(1, self._count('tagged geometry'))
+
+    self._new_head(['tagged geometry'], trunk_id)
+    self.assertEquals([], models.get_tagged_courses('tagged algebra')[0])
+    self.assertEquals(0, self._count('tagged algebra'))
+    self.assertEquals(1, self._count('tagged geometry'))
+
+
+class OutlineTest(unittest.TestCase):
+  """Tests the breadth-first course outline."""
+
+  def setUp(self):
+    identity_map.clear()
+
+  def _doc(self, title):
+    doc = library.create_new_doc()
+    doc.title = title
+    doc.put()
+    return doc
+
+  def _link(self, from_doc, to_doc):
+    link = library.insert_with_new_key(models.DocLinkModel,
+      trunk_ref=to_doc.trunk_ref.key(), doc_ref=to_doc.key(),
+      from_trunk_ref=from_doc.trunk_ref.key(), from_doc_ref=from_doc.key())
+    from_doc.content.append(link.key())
+    from_doc.put()
+
+  def testCyclicLinksTerminate(self):
+    docs = []
+    for i in range(3):
+      docs.append(self._doc(str(i)))
+    # 0 -> 1 -> 2 -> 0
+    self._link(docs[0], docs[1])
+    self._link(docs[1], docs[2])
+    self._link(docs[2], docs[0])
+
+    outline = docs[0].outline()
+    self.assertEquals('0', outline['title'])
+    self.assertEquals(['1'], [c['title'] for c in outline['content']])
+    child = outline['content'][0]
+    self.assertEquals(['2'], [c['title'] for c in child['content']])
+    self.assertEquals([], child['content'][0]['content'])
+
+  def testHeadChangeInvalidatesOutline(self):
+    parent = self._doc('parent')
+    child = self._doc('child')
+    self._link(parent, child)
+    self.assertEquals('child', parent.outline()['content'][0]['title'])
+
+    child.title = 'renamed'
+    child.put()
+    identity_map.clear()
+    self.assertEquals('renamed', parent.outline()['content'][0]['title'])
+
+  def testSharedModuleUnderEachLesson(self):
+    course, lesson1, lesson2, module = [
+        self._doc(title) for title in ('course', 'lesson1', 'lesson2', 'mod')]
+    self._link(course, lesson1)
+    self._link(course, lesson2)
+    self._link(lesson1, module)
+    self._link(lesson2, module)
+
+    outline = course.outline()
+    self.assertEquals([['mod'], ['mod']],
+                      [[c['title'] for c in lesson['content']]
+                       for lesson in outline['content']])
+
+  def testOtherTrunkChangeKeepsOutline(self):
+    parent = self._doc('parent')
+    self._link(parent, self._doc('child'))
+    outline = parent.outline()
+
+    other = self._doc('other')
+    other.title = 'renamed'
+    other.put()
+    self.assertTrue(outline is parent.outline())
+
+
+class GqlCacheTest(unittest.TestCase):
+  """Tests the shared query templates of models.gql()."""
+
+  def testCallsDoNotShareBindings(self):
+    first = models.gql(models.TrunkModel, 'WHERE title = :1', 'first')
+    second = models.gql(models.TrunkModel, 'WHERE title = :1', 'second')
+    self.assertFalse(first is second)
+    trunk = library.insert_with_new_key(models.TrunkModel, title='first')
+    self.assertEquals([trunk.key()], [t.key() for t in first.fetch(10)])
+    self.assertEquals([], second.fetch(10))
+
+  def testRecordsExecutionsPerShape(self):
+    clause = 'WHERE title = :1 AND head = :2'
+    query_string = 'SELECT * FROM TrunkModel ' + clause
+    before = models.query_stats().get(query_string, {}).get('count', 0)
+    models.gql(models.TrunkModel, clause, 'a', 'b').fetch(1)
+    models.gql(models.TrunkModel, clause, 'c', 'd').count()
+    stats = models.query_stats()[query_string]
+    self.assertEquals(before + 2, stats['count'])
+    self.assertTrue(stats['max'] <= stats['total'])
+
+
+class VisitedTrunksTest(unittest.TestCase):
+  """Tests the Bloom filter of visited trunks."""
+
+  def setUp(self):
+    identity_map.clear()
+
+  def testPutDocScoreRecordsTrunk(self):
+    user = users.User('visited1@gmail.com')
+    visited, unvisited = library.create_new_doc(), library.create_new_doc()
+    library.put_doc_score(visited, user, 40)
+    self.assertTrue(models.VisitedTrunks.may_have_visited(
+        user, visited.trunk_ref.key()))
+    self.assertFalse(models.VisitedTrunks.may_have_visited(
+        user, unvisited.trunk_ref.key()))
+    self.assertEquals(0, unvisited.get_score(user))
+
+    identity_map.clear()
+    self.assertEquals(40, visited.get_score(user))
+
+  def testFilterIsBuiltFromExistingStates(self):
+    user = users.User('visited2@gmail.com')
+    doc = library.create_new_doc()
+    # Bypasses DocVisitState.put(), like states written before the filter.
+    db.put(models.DocVisitState.new_for(user, doc.trunk_ref, doc_ref=doc,
+                                        progress_score=70))
+    self.assertEquals(70, doc.get_score(user))
+
+  def testFilterIsRebuiltInBatches(self):
+    user = users.User('visited4@gmail.com')
+    docs = [library.create_new_doc() for i in range(3)]
+    states = [models.DocVisitState.new_for(user, doc.trunk_ref, doc_ref=doc)
+              for doc in docs[:2]]
+    # A state still under a random key, as before rekey_user_states().
+    states.append(models.DocVisitState(user=user, trunk_ref=docs[2].trunk_ref,
+                                       doc_ref=docs[2]))
+    db.put(states)
+    batch_size = models.VisitedTrunks.REBUILD_BATCH_SIZE
+    models.VisitedTrunks.REBUILD_BATCH_SIZE = 1
+    try:
+      visited = models.VisitedTrunks.get_filter(user)
+    finally:
+      models.VisitedTrunks.REBUILD_BATCH_SIZE = batch_size
+    for doc in docs:
+      self.assertTrue(visited.contains(doc.trunk_ref.key()))
+
+  def testPutInTransactionMarksFilterStale(self):
+    user = users.User('visited3@gmail.com')
+    doc = library.create_new_doc()
+    trunk_key = doc.trunk_ref.key()
+    self.assertFalse(models.VisitedTrunks.may_have_visited(user, trunk_key))
+
+    visit_state = models.DocVisitState.new_for(user, doc.trunk_ref,
+                                               doc_ref=doc, progress_score=30)
+    db.run_in_transaction(visit_state.put)
+    self.assertTrue(models.VisitedTrunks.may_have_visited(user, trunk_key))
+
+    identity_map.clear()
+    self.assertTrue(models.VisitedTrunks.may_have_visited(user, trunk_key))
+    self.assertEquals(30, doc.get_score(user))
+
 
 if __name__ == "__main__":
   unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the full-text search index."""
+
+# Python imports
+import unittest
+
+# AppEngine imports
+from google.appengine.ext import db
+
+# local imports
+from demo import library
+from demo import models
+from demo import search
+import utils
+
+
+class TokenizeTest(unittest.TestCase):
+  """Tests splitting text into terms."""
+
+  def testStripsMarkupAndEntities(self):
+    text = search.strip_html(
+        '<p>Caf&eacute; <b>au</b>&nbsp;lait</p><script>var x;</script>')
+    self.assertEquals([u'caf\xe9', u'au', u'lait'], search.tokenize(text))
+
+  def testDropsShortTerms(self):
+    self.assertEquals(['this', 'is', 'test'],
+                      search.tokenize('This is a test'))
+
+
+class SearchTest(unittest.TestCase):
+  """Tests indexing heads and querying the index."""
+
+  def _new_head(self, title, text, trunk_id=None, tags=()):
+    text = models.RichTextModel.insert(data=db.Blob(text))
+    doc = utils.new_head(trunk_id, title=title, content=[text.key()],
+                         tags=[db.Category(tag) for tag in tags])
+    search.index_doc(doc)
+    return doc
+
+  def _found(self, query):
+    return [result['trunk_id'] for result in search.search(query)]
+
+  def testAllTermsMustMatch(self):
+    both = self._new_head('Photosynthesis', '<p>Plants need light</p>')
+    one = self._new_head('Respiration', '<p>Plants need oxygen</p>')
+    both_id = str(both.trunk_ref.key())
+    one_id = str(one.trunk_ref.key())
+
+    self.assertEquals([both_id], self._found('light plants'))
+    self.assertEquals(set([both_id, one_id]), set(self._found('plants')))
+    self.assertEquals([], self._found('light oxygen'))
+
+  def testTitleRanksAboveContent(self):
+    in_text = self._new_head('Leaves', '<p>About chlorophyll</p>')
+    in_title = self._new_head('Chlorophyll', '<p>Green pigment</p>')
+    self.assertEquals([str(in_title.trunk_ref.key()),
+                       str(in_text.trunk_ref.key())],
+                      self._found('chlorophyll'))
+
+  def testNewHeadReplacesTerms(self):
+    doc = self._new_head('Mitosis', '<p>Cell division</p>')
+    trunk_id = str(doc.trunk_ref.key())
+    self.assertEquals([trunk_id], self._found('mitosis'))
+
+    self._new_head('Meiosis', '<p>Cell division</p>', trunk_id,
+                   tags=['biology'])
+    self.assertEquals([], self._found('mitosis'))
+    self.assertEquals([trunk_id], self._found('meiosis biology'))
+
+  def testIndexTrunkUsesCurrentHead(self):
+    doc = self._new_head('Osmosis', '<p>Water moves</p>')
+    trunk_id = str(doc.trunk_ref.key())
+    clone = library.create_new_doc(trunk_id)
+    clone.title = 'Diffusion'
+    clone.put()
+
+    self.assertEquals(clone.key(), search.index_trunk(trunk_id).key())
+    self.assertEquals([], self._found('osmosis'))
+    self.assertEquals([trunk_id], self._found('diffusion'))
+
+  def testLongPostingListsKeepHeaviest(self):
+    in_title = self._new_head('Enzymes', '<p>Proteins</p>')
+    self._new_head('Catalysis', '<p>Enzymes speed reactions</p>')
+    self._new_head('Digestion', '<p>Enzymes break food</p>')
+    max_postings = search.MAX_POSTINGS
+    search.MAX_POSTINGS = 1
+    try:
+      self.assertEquals([str(in_title.trunk_ref.key())],
+                        self._found('enzymes'))
+    finally:
+      search.MAX_POSTINGS = max_postings
+    self.assertEquals((3, [(str(in_title.trunk_ref.key()),
+                            search.TITLE_WEIGHT)]),
+                      search._get_postings(['enzymes'])['enzymes'])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the XML sitemap generator."""
+
+# Python imports
+import datetime
+import unittest
+from xml.dom import minidom
+
+# local imports
+from demo import sitemap
+
+
+def _locs(rendered):
+  """Returns the <loc> values of a sitemap or sitemap index."""
+  return [node.firstChild.data for node in
+          minidom.parseString(rendered).getElementsByTagName('loc')]
+
+
+class SitemapTest(unittest.TestCase):
+  """Tests splitting URLs into sitemap files."""
+
+  def testEscapesAndDates(self):
+    files = list(sitemap.generate([
+        ('http://x/view?a=1&b=2', datetime.datetime(2010, 5, 17, 8, 30))]))
+    self.assertEquals(1, len(files))
+    self.assertTrue('<loc>http://x/view?a=1&amp;b=2</loc>' in files[0])
+    self.assertTrue('<lastmod>2010-05-17</lastmod>' in files[0])
+
+  def testEmptyListYieldsEmptyFile(self):
+    files = list(sitemap.generate([]))
+    self.assertEquals(1, len(files))
+    self.assertEquals([], _locs(files[0]))
+
+  def testSplitsOnUrlCount(self):
+    urls = [('http://x/%d' % i, None) for i in range(5)]
+    files = list(sitemap.generate(urls, max_urls=2))
+    self.assertEquals([2, 2, 1], [len(_locs(f)) for f in files])
+    self.assertEquals([loc for loc, lastmod in urls],
+                      sum([_locs(f) for f in files], []))
+
+  def testSplitsOnSize(self):
+    urls = [('http://x/%d' % i, None) for i in range(10)]
+    single = list(sitemap.generate(urls[:1]))[0]
+    files = list(sitemap.generate(urls, max_bytes=len(single) + 40))
+    self.assertTrue(len(files) > 1)
+    for rendered in files:
+      self.assertTrue(len(rendered) <= len(single) + 40)
+    self.assertEquals(10, sum([len(_locs(f)) for f in files]))
+
+  def testIndexListsFiles(self):
+    index = sitemap.generate_index(['http://x/sitemap.xml?part=1',
+                                    'http://x/sitemap.xml?part=2'])
+    self.assertTrue('<sitemapindex' in index)
+    self.assertEquals(['http://x/sitemap.xml?part=1',
+                       'http://x/sitemap.xml?part=2'], _locs(index))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the write-behind buffer of user states."""
+
+# Python imports
+import time
+import unittest
+
+# AppEngine imports
+from google.appengine.api import memcache
+from google.appengine.api import users
+from google.appengine.ext import db
+
+# local imports
+from demo import identity_map
+from demo import library
+from demo import models
+from demo import write_behind
+
+
+class WriteBehindTest(unittest.TestCase):
+  """Tests buffering, reading through and flushing."""
+
+  def setUp(self):
+    memcache.flush_all()
+    write_behind.ENABLED = True
+    self.user = users.User('test1@gmail.com')
+    self.doc = library.create_new_doc()
+
+  def tearDown(self):
+    write_behind.ENABLED = False
+
+  def _bucket(self):
+    return int(time.time()) // write_behind.FLUSH_INTERVAL
+
+  def testPutIsReadThroughAndFlushed(self):
+    first_bucket = self._bucket()
+    library.put_doc_score(self.doc, self.user, 40)
+    library.put_doc_score(self.doc, self.user, 70)
+    last_bucket = self._bucket()
+
+    key = models.DocVisitState.key_for(self.user, self.doc.trunk_ref)
+    self.assertEquals(None, db.get(key))
+    self.assertEquals(70, self.doc.get_score(self.user))
+
+    written = 0
+    for bucket in range(first_bucket, last_bucket + 1):
+      written += write_behind.flush(bucket)
+    self.assertTrue(written)
+    self.assertEquals(70, db.get(key).progress_score)
+
+    # Once flushed, readers go back to the datastore.
+    stored = db.get(key)
+    stored.progress_score = 20
+    db.put(stored)
+    self.assertEquals(20, self.doc.get_score(self.user))
+    self.assertEquals(0, write_behind.flush(last_bucket))
+
+  def testDirectPutDropsBufferedCopy(self):
+    bucket = self._bucket()
+    library.put_doc_score(self.doc, self.user, 40)
+    visit_state = models.DocVisitState.get_for(self.user, self.doc.trunk_ref)
+    visit_state.progress_score = 90
+    visit_state.put()
+
+    self.assertEquals(90, self.doc.get_score(self.user))
+    write_behind.flush(bucket)
+    key = models.DocVisitState.key_for(self.user, self.doc.trunk_ref)
+    self.assertEquals(90, db.get(key).progress_score)
+
+  def testFlushKeepsTimeOfPut(self):
+    bucket = self._bucket()
+    library.put_doc_score(self.doc, self.user, 40)
+    last_visit = models.DocVisitState.get_for(
+        self.user, self.doc.trunk_ref).last_visit
+    time.sleep(1)
+    write_behind.flush(bucket)
+    key = models.DocVisitState.key_for(self.user, self.doc.trunk_ref)
+    self.assertEquals(last_visit, db.get(key).last_visit)
+
+  def testFlushPendingBeforeFilterRebuild(self):
+    library.put_doc_score(self.doc, self.user, 40)
+    db.delete(models.VisitedTrunks.key_for(self.user))
+    identity_map.clear()
+
+    self.assertTrue(models.VisitedTrunks.may_have_visited(
+        self.user, self.doc.trunk_ref.key()))
+    key = models.DocVisitState.key_for(self.user, self.doc.trunk_ref)
+    self.assertEquals(40, db.get(key).progress_score)
+
+  def testDisabledWritesThrough(self):
+    write_behind.ENABLED = False
+    library.put_doc_score(self.doc, self.user, 40)
+    key = models.DocVisitState.key_for(self.user, self.doc.trunk_ref)
+    self.assertEquals(40, db.get(key).progress_score)
+
+
+if __name__ == "__main__":
+  unittest.main()
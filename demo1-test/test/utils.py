@@ -19,8 +19,9 @@
 
 """Test utils for setting up and tearing down environment.
 
-These are not needed when using the GAE Unit's test runner, since it is
-basically doing this already.
+setUpTest() and tearDownTest() are not needed when using the GAE Unit's test
+runner, since it is basically doing this already. new_head() and put_head()
+build the trunk heads the tests work on.
 """
 
 # Python imports
@@ -34,6 +35,10 @@ from google.appengine.api import mail_stub
 from google.appengine.api import urlfetch_stub
 from google.appengine.api import user_service_stub
 
+# local imports
+from demo import identity_map
+from demo import library
+
 APP_ID = u'test_app'
 AUTH_DOMAIN = 'gmail.com'
 LOGGED_IN_USER = 't...@example.com'  # set to '' for no logged in user
@@ -86,3 +91,33 @@ def tearDownTest(orig_apiproxy):
         restore the state for the dev server.
   """
   apiproxy_stub_map.apiproxy = orig_apiproxy
+
+
+def put_head(doc, **fields):
+  """Sets fields on a document, stores it and makes it its trunk's head.
+
+  Args:
+    doc: The DocModel to store.
+    **fields: Property values to set on doc before storing it.
+  Returns:
+    doc.
+  """
+  for name, value in fields.items():
+    setattr(doc, name, value)
+  doc.put()
+  trunk = identity_map.get_ref(doc, 'trunk_ref')
+  trunk.setHead(doc)
+  trunk.put()
+  return doc
+
+
+def new_head(trunk_id=None, **fields):
+  """Creates a document and makes it its trunk's head, see put_head().
+
+  Args:
+    trunk_id: Trunk to append the document to; a new trunk if None.
+    **fields: Property values to set on the document.
+  Returns:
+    The new DocModel.
+  """
+  return put_head(library.create_new_doc(trunk_id), **fields)
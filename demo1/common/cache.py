@@ -0,0 +1,368 @@
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Two-tier cache: a bounded in-process LRU in front of memcache.
+
+Values are cached under a namespace and a string key. Each namespace is
+declared with register(), which says which tiers it uses:
+
+  - The local tier is an LRU shared by all the requests of this instance,
+    bounded to LOCAL_CAPACITY entries. Entries there may be up to
+    local_max_age seconds older than memcache, since deletes made by other
+    instances do not reach it. Pinned namespaces, meant for a few small
+    values that live as long as the instance, are kept in an unbounded
+    table of their own instead, so that large values cannot evict them.
+  - The remote tier is memcache, shared by all instances.
+
+Every namespace carries a version counter that is part of its keys;
+invalidate() bumps it, which drops everything in the namespace at once.
+Versions of remote namespaces live in memcache and are re-read at most every
+VERSION_CHECK_INTERVAL seconds.
+
+Values held by the local tier are shared between requests as-is; callers
+must not mutate what get() returns.
+
+Methods:
+  register(): Declares a namespace and its tiers.
+  get(), get_multi(): Look values up, local tier first.
+  set_value(), set_multi(): Store values in both tiers.
+  delete(), delete_multi(): Drop values from both tiers.
+  invalidate(): Drops a whole namespace by bumping its version.
+  stats(): Returns hit/miss/eviction counters.
+"""
+
+import logging
+import sha
+import threading
+import time
+
+from google.appengine.api import memcache
+
+
+# Maximum number of entries kept in the local tier.
+LOCAL_CAPACITY = 2000
+
+# Seconds a version counter read from memcache is trusted.
+VERSION_CHECK_INTERVAL = 5
+
+# Memcache namespace used for all the values and version counters.
+_MEMCACHE_NAMESPACE = 'common.cache'
+
+# Memcache keys must not exceed 250 bytes; longer keys are hashed.
+_MAX_KEY_LENGTH = 200
+
+
+class _Namespace(object):
+  """Configuration and version of a namespace, see register()."""
+
+  def __init__(self, name, local, remote, local_max_age, pinned):
+    self.name = name
+    self.local = local
+    self.remote = remote
+    self.local_max_age = local_max_age
+    self.pinned = pinned
+    self.version = 1
+    self.version_checked = 0
+
+
+class _LRU(object):
+  """A thread-safe dictionary bounded to capacity entries, or unbounded.
+
+  Entries are kept in a circular doubly linked list, most recently used
+  first; each node is a [prev, next, key, value, expires] list.
+  """
+
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.lock = threading.Lock()
+    self.clear()
+
+  def clear(self):
+    self.nodes = {}
+    self.root = root = []
+    root[:] = [root, root, None, None, None]
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def _unlink(self, node):
+    prev, next = node[0], node[1]
+    prev[1] = next
+    next[0] = prev
+
+  def _push_front(self, node):
+    root = self.root
+    node[0] = root
+    node[1] = root[1]
+    root[1][0] = node
+    root[1] = node
+
+  def get(self, key):
+    """Returns (True, value), or (False, None) if key is missing or expired."""
+    self.lock.acquire()
+    try:
+      node = self.nodes.get(key)
+      if node is not None and node[4] is not None and node[4] < time.time():
+        self._unlink(node)
+        del self.nodes[key]
+        node = None
+      if node is None:
+        self.misses += 1
+        return False, None
+      self.hits += 1
+      self._unlink(node)
+      self._push_front(node)
+      return True, node[3]
+    finally:
+      self.lock.release()
+
+  def set(self, key, value, expires=None):
+    self.lock.acquire()
+    try:
+      node = self.nodes.get(key)
+      if node is not None:
+        self._unlink(node)
+      else:
+        node = [None, None, key, None, None]
+        self.nodes[key] = node
+      node[3] = value
+      node[4] = expires
+      self._push_front(node)
+      while self.capacity is not None and len(self.nodes) > self.capacity:
+        oldest = self.root[0]
+        self._unlink(oldest)
+        del self.nodes[oldest[2]]
+        self.evictions += 1
+    finally:
+      self.lock.release()
+
+  def delete(self, key):
+    self.lock.acquire()
+    try:
+      node = self.nodes.pop(key, None)
+      if node is not None:
+        self._unlink(node)
+    finally:
+      self.lock.release()
+
+
+_namespaces = {}
+_local = _LRU(LOCAL_CAPACITY)
+_pinned = _LRU(None)
+_remote_hits = 0
+_remote_misses = 0
+
+
+def register(name, local=True, remote=True, local_max_age=60, pinned=False):
+  """Declares a namespace. Re-registering a name updates its configuration.
+
+  Args:
+    name: Name of the namespace.
+    local: Whether values are kept in the in-process LRU.
+    remote: Whether values are kept in memcache. Values of namespaces that
+        are not remote need not be picklable.
+    local_max_age: Seconds a value may stay in the local tier, or None for
+        no limit. Only use None for values that cannot change, or for
+        namespaces that are not remote.
+    pinned: Whether local values are kept out of the LRU, where they are
+        never evicted. Only for namespaces holding few small values.
+  """
+  namespace = _namespaces.get(name)
+  if namespace is None:
+    namespace = _namespaces[name] = _Namespace(name, local, remote,
+                                               local_max_age, pinned)
+  else:
+    namespace.local = local
+    namespace.remote = remote
+    namespace.local_max_age = local_max_age
+    namespace.pinned = pinned
+  return namespace
+
+
+def _get_namespace(name):
+  namespace = _namespaces.get(name)
+  if namespace is None:
+    raise KeyError('Cache namespace %r is not registered' % name)
+  if namespace.remote and (
+      time.time() - namespace.version_checked > VERSION_CHECK_INTERVAL):
+    version = memcache.get('version:' + name, namespace=_MEMCACHE_NAMESPACE)
+    if version is None:
+      memcache.add('version:' + name, namespace.version,
+                   namespace=_MEMCACHE_NAMESPACE)
+    else:
+      namespace.version = version
+    namespace.version_checked = time.time()
+  return namespace
+
+
+def _local_tier(namespace):
+  """Returns the _LRU holding the local values of namespace."""
+  if namespace.pinned:
+    return _pinned
+  return _local
+
+
+def _full_key(namespace, key):
+  """Returns the key under which key of namespace is stored in both tiers."""
+  full_key = '%s|%d|%s' % (namespace.name, namespace.version, key)
+  if len(full_key) > _MAX_KEY_LENGTH:
+    full_key = '%s|%d|#%s' % (namespace.name, namespace.version,
+                              sha.new(key).hexdigest())
+  return full_key
+
+
+def get_multi(namespace, keys):
+  """Looks up several keys of a namespace.
+
+  Args:
+    namespace: Name of a registered namespace.
+    keys: List of string keys.
+  Returns:
+    A dict mapping the keys that were found to their values.
+  """
+  global _remote_hits, _remote_misses
+  namespace = _get_namespace(namespace)
+  results = {}
+  remote_keys = {}
+  for key in keys:
+    full_key = _full_key(namespace, key)
+    if namespace.local:
+      found, value = _local_tier(namespace).get(full_key)
+      if found:
+        results[key] = value
+        continue
+    if namespace.remote:
+      remote_keys[full_key] = key
+
+  if remote_keys:
+    fetched = memcache.get_multi(remote_keys.keys(),
+                                 namespace=_MEMCACHE_NAMESPACE)
+    _remote_hits += len(fetched)
+    _remote_misses += len(remote_keys) - len(fetched)
+    for full_key, value in fetched.iteritems():
+      results[remote_keys[full_key]] = value
+      if namespace.local:
+        _local_tier(namespace).set(full_key, value,
+                                   _local_expiry(namespace, 0))
+  return results
+
+
+def get(namespace, key, default=None):
+  """Looks up a single key of a namespace, see get_multi()."""
+  return get_multi(namespace, [key]).get(key, default)
+
+
+def _local_expiry(namespace, seconds):
+  """Returns when a local entry stored for seconds (0 = forever) expires."""
+  ages = [age for age in (seconds, namespace.local_max_age) if age]
+  if not ages:
+    return None
+  return time.time() + min(ages)
+
+
+def set_multi(namespace, mapping, expires=0):
+  """Stores several values in a namespace.
+
+  Args:
+    namespace: Name of a registered namespace.
+    mapping: Dict of string keys to values.
+    expires: Optional expiration in seconds; 0 means no expiration.
+  """
+  namespace = _get_namespace(namespace)
+  remote = {}
+  for key, value in mapping.iteritems():
+    full_key = _full_key(namespace, key)
+    if namespace.local:
+      _local_tier(namespace).set(full_key, value,
+                                 _local_expiry(namespace, expires))
+    if namespace.remote:
+      remote[full_key] = value
+  if remote:
+    failed = memcache.set_multi(remote, time=expires,
+                                namespace=_MEMCACHE_NAMESPACE)
+    if failed:
+      logging.warning('cache: memcache set failed for %d keys', len(failed))
+
+
+def set_value(namespace, key, value, expires=0):
+  """Stores a single value, see set_multi()."""
+  set_multi(namespace, {key: value}, expires=expires)
+
+
+def delete_multi(namespace, keys):
+  """Drops several keys of a namespace from both tiers."""
+  namespace = _get_namespace(namespace)
+  full_keys = [_full_key(namespace, key) for key in keys]
+  if namespace.local:
+    for full_key in full_keys:
+      _local_tier(namespace).delete(full_key)
+  if namespace.remote and full_keys:
+    memcache.delete_multi(full_keys, namespace=_MEMCACHE_NAMESPACE)
+
+
+def delete(namespace, key):
+  """Drops a single key, see delete_multi()."""
+  delete_multi(namespace, [key])
+
+
+def invalidate(namespace):
+  """Drops every value of a namespace by bumping its version.
+
+  Other instances notice the new version within VERSION_CHECK_INTERVAL
+  seconds.
+  """
+  namespace = _get_namespace(namespace)
+  if namespace.remote:
+    version = memcache.incr('version:' + namespace.name,
+                            namespace=_MEMCACHE_NAMESPACE)
+    if version is None:
+      version = namespace.version + 1
+      memcache.set('version:' + namespace.name, version,
+                   namespace=_MEMCACHE_NAMESPACE)
+    namespace.version = version
+    namespace.version_checked = time.time()
+  else:
+    namespace.version += 1
+
+
+def clear_local():
+  """Empties the local tier and resets its counters. Mostly for tests."""
+  global _remote_hits, _remote_misses
+  for lru in (_local, _pinned):
+    lru.lock.acquire()
+    try:
+      lru.clear()
+    finally:
+      lru.lock.release()
+  _remote_hits = _remote_misses = 0
+
+
+def stats():
+  """Returns the counters of both tiers.
+
+  Returns:
+    A dict with 'local_hits', 'local_misses', 'remote_hits', 'remote_misses',
+    'evictions', 'size', 'capacity' and 'pinned_size'. The local counters
+    include the pinned namespaces.
+  """
+  return {
+      'local_hits': _local.hits + _pinned.hits,
+      'local_misses': _local.misses + _pinned.misses,
+      'remote_hits': _remote_hits,
+      'remote_misses': _remote_misses,
+      'evictions': _local.evictions,
+      'size': len(_local.nodes),
+      'capacity': _local.capacity,
+      'pinned_size': len(_pinned.nodes),
+      }
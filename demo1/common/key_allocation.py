@@ -0,0 +1,70 @@
+#!/usr/bin/python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Allocation of key names for new entities, shared by the demo and quiz apps.
+
+Methods:
+  allocate_key_names(): Returns key names no other entity of a kind uses.
+"""
+
+import threading
+
+from google.appengine.ext import db
+
+
+# Number of ids reserved from the datastore at a time, per kind.
+_KEY_BLOCK_SIZE = 50
+
+# Maps kind to [next id, last id] of the block of ids reserved for this
+# process.
+_key_blocks = {}
+_key_blocks_lock = threading.Lock()
+
+
+def allocate_key_names(cls, count=1):
+  """Returns count key names that no other entity of cls uses.
+
+  The names are built from ids reserved with db.allocate_ids() in blocks of
+  _KEY_BLOCK_SIZE, so most calls cost no RPC at all. They have the form
+  'k.<id>'; '.' is not part of the alphabet of the random key names older
+  entities got from gen_random_string() (in demo.models and quiz.library),
+  so they cannot collide with those either.
+
+  Ids are reserved for the root of the kind, hence names are unique whatever
+  parent the entities are created under.
+
+  Args:
+    cls: Data model class.
+    count: Number of key names needed.
+  Returns:
+    A list of count key names.
+  """
+  kind = cls.kind()
+  names = []
+  _key_blocks_lock.acquire()
+  try:
+    while len(names) < count:
+      block = _key_blocks.get(kind)
+      if not block or block[0] > block[1]:
+        size = max(_KEY_BLOCK_SIZE, count - len(names))
+        block = list(db.allocate_ids(db.Key.from_path(kind, 1), size))
+        _key_blocks[kind] = block
+      take = min(count - len(names), block[1] - block[0] + 1)
+      names.extend(['k.%d' % i for i in xrange(block[0], block[0] + take)])
+      block[0] += take
+  finally:
+    _key_blocks_lock.release()
+  return names
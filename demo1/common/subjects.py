@@ -26,6 +26,8 @@ import os
 import yaml
 from django.utils import simplejson
 
+from common import cache
+
 
 class SubjectItem(object):
   """Represents a subject item.
@@ -120,8 +122,10 @@ class SubjectTaxonomy(object):
     return children is None
 
 
-# Singleton of taxonomy.
-_taxonomy = None
+# The taxonomy is loaded from a file shipped with the app, so it never
+# changes for the life of an instance; it is kept in the local tier only,
+# pinned so that large cached values do not evict it.
+cache.register('subjects', remote=False, local_max_age=None, pinned=True)
 
 
 def _GetSubjectsTaxonomyFromYaml(fileObj):
@@ -160,14 +164,17 @@ def GetSubjectsTaxonomy(force=False):
   Returns:
     An instance of SubjectTaxonomy.
   """
-  global _taxonomy
-  if _taxonomy and not force:
-    return _taxonomy
+  taxonomy = None
+  if not force:
+    taxonomy = cache.get('subjects', 'taxonomy')
+  if taxonomy:
+    return taxonomy
 
   fname = os.path.join(os.path.dirname(__file__), 'subjects.yaml')
   fileObj = open(fname, "r")
-  _taxonomy = _GetSubjectsTaxonomyFromYaml(fileObj)
-  return _taxonomy
+  taxonomy = _GetSubjectsTaxonomyFromYaml(fileObj)
+  cache.set_value('subjects', 'taxonomy', taxonomy)
+  return taxonomy
 
 
 def _ToDict(taxonomy, subject_id, levels, result=None):
@@ -18,6 +18,8 @@
 
 DEFAULT_TITLE = 'Lantern'
 HOME_DOMAIN = 'www.k16-8888.appspot.com'
+# Base of the absolute URLs given out, e.g. in the sitemap.
+SITE_URL = 'http://' + HOME_DOMAIN
 YAML_TYPE_KEY = 'doc_type'
 GROUP_TEMPLATE = 'group.html'
 CONTENT_TEMPLATE = 'content.html'
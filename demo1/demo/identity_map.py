@@ -0,0 +1,260 @@
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Request-scoped identity map for datastore entities.
+
+A single page view fetches the same TrunkModel and head DocModel many times
+through fetch_doc(), get_doc_for_user(), update_visit_stack(), etc. Routing
+those reads through get() below makes each key cost at most one datastore
+RPC per request; repeated lookups return the very same instance.
+
+The map is cleared at the start of every request by
+middleware.ClearIdentityMapMiddleware (and explicitly by the task handlers,
+which do not go through Django). BaseModel.put() and delete() keep the map
+in sync with writes made during the request.
+
+Methods:
+  get(): Drop-in replacement for db.get() that consults the map first.
+  peek(): Returns an entity only if it is already in the map.
+  get_ref(): Resolves a ReferenceProperty through the map.
+  prefetch_refs(): Resolves ReferenceProperties of many entities at once.
+  ref_key(): Returns the key stored in a ReferenceProperty without fetching.
+  add(), forget(): Record or drop entities after writes.
+  clear(): Empties the map and resets the counters.
+  stats(): Returns the hit/miss counters for debugging.
+"""
+
+import threading
+
+from google.appengine.ext import db
+
+
+# Marks keys that are known not to exist, so that misses are cached as well.
+_MISSING = object()
+
+
+class _RequestState(threading.local):
+  """Per-thread (hence per-request) state of the identity map.
+
+  Attributes:
+    entities: Maps str(key) to the entity, or to _MISSING.
+    hits: Number of keys served from the map.
+    misses: Number of keys that had to be fetched from the datastore.
+  """
+
+  def __init__(self):
+    self.entities = {}
+    self.hits = 0
+    self.misses = 0
+
+
+_state = _RequestState()
+
+
+def clear():
+  """Empties the identity map. Called at the start of each request."""
+  _state.entities = {}
+  _state.hits = 0
+  _state.misses = 0
+
+
+def _to_key(key_or_entity):
+  """Normalizes a key, key string or model instance into a db.Key.
+
+  Raises:
+    BadKeyError: If a string that is not a valid key is passed, just like
+        db.get() would.
+  """
+  if isinstance(key_or_entity, db.Key):
+    return key_or_entity
+  if isinstance(key_or_entity, basestring):
+    return db.Key(key_or_entity)
+  return key_or_entity.key()
+
+
+def get(keys):
+  """Fetches the specified entities, consulting the identity map first.
+
+  Has the same calling convention as db.get(): a single key returns a single
+  entity (or None), a list of keys returns a list. All the keys missing from
+  the map are fetched with a single db.get().
+
+  Args:
+    keys: A db.Key, key string or model instance, or a list of them.
+  Returns:
+    An entity or None, or a list of entities/None in the order of keys.
+  Raises:
+    BadKeyError: If a malformed key string is passed.
+  """
+  multiple = isinstance(keys, (list, tuple))
+  if not multiple:
+    keys = [keys]
+  keys = [_to_key(k) for k in keys]
+
+  entities = _state.entities
+  to_fetch = []
+  for key in keys:
+    key_str = str(key)
+    if key_str in entities:
+      _state.hits += 1
+    else:
+      _state.misses += 1
+      to_fetch.append(key)
+      # Guard against the same key appearing twice in one call.
+      entities[key_str] = _MISSING
+
+  if to_fetch:
+    try:
+      fetched = db.get(to_fetch)
+    except:
+      for key in to_fetch:
+        del entities[str(key)]
+      raise
+    for key, entity in zip(to_fetch, fetched):
+      if entity is not None:
+        entities[str(key)] = entity
+
+  results = []
+  for key in keys:
+    entity = entities[str(key)]
+    if entity is _MISSING:
+      entity = None
+    results.append(entity)
+
+  if multiple:
+    return results
+  return results[0]
+
+
+def peek(key):
+  """Returns the entity for key if it is already in the map, else None.
+
+  Never touches the datastore and does not affect the counters.
+
+  Args:
+    key: A db.Key, key string or model instance.
+  """
+  entity = _state.entities.get(str(_to_key(key)))
+  if entity is _MISSING:
+    return None
+  return entity
+
+
+def ref_key(entity, name):
+  """Returns the key stored in a ReferenceProperty, without fetching it.
+
+  Accessing entity.trunk_ref.key() dereferences the property, which costs a
+  datastore get just to learn the key; this does not.
+
+  Args:
+    entity: A model instance.
+    name: Name of a ReferenceProperty of the model.
+  Returns:
+    A db.Key, or None if the property is not set.
+  """
+  return getattr(entity.__class__, name).get_value_for_datastore(entity)
+
+
+def get_ref(entity, name):
+  """Dereferences a ReferenceProperty through the identity map.
+
+  Args:
+    entity: A model instance.
+    name: Name of a ReferenceProperty of the model.
+  Returns:
+    The referenced entity, or None if the property is unset or the entity
+    does not exist.
+  """
+  key = ref_key(entity, name)
+  if key is None:
+    return None
+  return get(key)
+
+
+def prefetch_refs(entities, *names):
+  """Resolves the named ReferenceProperties of a list of entities at once.
+
+  Walking a list and touching el.trunk_ref dereferences one entity at a
+  time. This collects the referenced keys across the whole list, fetches
+  them with a single get() and attaches the results, so that later
+  attribute access (including from templates) costs no RPC.
+
+  References to entities that do not exist are left alone, so accessing
+  them still raises as it would have.
+
+  Args:
+    entities: List of model instances; None entries are skipped.
+    names: Names of ReferenceProperties to resolve.
+  """
+  entities = [e for e in entities if e is not None]
+  keys = []
+  for entity in entities:
+    for name in names:
+      key = ref_key(entity, name)
+      if key is not None:
+        keys.append(key)
+  if not keys:
+    return
+
+  get(keys)
+  for entity in entities:
+    for name in names:
+      key = ref_key(entity, name)
+      if key is not None:
+        referenced = peek(key)
+        if referenced is not None:
+          setattr(entity, name, referenced)
+
+
+def add(entities):
+  """Records freshly written entities in the identity map.
+
+  Args:
+    entities: A model instance or a list of them. Unsaved ones are ignored.
+  """
+  if not isinstance(entities, (list, tuple)):
+    entities = [entities]
+  for entity in entities:
+    if entity is not None and entity.is_saved():
+      _state.entities[str(entity.key())] = entity
+
+
+def forget(keys):
+  """Drops the specified keys from the identity map.
+
+  Args:
+    keys: A db.Key, key string or model instance, or a list of them.
+  """
+  if not isinstance(keys, (list, tuple)):
+    keys = [keys]
+  for key in keys:
+    _state.entities.pop(str(_to_key(key)), None)
+
+
+def stats():
+  """Returns the counters of the identity map.
+
+  Returns:
+    A dict with 'hits', 'misses', 'size' and 'hit_rate' (a float in [0, 1]).
+  """
+  lookups = _state.hits + _state.misses
+  hit_rate = 0.0
+  if lookups:
+    hit_rate = float(_state.hits) / lookups
+  return {
+      'hits': _state.hits,
+      'misses': _state.misses,
+      'size': len(_state.entities),
+      'hit_rate': hit_rate,
+      }
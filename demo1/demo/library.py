@@ -23,23 +23,28 @@
 
 import base64
 import cgi
+import datetime
 import logging
 import os
 import re
 import urlparse
 
 from google.appengine.ext import db
-from google.appengine.api import memcache
+from google.appengine.api import datastore
 from google.appengine.api import users
 
 import django.template
 import django.utils.safestring
 from django.core.urlresolvers import reverse
 
+from common import cache
 import constants
+import identity_map
 import models
+import write_behind
 import yaml
 import notify
+import sitemap
 
 # For registering filter and tag libs.
 register = django.template.Library()
@@ -80,6 +85,10 @@ def get_key(cls):
   return str(object_key)
 
 
+# Rendered user links, by email.
+cache.register('show_user')
+
+
 @register.filter
 def show_user(email, arg=None, autoescape=None, memcache_results=None):
   """Render a link to the user's dashboard, with text being the nickname."""
@@ -93,10 +102,10 @@ def show_user(email, arg=None, autoescape=None, memcache_results=None):
   if memcache_results is not None:
     ret = memcache_results.get(email)
   else:
-    ret = memcache.get('show_user:' + email)
+    ret = cache.get('show_user', email)
 
   if ret is None:
-    logging.debug('memcache miss for %r', email)
+    logging.debug('cache miss for %r', email)
     account = models.Account.get_account_for_email(email)
     if account is not None and account.user_has_selected_nickname:
       ret = ('<a href="%s" onMouseOver="M_showUserInfoPopup(this)">%s</a>' %
@@ -109,10 +118,10 @@ def show_user(email, arg=None, autoescape=None, memcache_results=None):
         nick = nick.split('@', 1)[0]
       ret = cgi.escape(nick)
 
-    memcache.add('show_user:%s' % email, ret, 300)
+    cache.set_value('show_user', email, ret, expires=300)
 
     # populate the dict with the results, so same user in the list later
-    # will have a memcache "hit" on "read".
+    # will have a cache "hit" on "read".
     if memcache_results is not None:
       memcache_results[email] = ret
 
@@ -123,9 +132,9 @@ def show_user(email, arg=None, autoescape=None, memcache_results=None):
 def show_users(email_list, arg=None):
   """Render list of links to each user's dashboard."""
   if not email_list:
-    # Don't wast time calling memcache with an empty list.
+    # Don't wast time calling the cache with an empty list.
     return ''
-  memcache_results = memcache.get_multi(email_list, key_prefix='show_user:')
+  memcache_results = cache.get_multi('show_user', email_list)
   return django.utils.safestring.mark_safe(', '.join(
       show_user(email, arg, memcache_results=memcache_results)
       for email in email_list))
@@ -306,28 +315,35 @@ def parse_leaf(path):
 ### Library function to interact with datastore ###
 
 def insert_with_new_key(cls, parent=None, **kwargs):
-  """Insert model into datastore with a random key.
+  """Insert model into datastore with a new, unique key.
+
+  See common.key_allocation.allocate_key_names() for how keys are chosen.
 
   Args:
     cls: Data model class (ex. models.DocModel).
     parent: optional parent argument to bind models in same entity group.
-      NOTE: If parent argument is passed, key_name may not be unique across
-      all entities.
   Returns:
     Data model entity or None if error.
-
-  TODO(mukundjha): Check for race condition.
   """
   return models.insert_model_with_new_key(cls, parent=parent, **kwargs)
 
 
+def insert_many_with_new_keys(cls, values_list, parent=None):
+  """Inserts one model per dict of values in values_list, with a single put.
+
+  Args:
+    cls: Data model class (ex. models.DocModel).
+    values_list: List of dicts of initial property values.
+    parent: optional parent argument to bind models in same entity group.
+  Returns:
+    The list of new entities.
+  """
+  return models.insert_models_with_new_keys(cls, values_list, parent=parent)
+
+
 def create_new_trunk_with_doc(doc_id, commit_message=None):
   """Creates a new trunk with given document as head.
 
-  WARNING: Since we are passing parent parameter in insert_with_new_key,
-  function will only check for uniqueness of key among entities having 'trunk'
-  as an ancestor. This no longer guarantees unique key_name across all entities.
-
   NOTE(mukundjha): No check is done on doc_id, it's responsibility of
   other functions calling create_new_trunk_with_doc to check the parameter
   before its passed.
@@ -402,7 +418,7 @@ def create_new_doc(trunk_id=None, **kwargs):
 
   if trunk_id:
     try:
-      trunk = db.get(trunk_id)
+      trunk = identity_map.get(trunk_id)
     except db.BadKeyError, e:
       raise models.InvalidTrunkError('Invalid Trunk id %s', str(trunk_id))
 
@@ -421,10 +437,15 @@ def create_new_doc(trunk_id=None, **kwargs):
     doc.delete()
     raise models.InvalidDocumentError('Unable to create/append to trunk')
 
+  # The transaction wrote a new copy of the trunk; remember that one. Its
+  # cached head was dropped inside the transaction, where a concurrent reader
+  # could have cached the old head again before the commit.
+  identity_map.add(trunk)
+  models.invalidate_trunk_head(trunk)
   try:
-    tip = db.get(trunk.head)
+    tip = identity_map.get(trunk.head)
     if isinstance(tip, models.DocModel):
-      trunk.title = tip.title
+      trunk.copyHeadInfo(tip)
       trunk.put()
   except db.BadKeyError, e:
     pass
@@ -452,17 +473,18 @@ def fetch_doc(trunk_id, doc_id=None):
     InvalidDocumentError: If trunk_id passed is invalid.
   """
   try:
-    trunk = db.get(trunk_id)
+    trunk_key = db.Key(str(trunk_id))
   except db.BadKeyError, e:
     raise models.InvalidTrunkError('Invalid trunk id: %s', trunk_id)
 
   if doc_id:
     try:
-      doc = db.get(doc_id)
+      doc = identity_map.get(doc_id)
     except db.BadKeyError, e:
       raise models.InvalidDocumentError('No document Found with provided key')
 
-    trunk_revisions = models.TrunkRevisionModel.all().ancestor(trunk)
+    # The ancestor query only needs the trunk's key, not the trunk itself.
+    trunk_revisions = models.TrunkRevisionModel.all().ancestor(trunk_key)
     trunk_revision_with_doc = trunk_revisions.filter('obj_ref =',
                                                       str(doc.key()))
 
@@ -474,13 +496,14 @@ def fetch_doc(trunk_id, doc_id=None):
   # Using cached value of head stored in trunk, should be fine since all
   # writes are atomic and updates head.
 
-  if trunk.head:
-    return db.get(trunk.head)
+  head = models.get_trunk_head(trunk_key)
+  if head:
+    return head
   else:
     raise models.InvalidDocumentError("Trunk has no head document!")
 
 
-def get_doc_for_user(trunk_id, user):
+def get_doc_for_user(trunk_id, user, progress=None):
   """Retrieves document based on user's visit history.
 
   If the user has visited a particular revision (document of a trunk),
@@ -497,50 +520,60 @@ def get_doc_for_user(trunk_id, user):
   Args:
     trunk_id: Key to the referenced trunk.
     user: User whose history is to be used.
+    progress: Optional CourseProgress of a course containing the trunk,
+      consulted before the DocVisitState; see get_progress_record().
   Returns:
     Document based on user's visit history.
   Raises:
     InvalidTrunkError: If trunk_id is not valid.
   """
   try:
-    trunk = db.get(trunk_id)
+    trunk_key = db.Key(str(trunk_id))
   except db.BadKeyError, e:
     raise models.InvalidTrunkError('Invalid trunk %s', trunk_id)
 
-  query = models.DocVisitState.all().filter('user =', user).filter(
-      'trunk_ref =', trunk).order('-last_visit')
+  entry = progress and progress.get_entry(trunk_key)
+  if entry:
+    doc_id = entry[0]
+    if doc_id:
+      return identity_map.get(doc_id)
+    return models.get_trunk_head(trunk_key)
 
-  if query.count():
-    doc_entry = query.get()
-    return doc_entry.doc_ref
+  doc_entry = (models.VisitedTrunks.may_have_visited(user, trunk_key) and
+               models.DocVisitState.get_for(user, trunk_key))
+
+  if doc_entry:
+    return identity_map.get_ref(doc_entry, 'doc_ref')
   else:
-    doc = db.get(trunk.head)
-    return doc
+    return models.get_trunk_head(trunk_key)
 
 
 def get_parent(doc):
   """Returns a parent for a document.
 
   If multiple parents are present, choose one based on ranking function.
-  Note(mukundjha): Taking history into account makes it a very heavy on
-  datastore.
+  For now this is the document holding the latest link to doc's trunk, as
+  recorded by models.TrunkParents.
 
   Args:
-    doc: DocModel object from datastore.
+    doc: DocModel object from datastore, or its key.
   Returns:
     Document which is parent of doc passed or None if there are no
     parents.
   """
-  parent_entry = models.DocLinkModel.all().filter('doc_ref =', doc).order(
-       '-created').get()
+  if not isinstance(doc, models.DocModel):
+    doc = identity_map.get(doc)
+  entry = models.TrunkParents.get_for_trunks(
+      [identity_map.ref_key(doc, 'trunk_ref')])[0]
 
-  if parent_entry:
-    return parent_entry.from_doc_ref
+  if entry.parent_docs:
+    return identity_map.get(entry.parent_docs[0])
   else:
     return None
 
 
-def get_score_for_link(link_element, user, use_history=False, recurse=False):
+def get_score_for_link(link_element, user, use_history=False, recurse=False,
+                       progress=None):
   """Calculates score for the DocLink object.
 
   Score for a link is essentially score for the trunk pointed by the link.
@@ -548,7 +581,8 @@ def get_score_for_link(link_element, user, use_history=False, recurse=False):
   for the doc are re-computed by calling get_accumulated_score, else
   score entry for the trunk is fetched.
 
-  NOTE(mukundjha): Does not take care of cycles.
+  With recurse, the scores below the link are computed by
+  get_course_progress(), which takes care of cycles.
 
   Args:
     link_element: Link object for which score is required.
@@ -556,27 +590,28 @@ def get_score_for_link(link_element, user, use_history=False, recurse=False):
     use_history: If set user's history is used to fetch the doc.
     recurse: If set True, all the scores will be recursively computed
       and updated.
+    progress: Optional CourseProgress of a course containing the link. Its
+      entry for the trunk, unless dirty, saves the DocVisitState lookup.
 
   Returns:
     Score for the link object.
   """
   if recurse:
+    trunk_key = identity_map.ref_key(link_element, 'trunk_ref')
     if use_history:
-      doc = get_doc_for_user(link_element.trunk_ref.key(), user)
-    else:
-      doc = fetch_doc(link_element.trunk_ref.key())
-
-    if use_history:
-      doc_contents = get_doc_contents(doc, user, use_history=use_history)
+      doc = get_doc_for_user(trunk_key, user)
     else:
-      doc_contents = get_doc_contents_simple(doc, user)
-
-    return get_accumulated_score(doc, user, doc_contents,
-                                 use_history=use_history,
-                                 recurse=recurse)
+      doc = fetch_doc(trunk_key)
+    return get_course_progress(user, doc,
+                               use_history=use_history)[str(trunk_key)]
   else:
-    visit_state = models.DocVisitState.all().filter('user =', user).filter(
-        'trunk_ref =', link_element.trunk_ref).get()
+    trunk_key = identity_map.ref_key(link_element, 'trunk_ref')
+    entry = progress and progress.get_entry(trunk_key)
+    if entry and not entry[3]:
+      return entry[1]
+
+    visit_state = (models.VisitedTrunks.may_have_visited(user, trunk_key) and
+                   models.DocVisitState.get_for(user, trunk_key))
 
     if visit_state and visit_state.dirty_bit:
       if use_history:
@@ -635,15 +670,240 @@ def get_accumulated_score(doc, user, doc_contents, use_history=False,
       count += 1
 
   if total and count:
-    total = int(round(float(total)/count))
-    put_doc_score(doc, user, total)
-    return total
+    score = int(round(float(total)/count))
   else:
-    put_doc_score(doc, user, 0)
-    return 0
+    score = 0
+  put_doc_score(doc, user, score, score_total=total, score_count=count)
+  return score
+
+
+def get_course_progress(user, course_doc, use_history=False):
+  """Computes the scores of a course and of everything it links to.
+
+  The link graph is loaded one level at a time, with one get for the
+  contents of all the docs of a level and one for the docs of the trunks
+  they link to. The user's DocVisitState and WidgetProgressState entities
+  for the whole graph are then fetched with one get each, skipping the
+  trunks models.VisitedTrunks knows were never visited, and the quizzes
+  are scored with one query per 30 quizzes (see
+  models.QuizModel.get_scores()). Content keys that are no longer valid
+  are skipped.
 
+  Each trunk is scored once, however many docs link to it. A link closing a
+  cycle counts with the score stored for its trunk. So does a trunk whose
+  stored score is 100, as pages marked as read keep that score.
 
-def put_doc_score(doc, user, score):
+  Existing DocVisitState entities whose stored score turns out to be stale
+  are updated with a single put; no new ones are created.
+
+  Args:
+    user: User whose progress is computed, or None.
+    course_doc: DocModel at the root, usually a course.
+    use_history: If set, linked trunks are scored at the doc the user last
+      visited, as resolved by get_docs_for_user(); else at their head.
+  Returns:
+    A dict mapping the key (string) of each trunk reached, including the
+    one of course_doc, to its score. Without a user, only course_doc is
+    in it, with a score of 0.
+  """
+  course_trunk = str(identity_map.ref_key(course_doc, 'trunk_ref'))
+  if user is None:
+    return {course_trunk: 0}
+  docs = {course_trunk: course_doc}
+  contents = {}
+  level = [course_trunk]
+  while level:
+    keys = [key for trunk in level for key in docs[trunk].content]
+    try:
+      elements = identity_map.get(keys)
+    except db.BadKeyError:
+      # As in get_doc_contents_simple(), look the keys up one by one; bad
+      # ones are scored as missing elements.
+      elements = []
+      for key in keys:
+        try:
+          elements.append(identity_map.get(key))
+        except db.BadKeyError:
+          elements.append(None)
+    linked = []
+    for trunk in level:
+      count = len(docs[trunk].content)
+      contents[trunk], elements = elements[:count], elements[count:]
+      for element in contents[trunk]:
+        if isinstance(element, models.DocLinkModel):
+          linked_trunk = str(identity_map.ref_key(element, 'trunk_ref'))
+          if linked_trunk not in docs and linked_trunk not in linked:
+            linked.append(linked_trunk)
+    if use_history:
+      linked_docs = get_docs_for_user(linked, user)
+    else:
+      linked_docs = models.get_trunk_heads(linked)
+    level = []
+    for trunk, doc in zip(linked, linked_docs):
+      if doc:
+        docs[trunk] = doc
+        level.append(trunk)
+
+  visited = models.VisitedTrunks.get_filter(user)
+  visited_trunks = [trunk for trunk in docs if visited.contains(trunk)]
+  visit_states = dict(zip(visited_trunks,
+      models.DocVisitState.get_by_key_name(
+          [models.DocVisitState.key_name_for(user, trunk)
+           for trunk in visited_trunks])))
+  widgets = {}
+  quizzes = {}
+  for elements in contents.itervalues():
+    for element in elements:
+      if isinstance(element, models.WidgetModel):
+        widgets[str(element.key())] = element
+      elif isinstance(element, models.QuizModel):
+        quizzes[str(element.key())] = element
+  widget_states = dict(zip(widgets.keys(),
+      models.WidgetProgressState.get_by_key_name(
+          [models.WidgetProgressState.key_name_for(user, widget)
+           for widget in widgets.itervalues()])))
+  element_scores = models.QuizModel.get_scores(user, quizzes.values())
+
+  scores = {}
+  sums = {}
+  in_progress = set()
+
+  def stored_score(trunk):
+    visit_state = visit_states.get(trunk)
+    return visit_state and visit_state.progress_score or 0
+
+  def score_trunk(trunk):
+    if trunk in scores:
+      return scores[trunk]
+    if (trunk in in_progress or trunk not in docs or
+        stored_score(trunk) == 100):
+      return stored_score(trunk)
+    in_progress.add(trunk)
+    total, count = 0, 0
+    for element in contents[trunk]:
+      if element is None:
+        continue
+      if isinstance(element, models.DocLinkModel):
+        score = score_trunk(str(identity_map.ref_key(element, 'trunk_ref')))
+      elif isinstance(element, models.WidgetModel):
+        widget_state = widget_states[str(element.key())]
+        if widget_state:
+          score = widget_state.progress_score
+        else:
+          score = 0
+      else:
+        # Quizzes were scored at once above; other elements are scored once
+        # each, however many docs hold them.
+        element_key = str(element.key())
+        if element_key not in element_scores:
+          element_scores[element_key] = element.get_score(user)
+        score = element_scores[element_key]
+      if score is not None:
+        total += score
+        count += 1
+    in_progress.remove(trunk)
+    if total and count:
+      scores[trunk] = int(round(float(total)/count))
+    else:
+      scores[trunk] = 0
+    sums[trunk] = (total, count)
+    return scores[trunk]
+
+  score_trunk(course_trunk)
+  for trunk in docs:
+    score_trunk(trunk)
+
+  to_put = []
+  for trunk, visit_state in visit_states.iteritems():
+    if visit_state is None or trunk not in sums:
+      continue
+    total, count = sums[trunk]
+    if (visit_state.dirty_bit or visit_state.progress_score != scores[trunk]
+        or visit_state.score_total != total
+        or visit_state.score_count != count):
+      visit_state.progress_score = scores[trunk]
+      visit_state.score_total = total
+      visit_state.score_count = count
+      visit_state.dirty_bit = False
+      to_put.append(visit_state)
+  if to_put:
+    if course_doc.label == models.AllowedLabels.COURSE:
+      put_visit_states(to_put, user, course_trunks=[course_trunk])
+    else:
+      put_visit_states(to_put, user)
+
+  for trunk in docs:
+    scores.setdefault(trunk, stored_score(trunk))
+  return scores
+
+
+def put_visit_states(visit_states, user, course_trunks=None):
+  """Writes DocVisitState entities of a user behind.
+
+  All writes of DocVisitState entities not going through
+  DocVisitState.put() must use this function, which copies them into the
+  user's CourseProgress records of the courses on their visit path; see
+  update_progress_records().
+
+  Args:
+    visit_states: A DocVisitState or a list of them.
+    user: User owning the visit states.
+    course_trunks: Trunk keys of the courses the visit states belong to, if
+      the caller knows them; else found by get_visit_courses().
+  """
+  if not isinstance(visit_states, list):
+    visit_states = [visit_states]
+  write_behind.put(visit_states)
+  if user is None:
+    return
+  generation = models.CourseProgress.bump_generation(user)
+  if course_trunks is None:
+    course_trunks = get_visit_courses(visit_states, user)
+  update_progress_records(user, course_trunks, visit_states, generation)
+
+
+def get_visit_courses(visit_states, user):
+  """Returns the trunks of the courses visit states were reached through.
+
+  For each visit state, that is the trunk at the root of the user's
+  TraversalPath for its trunk or, if the user has none, the course found by
+  get_course_path(); and the visit state's own trunk, which may be a course.
+  Trunks that are not courses have no CourseProgress records and are simply
+  not found by update_progress_records().
+
+  Args:
+    visit_states: List of DocVisitState entities.
+    user: User owning them.
+  Returns:
+    A list of trunk keys, without duplicates.
+  """
+  trunk_keys = [identity_map.ref_key(visit_state, 'trunk_ref')
+                for visit_state in visit_states]
+  paths = models.TraversalPath.get_by_key_name(
+      [models.TraversalPath.key_name_for(user, trunk_key)
+       for trunk_key in trunk_keys])
+  courses = list(trunk_keys)
+  course_docs = []
+  for visit_state, path in zip(visit_states, paths):
+    if path and path.path:
+      courses.append(path.trunk_keys()[0])
+      continue
+    doc = identity_map.get_ref(visit_state, 'doc_ref')
+    course_path = doc and get_course_path(doc)
+    if course_path:
+      course_docs.append(course_path[0])
+  courses.extend([identity_map.ref_key(doc, 'trunk_ref')
+                  for doc in identity_map.get(course_docs) if doc])
+  seen = set()
+  unique = []
+  for course in courses:
+    if course and str(course) not in seen:
+      seen.add(str(course))
+      unique.append(course)
+  return unique
+
+
+def put_doc_score(doc, user, score, score_total=None, score_count=None):
   """Stores progress score for a doc.
 
   Updates the entry with new score if present, else makes a new entry.
@@ -653,20 +913,234 @@ def put_doc_score(doc, user, score):
     doc: Document fetching the score.
     user: User associated with the score.
     score: Current score.
+    score_total: If given, the sum of the element scores score was computed
+      from; see add_to_doc_score().
+    score_count: Number of elements summed in score_total.
   TODO(mukundjha): Determine if this needs to be run in a transaction.
   """
-  visit_state = models.DocVisitState.all().filter('user =', user).filter(
-    'trunk_ref =', doc.trunk_ref).get()
+  trunk_key = identity_map.ref_key(doc, 'trunk_ref')
+  # The filter must know of the trunk before its visit state exists.
+  models.VisitedTrunks.record(user, [trunk_key])
+  visit_state = models.DocVisitState.get_or_new(user, trunk_key)
+  visit_state.progress_score = score
+  visit_state.doc_ref = doc
+  visit_state.dirty_bit = False
+  if score_total is not None:
+    visit_state.score_total = score_total
+    visit_state.score_count = score_count
+  put_visit_states(visit_state, user)
+
+
+def get_progress_record(user, course_doc):
+  """Returns the CourseProgress of a user for a course.
+
+  Existing records are kept up to date by put_visit_states() for the courses
+  on the visit path, so they are returned as read unless the user's
+  progress generation shows visit states written otherwise. The entries of
+  such a record are then copied again from the user's DocVisitState
+  entities, with one get. A missing record is built from
+  get_course_progress() and the user's DocVisitState entities for the
+  trunks it reached. Either way the record is written behind.
+
+  Args:
+    user: User whose progress is returned.
+    course_doc: DocModel of the course.
+  Returns:
+    The CourseProgress entity, or None if there is no user.
+  """
+  if user is None:
+    return None
+  course_trunk = identity_map.ref_key(course_doc, 'trunk_ref')
+  generation = models.CourseProgress.get_generation(user)
+  record = models.CourseProgress.get_for(user, course_trunk)
+  if record:
+    if generation is None or record.generation != generation:
+      _refresh_progress_record(user, record, generation)
+    return record
+
+  scores = get_course_progress(user, course_doc)
+  trunks = scores.keys()
+  visit_states = models.DocVisitState.get_by_key_name(
+      [models.DocVisitState.key_name_for(user, trunk) for trunk in trunks])
+  record = models.CourseProgress.new_for(user, course_trunk,
+                                         generation=generation or 0)
+  for trunk, visit_state in zip(trunks, visit_states):
+    if visit_state:
+      record.set_entry(trunk, identity_map.ref_key(visit_state, 'doc_ref'),
+                       visit_state.progress_score,
+                       dirty_bit=visit_state.dirty_bit,
+                       last_visit=visit_state.last_visit)
+    else:
+      record.set_entry(trunk, '', scores[trunk])
+  write_behind.put(record)
+  return record
+
+
+def _refresh_progress_record(user, record, generation):
+  """Copies the user's visit states into a CourseProgress record.
+
+  Only the trunks already in the record that models.VisitedTrunks does not
+  rule out are read, with a single get.
+
+  Args:
+    user: User owning the record.
+    record: The CourseProgress to update.
+    generation: Progress generation of the user, read before the visit
+      states; None if unknown.
+  """
+  visited = models.VisitedTrunks.get_filter(user)
+  trunks = [trunk for trunk in record.trunks() if visited.contains(trunk)]
+  visit_states = models.DocVisitState.get_by_key_name(
+      [models.DocVisitState.key_name_for(user, trunk) for trunk in trunks])
+  for trunk, visit_state in zip(trunks, visit_states):
+    if visit_state:
+      record.set_entry(
+          trunk, identity_map.ref_key(visit_state, 'doc_ref') or '',
+          visit_state.progress_score, dirty_bit=visit_state.dirty_bit,
+          last_visit=visit_state.last_visit)
+  record.generation = generation or 0
+  write_behind.put(record)
+
+
+def update_progress_records(user, course_trunks, visit_states,
+                            generation=None):
+  """Copies visit state changes into the user's CourseProgress records.
+
+  Only the records of course_trunks are read, with a single get; courses
+  whose record was not built yet are skipped. A record that was up to date
+  before the write stays so, if no other write happened in between.
+
+  Args:
+    user: User whose progress changed.
+    course_trunks: Trunk keys of the courses the visit states belong to.
+    visit_states: DocVisitState entities just written.
+    generation: Progress generation of the user returned by
+      models.CourseProgress.bump_generation() for this write, if any.
+  """
+  if not course_trunks:
+    return
+  records = [record for record in models.CourseProgress.get_by_key_name(
+      [models.CourseProgress.key_name_for(user, course_trunk)
+       for course_trunk in course_trunks]) if record]
+  if not records:
+    return
+  for record in records:
+    for visit_state in visit_states:
+      record.set_entry(identity_map.ref_key(visit_state, 'trunk_ref'),
+                       identity_map.ref_key(visit_state, 'doc_ref') or '',
+                       visit_state.progress_score,
+                       dirty_bit=visit_state.dirty_bit,
+                       last_visit=visit_state.last_visit)
+    if generation is not None and record.generation == generation - 1:
+      record.generation = generation
+  write_behind.put(records)
+
+
+def add_to_doc_score(doc, user, old_score, new_score):
+  """Applies the change of one element's score to a doc and its parents.
+
+  Rather than recomputing scores from the contents, the DocVisitState of
+  each doc keeps the sum of its element scores (see get_accumulated_score()),
+  so a change of one element only adjusts that sum. The resulting change of
+  the doc's score is then pushed up the parents recorded in the user's
+  TraversalPath for the doc, stopping as soon as a score does not change.
+  This costs O(depth) rather than O(subtree).
+
+  Args:
+    doc: DocModel containing the element whose score changed.
+    user: User associated with the score.
+    old_score: Previous score of the element, None if it was not scored.
+    new_score: New score of the element.
+  Returns:
+    The new score of doc.
+  """
+  if old_score == new_score:
+    return doc.get_score(user)
+  return _apply_score_delta([doc] + _get_path_parents(doc, user), user,
+                            new_score - (old_score or 0),
+                            new_element=old_score is None)[0]
 
-  if visit_state:
-    visit_state.progress_score = score
-    visit_state.doc_ref = doc
-    visit_state.dirty_bit = False
-    visit_state.put()
-  else:
-    visit_state = insert_with_new_key(models.DocVisitState, user=user,
-                                      trunk_ref=doc.trunk_ref.key(),
-                                      doc_ref=doc.key(), progress_score=score)
+
+def propagate_doc_score(doc, user, old_score, new_score):
+  """Pushes a change of doc's own score up its parents.
+
+  For scores set directly on the doc, e.g. by marking it as read. See
+  add_to_doc_score().
+
+  Args:
+    doc: DocModel whose score changed.
+    user: User associated with the score.
+    old_score: Previous score of the doc.
+    new_score: New score of the doc, already stored.
+  """
+  _apply_score_delta(_get_path_parents(doc, user), user,
+                     new_score - old_score)
+
+
+def _get_path_parents(doc, user):
+  """Returns the parents of doc in the user's TraversalPath, nearest first."""
+  visit_stack = models.TraversalPath.get_for(
+      user, identity_map.ref_key(doc, 'trunk_ref'))
+  if not visit_stack:
+    return []
+  parents = [p for p in identity_map.get(visit_stack.path) if p]
+  parents.reverse()
+  return parents
+
+
+def _apply_score_delta(docs, user, delta, new_element=False):
+  """Adds delta to the element total of docs[0], then up the list.
+
+  Each doc's change of score becomes the delta of the next one. Docs whose
+  total is unknown or marked dirty are recomputed from their contents with
+  get_accumulated_score() instead.
+
+  The new scores are also copied into the user's CourseProgress for the
+  last doc, if it is a course that has one; see update_progress_records().
+
+  Args:
+    docs: List of DocModels, each one an element of the next.
+    user: User associated with the score.
+    delta: Change of the score of an element of docs[0].
+    new_element: Whether that element was not counted in the total before.
+  Returns:
+    The new scores of the docs that were updated, in order.
+  """
+  if not docs:
+    return []
+  course_trunks = [identity_map.ref_key(docs[-1], 'trunk_ref')]
+  visit_states = models.DocVisitState.get_by_key_name(
+      [models.DocVisitState.key_name_for(
+          user, identity_map.ref_key(doc, 'trunk_ref')) for doc in docs])
+  scores = []
+  to_put = []
+  for doc, visit_state in zip(docs, visit_states):
+    if not delta:
+      break
+    old_score = visit_state and visit_state.progress_score or 0
+    if (visit_state and visit_state.score_count and
+        not visit_state.dirty_bit):
+      visit_state.score_total += delta
+      if new_element:
+        visit_state.score_count += 1
+      score = int(round(float(visit_state.score_total) /
+                        visit_state.score_count))
+      score = max(0, min(100, score))
+      visit_state.progress_score = score
+      to_put.append(visit_state)
+    else:
+      # The recomputation reads the scores written so far.
+      if to_put:
+        put_visit_states(to_put, user, course_trunks=course_trunks)
+        to_put = []
+      doc_contents = get_doc_contents_simple(doc, user)
+      score = get_accumulated_score(doc, user, doc_contents)
+    scores.append(score)
+    delta = score - old_score
+    new_element = False
+  if to_put:
+    put_visit_states(to_put, user, course_trunks=course_trunks)
+  return scores
 
 
 def get_base_url(url):
@@ -706,14 +1180,14 @@ def get_doc_contents_simple(doc, user):
 
   try:
     # First try a bulk load.
-    content_list = db.get(doc.content)
+    content_list = identity_map.get(doc.content)
   except db.BadKeyError:
     # Unfortunately, any bad key results in the exception, so now need to
     # look up one by one, omitting any bad keys.
     content_list = []
     for content_id in doc.content:
       try:
-        content = db.get(content_id)
+        content = identity_map.get(content_id)
         content_list.append(content)
       except db.BadKeyError:
         pass
@@ -724,7 +1198,8 @@ def get_doc_contents_simple(doc, user):
 
 
 def get_doc_contents(doc, user, resolve_links=False, use_history=False,
-                     fetch_score=False, fetch_video_state=False):
+                     fetch_score=False, fetch_video_state=False,
+                     progress=None):
   """Return a list of objects referred by keys in content list of a doc.
 
   NOTE(mukundjha): doc is a DocModel object and not an id.
@@ -737,6 +1212,8 @@ def get_doc_contents(doc, user, resolve_links=False, use_history=False,
     fetch_score: If set true score is also appended to all objects.
     fetch_video_state: If set VideoModel object is appended with video's
       state (stored paused time).
+    progress: Optional CourseProgress of a course containing doc, used to
+      resolve links and their scores; see get_progress_record().
 
   Returns:
     An ordered list of objects referenced in content list of passed doc.
@@ -751,6 +1228,27 @@ def get_doc_contents(doc, user, resolve_links=False, use_history=False,
   # Get just the list of contents
   content_list = get_doc_contents_simple(doc, user)
 
+  # Fetch the paused time of all the videos at once.
+  video_states = {}
+  if fetch_video_state and not fetch_score:
+    videos = [el for el in content_list if isinstance(el, models.VideoModel)]
+    user = users.get_current_user()
+    if user and videos:
+      states = models.VideoState.get_by_key_name(
+          [models.VideoState.key_name_for(user, v) for v in videos])
+      video_states = dict(zip(videos, states))
+
+  # Resolve all the plain links in one batch rather than one by one.
+  link_heads = {}
+  if resolve_links and not use_history:
+    links = [el for el in content_list
+             if isinstance(el, models.DocLinkModel)]
+    link_trunks = [identity_map.ref_key(link, 'trunk_ref') for link in links]
+    for link, head in zip(links, models.get_trunk_heads(link_trunks)):
+      if not head:
+        raise models.InvalidDocumentError("Trunk has no head document!")
+      link_heads[link] = head
+
   # Now perform any additional resolution of titles, scores, etc.
   for element in content_list:
     if not isinstance(element, models.DocLinkModel):
@@ -759,22 +1257,26 @@ def get_doc_contents(doc, user, resolve_links=False, use_history=False,
 
       # If video object and fetch_video_status is true, status is fetched.
       elif fetch_video_state and isinstance(element, models.VideoModel):
-        video_state = models.VideoState.all().filter(
-            'video_ref =', element).filter(
-                'user =', users.get_current_user()).get()
+        video_state = video_states.get(element)
         if video_state:
           element.current_time = video_state.paused_time
     else:
       link = element
       if resolve_links and use_history:
-        link_doc = get_doc_for_user(link.trunk_ref.key(), user)
+        link_doc = get_doc_for_user(
+            identity_map.ref_key(link, 'trunk_ref'), user, progress=progress)
         link.default_title = link_doc.title
       elif resolve_links:
-        link_doc = fetch_doc(link.trunk_ref.key())
+        link_doc = link_heads[link]
         link.default_title = link_doc.title
 
       if fetch_score:
-        link.score = link_doc.get_score(user)
+        entry = progress and progress.get_entry(
+            identity_map.ref_key(link, 'trunk_ref'))
+        if entry and not entry[3]:
+          link.score = entry[1]
+        else:
+          link.score = link_doc.get_score(user)
 
   return content_list
 
@@ -790,27 +1292,24 @@ def put_widget_score(widget, user, score, user_data=None):
     score: Current score. If None, do not update it.
     user_data: Optional per-user data to be persisted on behalf of the
         widget.
+  Returns:
+    The previous score of the widget as seen by WidgetModel.get_score(),
+    i.e. 0 if it had no state and None if its score was never set.
   TODO(mukundjha): Determine if this needs to be run in a transaction.
   """
-  visit_state = models.WidgetProgressState.all().filter('user =', user).filter(
-    'widget_ref =', widget).get()
+  visit_state = models.WidgetProgressState.get_or_new(user, widget)
+  previous_score = 0
 
-  if visit_state:
+  if visit_state.is_saved():
+    previous_score = visit_state.progress_score
     if score is not None:
       visit_state.progress_score = score
-    if user_data:
-      visit_state.user_data = user_data
-    visit_state.put()
   else:
-    score = score or 0  # Make sure it is not None
-    if user_data:
-      visit_state = insert_with_new_key(
-          models.WidgetProgressState, user=user,
-          widget_ref=widget, progress_score=score, user_data=user_data)
-    else:
-      visit_state = insert_with_new_key(
-          models.WidgetProgressState, user=user,
-          widget_ref=widget, progress_score=score)
+    visit_state.progress_score = score or 0  # Make sure it is not None
+  if user_data:
+    visit_state.user_data = user_data
+  write_behind.put(visit_state)
+  return previous_score
 
 
 def get_path_till_course(doc, path=None, path_trunk_set=None):
@@ -821,64 +1320,98 @@ def get_path_till_course(doc, path=None, path_trunk_set=None):
   Currently just picking the most latest parent recursively up
   until a course is reached or there are no more parents to pick.
 
-  NOTE(mukundjha): This function is very heavy on datastore.
-  * Checking for first 1000 entries for an existing course
-  is slightly better than checking all entries.
+  Parents are read from models.TrunkParents, one get per level, rather
+  than from the DocLinkModel table. See get_course_path() for the shortest
+  path to a course.
 
   Args:
     doc: DocModel object in consideration.
-    path: starting path
+    path: starting path, as a list of doc keys from doc upwards.
+    path_trunk_set: Keys of the trunks already on the path.
 
   Returns:
     A list of parents doc_ids with root as a course.
   """
-  logging.info('****Path RCVD %r', path)
-  trunk_set = set()
   if path is None:
     path = []
+  trunk_key = identity_map.ref_key(doc, 'trunk_ref')
   if path_trunk_set is None:
-    path_trunk_set = set([doc.trunk_ref.key()])
-
-  parent_entry = models.DocLinkModel.all().filter(
-      'trunk_ref =', doc.trunk_ref).order(
-      '-created').fetch(1000)
-
-  # Flag is set if an alternate path is picked.
-  alternate_picked_flag = 0
-  alternate_parent = None
-
-  for parent in parent_entry:
-    if parent.from_trunk_ref.key() not in trunk_set:
-      trunk_set.add(parent.from_trunk_ref.key())
-      if parent.from_trunk_ref.key() not in path_trunk_set:
-        if not alternate_picked_flag:
-          alternate_parent = parent
-          alternate_picked_flag = 1
-
-        if parent.from_doc_ref.label == models.AllowedLabels.COURSE:
-          path_trunk_set.add(parent.from_trunk_ref.key())
-          path.append(parent.from_doc_ref)
-          path.reverse()
-          path_to_return = [el.key() for el in path]
-          return path_to_return
-
-
-  if alternate_parent:
-    parent = alternate_parent
-    if parent.from_trunk_ref.key() not in path_trunk_set:
-
-      path_trunk_set.add(parent.from_trunk_ref.key())
-      path.append(parent.from_doc_ref)
-      path_to_return = get_path_till_course(parent.from_doc_ref,
-                                            path, path_trunk_set)
-    else:
-      path.reverse()
-      path_to_return = [el.key() for el in path]
-  else:
-    path.reverse()
-    path_to_return = [el.key() for el in path]
+    path_trunk_set = set([trunk_key])
+
+  while True:
+    entry = models.TrunkParents.get_for_trunks([trunk_key])[0]
+    candidates = [parent for parent in entry.parents()
+                  if parent[0] not in path_trunk_set]
+    if not candidates:
+      break
+    courses = [parent for parent in candidates
+               if parent[2] == models.AllowedLabels.COURSE]
+    if courses:
+      path.append(courses[0][1])
+      break
+    # The latest parent is picked as an alternate path if none is a course.
+    trunk_key, doc_key, label = candidates[0]
+    path_trunk_set.add(trunk_key)
+    path.append(doc_key)
+
+  path.reverse()
+  return path
+
+
+def _find_course_path(trunk_key, entry):
+  """Searches the parent index breadth-first for the nearest course.
+
+  Args:
+    trunk_key: Key of the trunk to start from.
+    entry: TrunkParents entry of that trunk.
+  Returns:
+    The list of doc keys from the course down to the trunk's parent, or
+    None if no course is reachable.
+  """
+  seen = set([trunk_key])
+  level = [(entry, [])]
+  while level:
+    next_trunks = []
+    next_paths = []
+    for parent_entry, path in level:
+      for parent_trunk, parent_doc, label in parent_entry.parents():
+        if parent_trunk in seen:
+          continue
+        seen.add(parent_trunk)
+        if label == models.AllowedLabels.COURSE:
+          return [parent_doc] + path
+        next_trunks.append(parent_trunk)
+        next_paths.append([parent_doc] + path)
+    level = zip(models.TrunkParents.get_for_trunks(next_trunks), next_paths)
+  return None
+
+
+def get_course_path(doc):
+  """Returns the shortest path from a course down to doc.
+
+  The parent index is searched breadth-first, one batched get per level,
+  and the result is remembered in the TrunkParents entry of doc's trunk,
+  so later calls cost a single get. Without a course above doc, falls back
+  to get_path_till_course().
+
+  Args:
+    doc: DocModel object in consideration.
+  Returns:
+    A list of doc keys, from the course down to doc's parent.
+  """
+  trunk_key = identity_map.ref_key(doc, 'trunk_ref')
+  entry = models.TrunkParents.get_for_trunks([trunk_key])[0]
+  if entry.has_course_path:
+    return entry.course_path
 
-  return path_to_return
+  path = _find_course_path(trunk_key, entry)
+  if path is None:
+    # Not remembered, as a course may be linked above doc later.
+    return get_path_till_course(doc)
+  entry.course_path = path
+  entry.has_course_path = True
+  entry.put()
+  return path
 
 
 def get_or_create_session(widget, user):
@@ -895,12 +1428,12 @@ def get_or_create_session(widget, user):
   Returns:
     An instance of the WidgetProgressState model.
   """
-  visit_state = models.WidgetProgressState.all().filter('user =', user).filter(
-    'widget_ref =', widget).get()
+  visit_state = models.WidgetProgressState.get_for(user, widget)
 
   if not visit_state:
-    visit_state = insert_with_new_key(models.WidgetProgressState, user=user,
-                                      widget_ref=widget, progress_score=None)
+    visit_state = models.WidgetProgressState.new_for(user, widget,
+                                                     progress_score=None)
+    visit_state.put()
   return visit_state
 
 
@@ -920,20 +1453,21 @@ def set_dirty_bits_for_doc(doc, user):
     doc: Document for which score has just been updated.
     user: Associated user.
   """
-  doc_visit_stack =  models.TraversalPath.all().filter(
-      'current_trunk =', doc.trunk_ref).get()
+  doc_visit_stack = models.TraversalPath.get_for(
+      user, identity_map.ref_key(doc, 'trunk_ref'))
 
   if not doc_visit_stack:
     return
 
-  for el in doc_visit_stack.path:
-    parent = db.get(el)
-    visit_entry = models.DocVisitState.all().filter(
-        'trunk_ref =', parent.trunk_ref).filter(
-        'user =', user).get()
-    if visit_entry:
-      visit_entry.dirty_bit = True
-      visit_entry.put()
+  visit_entries = models.DocVisitState.get_by_key_name(
+      [models.DocVisitState.key_name_for(user, trunk_key)
+       for trunk_key in doc_visit_stack.trunk_keys() if trunk_key])
+  visit_entries = [entry for entry in visit_entries if entry]
+  for visit_entry in visit_entries:
+    visit_entry.dirty_bit = True
+  if visit_entries:
+    put_visit_states(visit_entries, user,
+                     course_trunks=doc_visit_stack.trunk_keys()[:1])
 
 
 def update_visit_stack(doc, parent, user):
@@ -955,67 +1489,68 @@ def update_visit_stack(doc, parent, user):
   Returns:
     Updated visit stack entry object.
   """
-  doc_visit_stack =  models.TraversalPath.all().filter(
-      'current_trunk =', doc.trunk_ref).filter(
-      'user =', user).get()
+  doc_trunk_key = identity_map.ref_key(doc, 'trunk_ref')
+  doc_visit_stack = models.TraversalPath.get_for(user, doc_trunk_key)
 
   if parent:
+    parent_trunk_key = identity_map.ref_key(parent, 'trunk_ref')
     if parent.label == models.AllowedLabels.COURSE:
       path = [parent.key()]
+      path_trunks = [parent_trunk_key]
     else:
-      parent_visit_stack = models.TraversalPath.all().filter(
-          'current_trunk =', parent.trunk_ref).filter(
-          'user =', user).get()
+      parent_visit_stack = models.TraversalPath.get_for(user,
+                                                        parent_trunk_key)
       if not parent_visit_stack:
-        path_for_parent = get_path_till_course(parent)
+        path_for_parent = get_course_path(parent)
 
-        parent_visit_stack = insert_with_new_key(
-            models.TraversalPath, current_trunk=parent.trunk_ref,
-            current_doc=parent, path=path_for_parent, user=user)
+        parent_visit_stack = models.TraversalPath.new_for(
+            user, parent_trunk_key, current_doc=parent, path=path_for_parent)
+        parent_visit_stack.put()
 
       path = []
+      path_trunks = []
       cycle_detected = 0
       # Checking for loop
-      for el in parent_visit_stack.path:
-        element = db.get(el)
-        if element.trunk_ref.key() == doc.trunk_ref.key():
+      for el, element_trunk_key in zip(parent_visit_stack.path,
+                                       parent_visit_stack.trunk_keys()):
+        if element_trunk_key == doc_trunk_key:
           cycle_detected = 1
           break
-        elif element.trunk_ref.key() == parent.trunk_ref.key():
+        elif element_trunk_key == parent_trunk_key:
           path.append(el)
+          path_trunks.append(element_trunk_key)
           cycle_detected = 1
           break
         else:
           path.append(el)
+          path_trunks.append(element_trunk_key)
 
       if not cycle_detected:
         path.append(parent.key())
+        path_trunks.append(parent_trunk_key)
 
-    if doc_visit_stack:
-      doc_visit_stack.path = path
-      doc_visit_stack.put()
-    else:
-      doc_visit_stack = insert_with_new_key(
-        models.TraversalPath, current_doc=doc,
-        current_trunk=doc.trunk_ref, path=path, user=user)
+    if not doc_visit_stack:
+      doc_visit_stack = models.TraversalPath.new_for(
+          user, doc_trunk_key, current_doc=doc)
+    doc_visit_stack.set_path(path, path_trunks)
+    doc_visit_stack.put()
 
   # If parent is not present
   elif not doc_visit_stack:
     # Gets set of parents.
-    path = get_path_till_course(doc)
-    doc_visit_stack = insert_with_new_key(
-        models.TraversalPath, current_trunk=doc.trunk_ref,
-        current_doc=doc, path=path, user=user)
+    path = get_course_path(doc)
+    doc_visit_stack = models.TraversalPath.new_for(
+        user, doc_trunk_key, current_doc=doc, path=path)
+    doc_visit_stack.put()
   return doc_visit_stack
 
 
 def update_recent_course_entry(recent_doc, course, user):
   """Updates the entry for recent course visited/accesed.
 
-  Note(mukundjha): instead of using course.get_score() we should
-  use the get_accumulated_score() with recurse=True, but it would
-  be too costly to do it on every update. Therefore its better to
-  push the score-change/delta up the tree on every update.
+  The course score is kept current by add_to_doc_score(), which pushes
+  every score change up the visit path, so course.get_score() is used
+  unless the entry is marked dirty.
 
   Args:
     recent_doc: Latest doc accessed for the course.
@@ -1026,11 +1561,10 @@ def update_recent_course_entry(recent_doc, course, user):
   if course.label != models.AllowedLabels.COURSE:
     return None
 
-  course_entry = models.RecentCourseState.all().filter('user =', user).filter(
-      'course_trunk_ref =', course.trunk_ref).get()
-
-  visit_state = models.DocVisitState.all().filter('user =', user).filter(
-        'trunk_ref =', course.trunk_ref).get()
+  course_trunk_key = identity_map.ref_key(course, 'trunk_ref')
+  course_entry, visit_state = write_behind.get([
+      models.RecentCourseState.key_for(user, course_trunk_key),
+      models.DocVisitState.key_for(user, course_trunk_key)])
 
   if visit_state and visit_state.dirty_bit:
     doc_contents = get_doc_contents_simple(course, user)
@@ -1039,12 +1573,10 @@ def update_recent_course_entry(recent_doc, course, user):
     score = course.get_score(user)
 
   if not course_entry:
-    course_entry = insert_with_new_key(models.RecentCourseState,
-                                       course_trunk_ref=course.trunk_ref,
-                                       course_doc_ref=course,
-                                       last_visited_doc_ref=recent_doc,
-                                       course_score=score,
-                                       user=user)
+    course_entry = models.RecentCourseState.new_for(
+        user, course_trunk_key, course_doc_ref=course,
+        last_visited_doc_ref=recent_doc, course_score=score)
+    course_entry.put()
   else:
     course_entry.last_visited_doc_ref = recent_doc
     course_entry.course_doc_ref=course
@@ -1064,16 +1596,19 @@ def get_recent_in_progress_courses(user):
   Returns:
     List of recent course entry.
   """
-  recent_list = models.RecentCourseState.all().filter('user =', user).order(
-      '-time_stamp')
+  recent_list = list(models.RecentCourseState.all().filter(
+      'user =', user).order('-time_stamp'))
+  visit_states = models.DocVisitState.get_by_key_name(
+      [models.DocVisitState.key_name_for(
+          user, identity_map.ref_key(entry, 'course_trunk_ref'))
+       for entry in recent_list])
   in_progress = []
   num_to_pick = 5
-  for entry in recent_list:
-    visit_state = models.DocVisitState.all().filter('user =', user).filter(
-        'trunk_ref =', entry.course_trunk_ref).get()
+  for entry, visit_state in zip(recent_list, visit_states):
+    course_trunk_key = identity_map.ref_key(entry, 'course_trunk_ref')
 
     if visit_state and visit_state.dirty_bit:
-      course = fetch_doc(entry.course_trunk_ref.key())
+      course = fetch_doc(course_trunk_key)
       doc_contents = get_doc_contents_simple(course, user)
       score =  get_accumulated_score(course, user, doc_contents)
       entry.course_score = score
@@ -1085,10 +1620,100 @@ def get_recent_in_progress_courses(user):
       num_to_pick -= 1
       in_progress.append(entry)
 
+  # The homepage shows the title and keys of each course.
+  identity_map.prefetch_refs(in_progress, 'course_trunk_ref', 'course_doc_ref')
   return in_progress
 
 
-def expand_path(path, user, use_history, absolute):
+def get_docs_for_user(trunk_ids, user):
+  """Batch version of get_doc_for_user().
+
+  Resolves all the trunks with one get of the visit states (skipping the
+  trunks models.VisitedTrunks rules out), one get of the visited docs and
+  one get_trunk_heads() call for the rest.
+
+  Args:
+    trunk_ids: List of trunk keys or key strings.
+    user: User whose history is to be used, or None.
+  Returns:
+    The list of DocModels, in the order of trunk_ids; None for trunks
+    without a head.
+  """
+  trunk_keys = [db.Key(str(trunk_id)) for trunk_id in trunk_ids]
+  visited = [trunk_key for trunk_key in trunk_keys
+             if models.VisitedTrunks.may_have_visited(user, trunk_key)]
+  visit_states = models.DocVisitState.get_by_key_name(
+      [models.DocVisitState.key_name_for(user, trunk_key)
+       for trunk_key in visited])
+  doc_keys = {}
+  for trunk_key, visit_state in zip(visited, visit_states):
+    doc_key = visit_state and identity_map.ref_key(visit_state, 'doc_ref')
+    if doc_key:
+      doc_keys[trunk_key] = doc_key
+  visited_docs = dict(zip(doc_keys.keys(),
+                          identity_map.get(doc_keys.values())))
+
+  unvisited = [trunk_key for trunk_key in trunk_keys
+               if not visited_docs.get(trunk_key)]
+  heads = dict(zip(unvisited, models.get_trunk_heads(unvisited)))
+  return [visited_docs.get(trunk_key) or heads[trunk_key]
+          for trunk_key in trunk_keys]
+
+
+def expand_paths(visit_stacks, user, use_history, absolute=False):
+  """Expands several traversal paths at once.
+
+  Batch version of expand_path(): the docs of all the paths are resolved
+  together, with the same few calls as a single path. Unlike expand_path(),
+  a doc that no longer exists or a trunk without a head does not raise; the
+  path holding it is cut short before it.
+
+  Args:
+    visit_stacks: List of TraversalPath entities.
+    user: User associated with request.
+    use_history: If set then user's history is used to expand all
+      the links.
+    absolute: If set the docs in the paths are fetched as they are.
+  Returns:
+    A list holding the list of DocModels of each path.
+  """
+  if absolute:
+    docs = identity_map.get(
+        [key for visit_stack in visit_stacks for key in visit_stack.path])
+  else:
+    # Paths stored without their trunks need their docs, all in one get.
+    identity_map.get(
+        [key for visit_stack in visit_stacks
+         if len(visit_stack.path_trunks) != len(visit_stack.path)
+         for key in visit_stack.path])
+    trunk_keys = [trunk_key for visit_stack in visit_stacks
+                  for trunk_key in visit_stack.trunk_keys()]
+    found = [trunk_key for trunk_key in trunk_keys if trunk_key is not None]
+    if use_history:
+      found = get_docs_for_user(found, user)
+    else:
+      found = models.get_trunk_heads(found)
+    found.reverse()
+    docs = []
+    for trunk_key in trunk_keys:
+      if trunk_key is None:
+        docs.append(None)
+      else:
+        docs.append(found.pop())
+  # Templates link to each element through its trunk.
+  identity_map.prefetch_refs(docs, 'trunk_ref')
+
+  paths = []
+  for visit_stack in visit_stacks:
+    path = docs[:len(visit_stack.path)]
+    docs = docs[len(visit_stack.path):]
+    if None in path:
+      path = path[:path.index(None)]
+    paths.append(path)
+  return paths
+
+
+def expand_path(path, user, use_history, absolute, trunks=None):
   """Expands the path into objects based on the parameters.
 
   Absolute is given preference over others.
@@ -1100,19 +1725,35 @@ def expand_path(path, user, use_history, absolute):
     user: User associated with request.
     use_history: If set then user's history is used to expand all
     the links.
+    trunks: Optional trunk key of each doc, see TraversalPath.trunk_keys().
+      Saves fetching the docs unless absolute is set.
 
   Returns:
     Returns list of DocModel objects corresponding to the doc_ids in the path
     passed.
+  Raises:
+    InvalidDocumentError: If a doc on the path no longer exists, or its
+      trunk has no head document.
   """
-  path = db.get(path)  # Returns a list
+  if not absolute and trunks is None:
+    trunks = [el and identity_map.ref_key(el, 'trunk_ref')
+              for el in identity_map.get(path)]
   if absolute:
-    return path
-  elif use_history:
-    path = [ get_doc_for_user(el.trunk_ref.key(), user) for el in path ]
+    path = identity_map.get(path)  # Returns a list
+    if None in path:
+      raise models.InvalidDocumentError("Path refers to a missing document!")
+  elif None in trunks:
+    raise models.InvalidDocumentError("Path refers to a missing document!")
   else:
-    # Fetch latest
-    path = [ fetch_doc(el.trunk_ref.key()) for el in path ]
+    if use_history:
+      path = get_docs_for_user(trunks, user)
+    else:
+      # Fetch latest
+      path = models.get_trunk_heads(trunks)
+    if None in path:
+      raise models.InvalidDocumentError("Trunk has no head document!")
+  # Templates link to each element through its trunk.
+  identity_map.prefetch_refs(path, 'trunk_ref')
   return path
 
 
@@ -1154,8 +1795,8 @@ def get_doc_annotation(doc, user, doc_contents=None):
 def _get_doc_content_annotation(trunk_id, doc_id, content_id, user):
   """Retrieves user-annotation for a given doc content.
 
-  This is an internal work routine that uses the memcache to cache the key name
-  of the annotation object associated with the specified content.
+  This is an internal work routine. The annotation is keyed by the user and
+  the trunk, doc and content keys, so an existing one is read with a get.
 
   Args:
     trunk_id: Trunk ID of the doc that contains the annotation.
@@ -1169,11 +1810,13 @@ def _get_doc_content_annotation(trunk_id, doc_id, content_id, user):
   """
   if not user:
     return None
-  cache_key = '|'.join([trunk_id, doc_id, content_id, str(user)])
-  key_name = memcache.get(cache_key, namespace='anno')
-
-  if key_name:
-    return models.AnnotationState.get_by_key_name(key_name)
+  try:
+    anno = models.AnnotationState.get_for(user, trunk_id, doc_id, content_id)
+  except db.BadKeyError, e:
+    logging.error('Bad key for annotation: %r' % e)
+    return None
+  if anno:
+    return anno
 
   try:
     doc = fetch_doc(trunk_id, doc_id=doc_id)
@@ -1183,28 +1826,16 @@ def _get_doc_content_annotation(trunk_id, doc_id, content_id, user):
 
   content = None
   try:
-    content = db.get(content_id)
+    content = identity_map.get(content_id)
   except db.BadKeyError:
     pass
   if not content:
     logging.error('Cannot locate content for annotation: %r' % content_id)
     return None
 
-  query = (models.AnnotationState.all()
-           .filter('user =', user)
-           .filter('trunk_ref =', doc.trunk_ref)
-           .filter('doc_ref =', doc)
-           .filter('object_ref =', content))
-  if query.count() == 0:
-    anno = models.AnnotationState(user=user,
-                                  doc_ref=doc,
-                                  trunk_ref=doc.trunk_ref,
-                                  object_ref=content)
-    anno.annotation_data = ''
-    anno.put()
-  else:
-    anno = query.get()
-  memcache.set(cache_key, anno.key().name(), namespace='anno')
+  anno = models.AnnotationState.new_for(user, trunk_id, doc, content)
+  anno.annotation_data = ''
+  anno.put()
   return anno
 
 
@@ -1229,8 +1860,6 @@ def get_annotation_data(trunk_id, doc_id, content_id, user):
 def update_doc_content_annotation(trunk_id, doc_id, content_id, user, data):
   """Updates user-annotation for a given doc content.
 
-  Uses the memcache.
-
   Args:
     trunk_id: Trunk ID of the doc that contains the annotation.
     doc_id: Doc ID of the doc that contains the annotation.
@@ -1258,13 +1887,10 @@ def get_notepad(key, user):
     key: key to a NotePadModel object
     user: the user the NotePadState belongs to
   """
-  ob = db.get(key)
-  notepad = (models.NotePadState.all()
-             .filter('user =', user)
-             .filter('object_ref =', ob))
-  if notepad.count() == 0:
+  notepad = models.NotePadState.get_for(user, key)
+  if not notepad:
     return ""
-  return "\n\n".join([x.notepad_data for x in notepad])
+  return notepad.notepad_data or ""
 
 
 def update_notepad(key, user, text):
@@ -1275,16 +1901,7 @@ def update_notepad(key, user, text):
     user: the user the NotePadState belongs to
     text: the updated contents
   """
-
-  ob = db.get(key)
-  notepad = (models.NotePadState.all()
-             .filter('user =', user)
-             .filter('object_ref =', ob))
-  if notepad.count() == 0:
-    notepad = models.NotePadState(user=user, object_ref=ob)
-  else:
-    notepad = notepad[0]
-
+  notepad = models.NotePadState.get_or_new(user, key)
   notepad.notepad_data = text
   notepad.put()
 
@@ -1303,7 +1920,7 @@ def view_doc_param(doc, visit, current, came_from):
   if not doc:
     return None
 
-  param = [ ('trunk_id', str(doc.trunk_ref.key())),
+  param = [ ('trunk_id', str(identity_map.ref_key(doc, 'trunk_ref'))),
             ('doc_id', str(doc.key())) ]
 
   if visit:
@@ -1311,23 +1928,36 @@ def view_doc_param(doc, visit, current, came_from):
 
     while (0 < depth) and (visit.path[depth] != doc.key()):
       depth -= 1
-    if 0 < depth:
-      parent = db.get(visit.path[depth - 1])
-    else:
-      parent = None
-
-    if parent:
-      param.extend([ ('parent_trunk', str(parent.trunk_ref.key())),
-                     ('parent_id', str(parent.key())) ])
+    if 0 < depth and visit.trunk_keys()[depth - 1]:
+      param.extend([ ('parent_trunk', str(visit.trunk_keys()[depth - 1])),
+                     ('parent_id', str(visit.path[depth - 1])) ])
   if came_from:
     param.extend([ ('came_from', str(came_from.key())) ])
 
   return param
 
 
+def _sequence_param(entry):
+  """Returns the URL parameters to view an entry of a course sequence."""
+  trunk_id, doc_id, parent_trunk_id, parent_id, came_from_id = entry
+  param = [ ('trunk_id', trunk_id), ('doc_id', doc_id) ]
+  if parent_id:
+    param.extend([ ('parent_trunk', parent_trunk_id),
+                   ('parent_id', parent_id) ])
+  if came_from_id:
+    param.extend([ ('came_from', came_from_id) ])
+  return param
+
+
 def getPrevNextLinks(doc, visit, came_from):
   """Compute where to go next
 
+  The position of doc under its parent in the visit path is looked up in the
+  reading order of the root of the path, see models.get_course_sequence(),
+  which is computed once per course and cached. Documents not found there
+  under that parent fall back to walking the contents of their ancestors,
+  which only yields the next page.
+
   Args:
     doc: this document
     visit: traversal path from top to this document
@@ -1338,9 +1968,38 @@ def getPrevNextLinks(doc, visit, came_from):
     prev_param: URL parameters to feed to view to go to natural "previous" page
     next_param: URL parameters to feed to view to go to natural "next" page
   """
-  # TODO: the "prev" half is not yet computed nor used.
-  prev_param = None
+  root = parent_trunk = None
+  if visit and visit.path:
+    root = identity_map.get(visit.path[0])
+    parent_trunk = visit.trunk_keys()[-1]
+    if parent_trunk is None:
+      return (None, _walk_next(doc, visit, came_from))
+    parent_trunk = str(parent_trunk)
+  entries, positions = models.get_course_sequence(root or doc)
+
+  came_from_trunk = None
+  if came_from:
+    came_from_trunk = str(identity_map.ref_key(came_from, 'trunk_ref'))
+  position = positions.get(
+      (str(identity_map.ref_key(doc, 'trunk_ref')), parent_trunk,
+       came_from_trunk))
+  if position is None:
+    return (None, _walk_next(doc, visit, came_from))
+
+  prev_param = next_param = None
+  if position > 0:
+    prev_param = _sequence_param(entries[position - 1])
+  if position + 1 < len(entries):
+    next_param = _sequence_param(entries[position + 1])
+  return (prev_param, next_param)
+
+
+def _walk_next(doc, visit, came_from):
+  """Computes where to go next by walking the contents of doc's ancestors.
 
+  Returns:
+    URL parameters to feed to view to go to natural "next" page.
+  """
   # If we came back from down below, visit the next child (no "immediate
   # adjacency" required --- we have been showing this document already).
   # If we came from top-down navigation, we do not have came_from; visit
@@ -1357,7 +2016,7 @@ def getPrevNextLinks(doc, visit, came_from):
     depth, child = len(visit.path), doc
     while (0 < depth):
       depth -= 1
-      parent = db.get(visit.path[depth])
+      parent = identity_map.get(visit.path[depth])
       # After visiting child inside parent, "next_child_or_self" is either
       # the target of a link to the child that immediately follows the
       # link to this child, or the parent itself if the link to this child
@@ -1380,9 +2039,7 @@ def getPrevNextLinks(doc, visit, came_from):
       else:
         child = parent
 
-  next_param = view_doc_param(next, visit, here, next_came_from)
-
-  return (prev_param, next_param)
+  return view_doc_param(next, visit, here, next_came_from)
 
 
 def auto_subscribe(user, trunk):
@@ -1393,3 +2050,237 @@ def auto_subscribe(user, trunk):
     trunk: the trunk object that represents the page
   """
   return notify.setSubscription(user, trunk, 1)
+
+
+# User state models that are keyed by UserStateModel.key_name_for().
+KEYED_USER_STATE_MODELS = [
+    models.DocVisitState,
+    models.WidgetProgressState,
+    models.VideoState,
+    models.NotePadState,
+    models.AnnotationState,
+    models.TraversalPath,
+    models.RecentCourseState,
+    ]
+
+
+def _sitemap_urls(courses, base_url):
+  """Yields the (loc, lastmod) pairs of the pages of courses."""
+  for course in courses:
+    yield ('%s/view?trunk_id=%s&doc_id=%s' % (
+        base_url, course['trunk_id'], course['doc_id']), course['modified'])
+    yield ('%s/sitemap?trunk_id=%s' % (base_url, course['trunk_id']),
+           course['modified'])
+
+
+def get_sitemap(part=None):
+  """Returns the XML sitemap of the courses.
+
+  Each sitemap file lists the courses of one page of the catalog (see
+  models.get_course_catalog_page()), so a request renders a single file from
+  a single page. Files are cached along with the catalog, and so is the
+  index, which takes a walk over all the pages to count them. URLs are
+  absolute, on constants.SITE_URL.
+
+  Args:
+    part: Number (from 1) of the sitemap file to return. If None, returns
+        the only file if there is a single one, or else a sitemap index
+        listing the files as SITE_URL/sitemap.xml?part=<number>.
+  Returns:
+    The UTF-8 encoded XML, or None if there is no such part.
+  """
+  base_url = constants.SITE_URL
+  if part is None:
+    rendered = cache.get(models.CATALOG_NAMESPACE, 'sitemap:index')
+    if rendered is None:
+      page = models.get_course_catalog_page(1)
+      count = 1
+      while not page[2]:
+        count += 1
+        page = models.get_course_catalog_page(count, page)
+      if not page[0] and count > 1:
+        count -= 1
+      if count > 1:
+        rendered = sitemap.generate_index([
+            '%s/sitemap.xml?part=%d' % (base_url, number)
+            for number in range(1, count + 1)])
+      else:
+        rendered = get_sitemap(1)
+      cache.set_value(models.CATALOG_NAMESPACE, 'sitemap:index', rendered)
+    return rendered
+  if part < 1:
+    return None
+
+  cache_key = 'sitemap:%d' % part
+  rendered = cache.get(models.CATALOG_NAMESPACE, cache_key)
+  if rendered is None:
+    courses = models.get_course_catalog_page(part)[0]
+    if not courses and part > 1:
+      return None
+    # A catalog page is small enough for a single file.
+    rendered = sitemap.generate(_sitemap_urls(courses, base_url)).next()
+    cache.set_value(models.CATALOG_NAMESPACE, cache_key, rendered)
+  return rendered
+
+
+def rekey_user_states(model_class, start_key=None, batch_size=100):
+  """Moves one batch of user state entities to their deterministic keys.
+
+  Entities written before the models were keyed by key_name_for() carry
+  random key names and are invisible to get_for(). This copies each of
+  them to its deterministic key and deletes the original. When several old
+  entities map to the same key, the most recently modified one wins.
+
+  The stored entities are copied as they are: saving them through the model
+  would set their auto_now properties to the time of the move, which would
+  lose when they were last modified.
+
+  Args:
+    model_class: One of KEYED_USER_STATE_MODELS.
+    start_key: Key to resume after, as returned by the previous call.
+    batch_size: Number of entities to examine.
+
+  Returns:
+    (next_start_key, moved), where next_start_key is None once the kind has
+    been fully processed and moved is the number of entities rekeyed.
+  """
+  query = model_class.all().order('__key__')
+  if start_key:
+    query.filter('__key__ >', db.Key(str(start_key)))
+  batch = query.fetch(batch_size)
+  if not batch:
+    return None, 0
+
+  timestamps = [name for name, prop in model_class.properties().iteritems()
+                if isinstance(prop, db.DateTimeProperty) and prop.auto_now]
+
+  def last_modified(entity):
+    if timestamps and getattr(entity, timestamps[0]):
+      return getattr(entity, timestamps[0])
+    return datetime.datetime.min
+
+  to_move = {}
+  to_delete = []
+  for entity in batch:
+    refs = [getattr(model_class, name).get_value_for_datastore(entity)
+            for name in model_class.KEY_REFS]
+    if None in refs:
+      logging.warning('Cannot rekey %s, it lacks one of %r',
+                      entity.key(), model_class.KEY_REFS)
+      continue
+    key_name = model_class.key_name_for(entity.user, *refs)
+    if entity.key().name() == key_name:
+      continue
+    to_delete.append(entity)
+    other = to_move.get(key_name)
+    if other is None or last_modified(entity) > last_modified(other):
+      to_move[key_name] = entity
+
+  if to_move:
+    key_names = to_move.keys()
+    existing = model_class.get_by_key_name(key_names)
+    key_names = [key_name for key_name, current in zip(key_names, existing)
+                 if not current or
+                 last_modified(current) < last_modified(to_move[key_name])]
+    originals = datastore.Get([to_move[key_name].key()
+                               for key_name in key_names])
+    copies = []
+    for key_name, original in zip(key_names, originals):
+      copy = datastore.Entity(
+          model_class.kind(), name=key_name,
+          unindexed_properties=original.unindexed_properties())
+      copy.update(original)
+      copies.append(copy)
+    datastore.Put(copies)
+    if model_class.WRITE_BEHIND:
+      write_behind.discard([copy.key() for copy in copies])
+  db.delete(to_delete)
+  return batch[-1].key(), len(to_delete)
+
+
+def backfill_path_trunks(start_key=None, batch_size=100):
+  """Stores the trunk keys of one batch of TraversalPath entities.
+
+  Paths written before TraversalPath.path_trunks existed resolve their
+  trunks with a get on every read until they are saved again. This saves
+  them, fetching the docs of the whole batch with a single get.
+
+  Args:
+    start_key: Key to resume after, as returned by the previous call.
+    batch_size: Number of entities to examine.
+
+  Returns:
+    (next_start_key, updated), where next_start_key is None once all the
+    paths have been processed and updated is the number of paths saved.
+  """
+  query = models.TraversalPath.all().order('__key__')
+  if start_key:
+    query.filter('__key__ >', db.Key(str(start_key)))
+  batch = query.fetch(batch_size)
+  if not batch:
+    return None, 0
+
+  to_put = [visit_stack for visit_stack in batch
+            if len(visit_stack.path_trunks) != len(visit_stack.path)]
+  identity_map.get([key for visit_stack in to_put for key in visit_stack.path])
+  for visit_stack in to_put:
+    visit_stack.trunk_keys()
+  to_put = [visit_stack for visit_stack in to_put
+            if len(visit_stack.path_trunks) == len(visit_stack.path)]
+  db.put(to_put)
+  return batch[-1].key(), len(to_put)
+
+
+# URL of the task running backfill_trunk_metadata() over all the trunks, one
+# batch per request; queued by views.update_trunk_title().
+BACKFILL_TRUNK_METADATA_URL = '/task/backfillTrunkMetadata'
+
+# Name of the first task of the backfill, so that it is queued only once.
+BACKFILL_TRUNK_METADATA_TASK = 'backfill-trunk-metadata-v1'
+
+
+def backfill_trunk_metadata(start_key=None, batch_size=100):
+  """Stores the head metadata of one batch of trunks.
+
+  Trunks saved before TrunkTitleIndex and the listing fields of TrunkModel
+  existed are missing from the link picker, /list and the sitemaps until
+  they are saved again. This copies the metadata of their heads onto them, dates
+  them by their first revision, saves them and writes their TrunkTitleIndex
+  entries. Every trunk is dated, since those saved between
+  the deployment of TrunkModel.created and the backfill got the time of
+  that save. Trunks whose listed metadata is already right are not saved.
+
+  Args:
+    start_key: Key to resume after, as returned by the previous call.
+    batch_size: Number of trunks to examine.
+
+  Returns:
+    (next_start_key, updated), where next_start_key is None once all the
+    trunks have been processed and updated is the number of trunks saved.
+  """
+  query = models.TrunkModel.all().order('__key__')
+  if start_key:
+    query.filter('__key__ >', db.Key(str(start_key)))
+  batch = query.fetch(batch_size)
+  if not batch:
+    return None, 0
+
+  updated = 0
+  for trunk, head in zip(batch, models.get_trunk_heads(batch)):
+    if not head:
+      continue
+    first = models.TrunkRevisionModel.all().ancestor(trunk).order(
+        'created').get()
+    if first:
+      trunk.created = first.created
+    elif not trunk.has_head:
+      # created was never stored, and reads as the time the trunk was loaded.
+      trunk.created = head.created
+    trunk.has_head = True
+    trunk.copyHeadInfo(head)
+    if not trunk.listing_changed():
+      continue
+    trunk.put()
+    models.TrunkTitleIndex.update(trunk, force=True)
+    updated += 1
+  return batch[-1].key(), updated
@@ -20,11 +20,27 @@
 
 """Custom middleware.  Some of this may be generally useful."""
 
+import logging
+
 from google.appengine.api import users
 
+import identity_map
 import models
 
 
+class ClearIdentityMapMiddleware(object):
+  """Start each request with an empty identity map; log its hit rate."""
+
+  def process_request(self, request):
+    identity_map.clear()
+
+  def process_response(self, request, response):
+    stats = identity_map.stats()
+    logging.debug('identity map: %d hits, %d misses (hit rate %.0f%%)',
+                  stats['hits'], stats['misses'], stats['hit_rate'] * 100)
+    return response
+
+
 class AddUserToRequestMiddleware(object):
   """Add a user object and a user_is_admin flag to each request."""
 
@@ -32,7 +48,10 @@ class AddUserToRequestMiddleware(object):
     request.user = users.get_current_user()
     request.user_is_admin = users.is_current_user_admin()
 
-    # Update the cached value of the current user's Account
+    # Update the cached value of the current user's Account. It is reset
+    # first so that the lookup goes to memcache rather than returning the
+    # Account left there by the previous request.
+    models.Account.current_user_account = None
     account = None
     if request.user is not None:
       account = models.Account.get_account_for_user(request.user)
@@ -22,7 +22,10 @@
 """App Engine data model (schema) definition for Lantern."""
 
 # Python imports
+import array
 import base64
+import calendar
+import copy
 import datetime
 import difflib
 import itertools
@@ -34,26 +37,100 @@ import random
 import re
 import sha
 import string
+import struct
+import threading
 import time
 
 # AppEngine imports
 from google.appengine.ext import db
 from google.appengine.api import memcache
 from google.appengine.api import users
+from google.appengine.api.labs import taskqueue
+from google.appengine.datastore import entity_pb
 
 # Local imports
+from common import cache
+from common import key_allocation
 import constants
 import htmlfolder
+import identity_map
+import write_behind
 
 ### GQL query cache ###
 
 
-_query_cache = {}
+# Parsed query templates, by query string. They cannot be pickled, so they
+# are kept in the local tier only, pinned: there are few of them.
+cache.register('gql', remote=False, local_max_age=None, pinned=True)
+
+# Maps query string to [executions, total seconds, slowest seconds].
+_query_stats = {}
+_query_stats_lock = threading.Lock()
+
+
+def _record_query(query_string, seconds):
+  """Adds one execution of query_string, taking seconds, to the stats."""
+  _query_stats_lock.acquire()
+  try:
+    stats = _query_stats.setdefault(query_string, [0, 0.0, 0.0])
+    stats[0] += 1
+    stats[1] += seconds
+    stats[2] = max(stats[2], seconds)
+  finally:
+    _query_stats_lock.release()
+
+
+def query_stats():
+  """Returns the execution stats of the queries made through gql().
+
+  Returns:
+    A dict mapping each query string to a dict with 'count', 'total' and
+    'max' (the latter two in seconds).
+  """
+  _query_stats_lock.acquire()
+  try:
+    return dict((query_string, {'count': count, 'total': total, 'max': slowest})
+                for query_string, (count, total, slowest)
+                in _query_stats.iteritems())
+  finally:
+    _query_stats_lock.release()
+
+
+class _CachedGqlQuery(db.GqlQuery):
+  """GqlQuery that records how long its executions take.
+
+  Instances in the cache are templates: gql() hands out a shallow copy of
+  one for each call and binds the arguments on the copy, so the parsed
+  query is shared but the bindings are not.
+  """
+
+  def __init__(self, query_string, *args, **kwds):
+    db.GqlQuery.__init__(self, query_string, *args, **kwds)
+    self._stats_key = query_string
+
+  def _timed(self, method, *args, **kwds):
+    start = time.time()
+    try:
+      return method(self, *args, **kwds)
+    finally:
+      _record_query(self._stats_key, time.time() - start)
+
+  def run(self, *args, **kwds):
+    return self._timed(db.GqlQuery.run, *args, **kwds)
+
+  def fetch(self, *args, **kwds):
+    return self._timed(db.GqlQuery.fetch, *args, **kwds)
+
+  def count(self, *args, **kwds):
+    return self._timed(db.GqlQuery.count, *args, **kwds)
 
 
 def gql(cls, clause, *args, **kwds):
   """Return a query object, from the cache if possible.
 
+  Safe to call from concurrent requests: the arguments are bound to a copy of
+  the cached template, never to the template itself.
+
   Args:
     cls: a db.Model subclass.
     clause: a query clause, e.g. 'WHERE draft = TRUE'.
@@ -64,9 +141,11 @@ def gql(cls, clause, *args, **kwds):
     **kwds bound to the query.
   """
   query_string = 'SELECT * FROM %s %s' % (cls.kind(), clause)
-  query = _query_cache.get(query_string)
-  if query is None:
-    _query_cache[query_string] = query = db.GqlQuery(query_string)
+  template = cache.get('gql', query_string)
+  if template is None:
+    template = _CachedGqlQuery(query_string)
+    cache.set_value('gql', query_string, template)
+  query = copy.copy(template)
   query.bind(*args, **kwds)
   return query
 
@@ -93,37 +172,57 @@ def gen_random_string(num_chars=16):
 
 
 def insert_model_with_new_key(cls, parent=None, **kwargs):
-  """Insert model into datastore with a random key.
+  """Insert model into datastore with a new, unique key.
 
   Args:
     cls: Data model class (ex. models.DocModel).
     parent: optional parent argument to bind models in same entity group.
-      NOTE: If parent argument is passed, key_name may not be unique across
-      all entities.
   Returns:
     Data model entity or None if error.
-
-  TODO(mukundjha): Check for race condition.
   """
-  while True:
-    key_name = gen_random_string()
-    entity = cls.get_by_key_name(key_name, parent=parent)
-    if entity is None:
-      entity = cls(key_name=key_name, parent=parent, **kwargs)
-      entity.put()
-      break
-    else:
-      logging.info("Entity with key "+key_name+" exists")
+  entity = cls(key_name=key_allocation.allocate_key_names(cls)[0],
+               parent=parent, **kwargs)
+  entity.put()
+  _index_new_links([entity])
   return entity
 
 
+def insert_models_with_new_keys(cls, values_list, parent=None):
+  """Bulk version of insert_model_with_new_key(), using a single put.
+
+  Args:
+    cls: Data model class (ex. models.DocVisitState).
+    values_list: List of dicts, the initial property values of each entity.
+    parent: optional parent argument to bind models in same entity group.
+  Returns:
+    The list of new entities, in the order of values_list.
+  """
+  key_names = key_allocation.allocate_key_names(cls, len(values_list))
+  entities = [cls(key_name=key_name, parent=parent, **values)
+              for key_name, values in zip(key_names, values_list)]
+  db.put(entities)
+  # BaseModel.put() would have done this for each entity.
+  identity_map.add([e for e in entities if isinstance(e, BaseModel)])
+  _index_new_links(entities)
+  return entities
+
+
+# Accounts are cached in memcache only, by key name, encoded as protobufs.
+_ACCOUNT_NAMESPACE = 'account'
+cache.register(_ACCOUNT_NAMESPACE, local=False)
+
+# Number of nickname candidates looked up at once for a new Account.
+_NICKNAME_PROBE_BATCH = 10
+
+
 class Account(db.Model):
   """Maps a user or email address to a user-selected nickname, and more.
 
   NOTE(vche): Changed from rietveld to use user_id, rather than email,
   as the key, since the user_id is more stable.
 
-  Nicknames do not have to be unique.
+  Nicknames do not have to be unique, but the ones created by
+  create_nickname_for_user() are; see NicknameIndex.
 
   The default nickname is generated from the email address by
   stripping the first '@' sign and everything after it.  The email
@@ -158,7 +257,14 @@ class Account(db.Model):
   def put(self):
     self.lower_email = str(self.email).lower()
     self.lower_nickname = self.nickname.lower()
-    super(Account, self).put()
+    key = super(Account, self).put()
+    cache.set_value(_ACCOUNT_NAMESPACE, key.name(), _encode_entity(self))
+    return key
+
+  def delete(self):
+    key_name = self.key().name()
+    super(Account, self).delete()
+    cache.delete(_ACCOUNT_NAMESPACE, key_name)
 
   @classmethod
   def get_account_for_user(cls, user):
@@ -178,18 +284,44 @@ class Account(db.Model):
 
   @classmethod
   def create_nickname_for_user(cls, user):
-    """Returns a unique nickname for a user, appending numeric suffix."""
-    name = nickname = user.email().split('@', 1)[0]
-    next_char = chr(ord(nickname[0].lower())+1)
-    existing_nicks = [account.lower_nickname
-                      for account in cls.gql(('WHERE lower_nickname >= :1 AND '
-                                              'lower_nickname < :2'),
-                                             nickname.lower(), next_char)]
+    """Claims a unique nickname for a user, appending numeric suffix.
+
+    Candidates are looked up in NicknameIndex _NICKNAME_PROBE_BATCH at a
+    time, so the cost does not depend on the number of existing accounts.
+    The first free one is claimed with NicknameIndex.claim().
+    """
+    name = user.email().split('@', 1)[0]
+    user_id = user.user_id()
     suffix = 0
-    while nickname.lower() in existing_nicks:
-      suffix += 1
-      nickname = '%s%d' % (name, suffix)
-    return nickname
+    while True:
+      candidates = ['%s%d' % (name, n)
+                    for n in range(suffix, suffix + _NICKNAME_PROBE_BATCH)]
+      if suffix == 0:
+        candidates[0] = name
+      claims = NicknameIndex.get_by_key_name(
+          [NicknameIndex.key_name_for(c) for c in candidates])
+      for nickname, claim in zip(candidates, claims):
+        if claim is not None and claim.user_id != user_id:
+          continue
+        if claim is None and cls._nickname_used_by_other(nickname, user_id):
+          continue
+        if NicknameIndex.claim(nickname, user_id):
+          return nickname
+      suffix += _NICKNAME_PROBE_BATCH
+
+  @classmethod
+  def _nickname_used_by_other(cls, nickname, user_id):
+    """Whether an Account of another user has nickname.
+
+    Accounts created before NicknameIndex existed hold nicknames that are
+    not in the index; this equality query keeps them from being handed out
+    again.
+    """
+    query = gql(cls, 'WHERE lower_nickname = :1', nickname.lower())
+    for account in query.fetch(2):
+      if account.user_id != user_id:
+        return True
+    return False
 
   @classmethod
   def get_nickname_for_user(cls, user):
@@ -210,11 +342,23 @@ class Account(db.Model):
 
   @classmethod
   def get_by_key_name(cls, key, **kwds):
-    """Override db.Model.get_by_key_name() to use cached value if possible."""
-    if not kwds and cls.current_user_account is not None:
+    """Override db.Model.get_by_key_name() to use cached value if possible.
+
+    A single key name is looked up in current_user_account, then in memcache,
+    and only then in the datastore.
+    """
+    if kwds or not isinstance(key, basestring):
+      return super(Account, cls).get_by_key_name(key, **kwds)
+    if cls.current_user_account is not None:
       if key == cls.current_user_account.key().name():
         return cls.current_user_account
-    return super(Account, cls).get_by_key_name(key, **kwds)
+    encoded = cache.get(_ACCOUNT_NAMESPACE, key)
+    if encoded is not None:
+      return _decode_entity(encoded)
+    account = super(Account, cls).get_by_key_name(key)
+    if account is not None:
+      cache.set_value(_ACCOUNT_NAMESPACE, key, _encode_entity(account))
+    return account
 
   @classmethod
   def get_nickname_for_id(cls, user_id, default=None):
@@ -239,14 +383,14 @@ class Account(db.Model):
   def get_accounts_for_email(cls, email):
     """Get list of Accounts that have this email."""
     assert email
-    return [a for a in cls.all().filter('lower_email =', email.lower())]
+    return list(gql(cls, 'WHERE lower_email = :1', email.lower()))
 
   @classmethod
   def get_accounts_for_nickname(cls, nickname):
     """Get the list of Accounts that have this nickname."""
     assert nickname
     assert '@' not in nickname
-    return [a for a in cls.all().filter('lower_nickname =', nickname.lower())]
+    return list(gql(cls, 'WHERE lower_nickname = :1', nickname.lower()))
 
   @classmethod
   def get_nickname_for_email(cls, email, default=None):
@@ -315,6 +459,48 @@ class Account(db.Model):
     return m.hexdigest()
 
 
+class NicknameIndex(db.Model):
+  """Records which Account holds a nickname, to keep nicknames unique.
+
+  Keyed by key_name_for(nickname), so that finding out whether a nickname is
+  taken is a get rather than a query. Entries are created by claim() and
+  never change owner.
+
+  Attributes:
+    user_id: user_id of the Account holding the nickname.
+    created: The date/time that the nickname was claimed.
+  """
+
+  user_id = db.StringProperty(required=True)
+  created = db.DateTimeProperty(auto_now_add=True)
+
+  @staticmethod
+  def key_name_for(nickname):
+    """Returns the key name of the entry for nickname, in any case."""
+    return 'n:' + nickname.lower()
+
+  @classmethod
+  def claim(cls, nickname, user_id):
+    """Claims nickname for user_id, unless another user already holds it.
+
+    Args:
+      nickname: The nickname to claim.
+      user_id: user_id of the claiming Account.
+    Returns:
+      True if user_id holds nickname now, False if someone else does.
+    """
+    key_name = cls.key_name_for(nickname)
+
+    def txn():
+      entry = cls.get_by_key_name(key_name)
+      if entry is None:
+        cls(key_name=key_name, user_id=user_id).put()
+        return True
+      return entry.user_id == user_id
+
+    return db.run_in_transaction(txn)
+
+
 class ProvisionalAccount(db.Model):
   """Account based on email only, before user has logged in.
 
@@ -407,15 +593,118 @@ class BaseModel(db.Model):
     """
     return insert_model_with_new_key(cls, parent=parent, **kwargs)
 
+  def put(self):
+    """Writes the entity and refreshes it in the request's identity map."""
+    key = super(BaseModel, self).put()
+    identity_map.add(self)
+    return key
+
+  def delete(self):
+    """Deletes the entity and drops it from the request's identity map."""
+    identity_map.forget(self.key())
+    super(BaseModel, self).delete()
+
 
 class UserStateModel(db.Model):
   """Abstract base class for all user specific state models.
 
+  Subclasses that list their identifying references in KEY_REFS keep at most
+  one entity per (user, references) and are keyed by key_name_for(), so that
+  they are read with a get instead of a filter query.
+
+  Class Attributes:
+    KEY_REFS: Names of the ReferenceProperties that, with the user, identify
+        an entity. Empty for models that are not keyed this way.
+    WRITE_BEHIND: Whether entities are updated through write_behind.put(),
+        in which case get_by_key_name() sees the buffered copies.
+
   Attributes:
     user: Reference to the the user.
   """
+  KEY_REFS = ()
+  WRITE_BEHIND = False
+
   user = db.UserProperty(auto_current_user_add=True, required=True)
 
+  @classmethod
+  def key_name_for(cls, user, *refs):
+    """Returns the key name of the entity for user and refs.
+
+    Args:
+      user: A users.User.
+      refs: One model, key or key string for each name in KEY_REFS.
+    Returns:
+      A string of the form 'u:<user_id>|<key>|...'. Users without a user id
+      (e.g. those constructed from an email address) use 'e:<email>'.
+    Raises:
+      BadKeyError: If a ref is a malformed key string.
+      ValueError: If the number of refs does not match KEY_REFS.
+    """
+    if len(refs) != len(cls.KEY_REFS):
+      raise ValueError('%s is keyed by %r' % (cls.kind(), cls.KEY_REFS))
+    if user.user_id():
+      parts = ['u:' + user.user_id()]
+    else:
+      parts = ['e:' + user.email()]
+    for ref in refs:
+      if isinstance(ref, db.Model):
+        ref = ref.key()
+      parts.append(str(db.Key(str(ref))))
+    return '|'.join(parts)
+
+  @classmethod
+  def get_by_key_name(cls, key_names, parent=None):
+    """Override db.Model.get_by_key_name() to see buffered writes."""
+    if not cls.WRITE_BEHIND or parent is not None:
+      return super(UserStateModel, cls).get_by_key_name(key_names,
+                                                        parent=parent)
+    if isinstance(key_names, (list, tuple)):
+      return write_behind.get([db.Key.from_path(cls.kind(), name)
+                               for name in key_names])
+    return write_behind.get(db.Key.from_path(cls.kind(), key_names))
+
+  def put(self):
+    """Writes the entity, dropping any copy buffered by write_behind."""
+    key = super(UserStateModel, self).put()
+    if self.WRITE_BEHIND:
+      write_behind.discard(key)
+    return key
+
+  @classmethod
+  def key_for(cls, user, *refs):
+    """Returns the db.Key of the entity for user and refs."""
+    return db.Key.from_path(cls.kind(), cls.key_name_for(user, *refs))
+
+  @classmethod
+  def get_for(cls, user, *refs):
+    """Fetches the entity for user and refs.
+
+    Returns:
+      The entity, or None if there is none (or user is None).
+    """
+    if user is None:
+      return None
+    return cls.get_by_key_name(cls.key_name_for(user, *refs))
+
+  @classmethod
+  def new_for(cls, user, *refs, **kwargs):
+    """Returns a new, unsaved entity for user and refs.
+
+    Args:
+      user: A users.User.
+      refs: Values for the properties named in KEY_REFS.
+      kwargs: The initial values of the other properties.
+    """
+    refs = [isinstance(ref, basestring) and db.Key(ref) or ref
+            for ref in refs]
+    kwargs.update(zip(cls.KEY_REFS, refs))
+    return cls(key_name=cls.key_name_for(user, *refs), user=user, **kwargs)
+
+  @classmethod
+  def get_or_new(cls, user, *refs):
+    """Fetches the entity for user and refs, or returns a new unsaved one."""
+    return cls.get_for(user, *refs) or cls.new_for(user, *refs)
+
 
 class BaseContentModel(BaseModel):
   """Abstract base class inherited by all immutable content objects.
@@ -452,16 +741,60 @@ class BaseContentModel(BaseModel):
     Returns:
       Returns an object of type cls.
     """
-    identifying_fields = cls._get_identifying_fields(**kwargs)
-    txt = '|'.join(identifying_fields)
-
-    key_name = cls.__name__ + ':' + sha.new(txt).hexdigest()
+    key_name = cls._content_key_name(**kwargs)
     object = cls.get_by_key_name(key_name)
 
     if not object:
       object = cls.get_or_insert(key_name, **kwargs)
+      _index_new_links([object])
     return object
 
+  @staticmethod
+  def insert_many(specs):
+    """Bulk version of insert(), for objects of possibly different classes.
+
+    All the key names are computed up front, existing objects are looked up
+    with a single get and the missing ones written with a single put, so the
+    cost does not grow with the number of objects.
+
+    Unlike insert() the write is not transactional. Two concurrent callers
+    may both write the same object; since the key name is a hash of the
+    content, only creator and created can differ.
+
+    Args:
+      specs: List of (model_class, kwargs) pairs, kwargs being what would
+          be passed to model_class.insert().
+
+    Returns:
+      A list of objects, in the order of specs.
+    """
+    keys = []
+    for model_class, kwargs in specs:
+      keys.append(db.Key.from_path(model_class.kind(),
+                                   model_class._content_key_name(**kwargs)))
+    objects = identity_map.get(keys)
+
+    new_objects = {}
+    for i, (model_class, kwargs) in enumerate(specs):
+      if objects[i] is None:
+        key_str = str(keys[i])
+        if key_str not in new_objects:
+          new_objects[key_str] = model_class(key_name=keys[i].name(), **kwargs)
+        objects[i] = new_objects[key_str]
+
+    if new_objects:
+      db.put(new_objects.values())
+      identity_map.add(new_objects.values())
+      _index_new_links(new_objects.values())
+    return objects
+
+  @classmethod
+  def _content_key_name(cls, **kwargs):
+    """Returns the key name insert() uses for an object with kwargs."""
+    identifying_fields = cls._get_identifying_fields(**kwargs)
+    txt = '|'.join(identifying_fields)
+    return cls.__name__ + ':' + sha.new(txt).hexdigest()
+
   @classmethod
   def _get_identifying_fields(cls, **kwargs):
     """Gets a list of fields that uniquely identify an entry.
@@ -617,6 +950,14 @@ class DocModel(BaseContentModel):
   label = db.StringProperty(default=AllowedLabels.MODULE)
   score_weight = db.ListProperty(float)
 
+  def put(self):
+    """Writes the doc, dropping the cached copy kept for its trunk's head."""
+    key = super(DocModel, self).put()
+    trunk_key = identity_map.ref_key(self, 'trunk_ref')
+    if trunk_key:
+      invalidate_trunk_head(trunk_key)
+    return key
+
   def get_score(self, user):
     """Returns progress score for the doc.
 
@@ -629,8 +970,10 @@ class DocModel(BaseContentModel):
     Raises:
      InvalidDocumentError: If doc is invalid.
     """
-    visit_state = DocVisitState.all().filter('user =', user).filter(
-      'trunk_ref =', self.trunk_ref).order('-last_visit').get()
+    trunk_key = identity_map.ref_key(self, 'trunk_ref')
+    if not trunk_key or not VisitedTrunks.may_have_visited(user, trunk_key):
+      return 0
+    visit_state = DocVisitState.get_for(user, trunk_key)
 
     if visit_state:
       return visit_state.progress_score
@@ -644,17 +987,14 @@ class DocModel(BaseContentModel):
       old: old document
       new: new document
     """
-    content_len = len(self.content)
     old_key = str(old.key())
-    for i, element in enumerate(self.content):
-      elem = db.get(element)
+    for i, elem in enumerate(identity_map.get(self.content)):
       if not isinstance(elem, DocLinkModel):
         continue
-      doc = elem.doc_ref
-      if not doc:
+      doc_key = identity_map.ref_key(elem, 'doc_ref')
+      if not doc_key:
         continue
-      doc_key = str(doc.key())
-      if doc_key == old_key:
+      if str(doc_key) == old_key:
         break
     else:
       return # not found
@@ -742,7 +1082,7 @@ class DocModel(BaseContentModel):
 
   def trunk_tip(self):
     """Returns the tip of the same trunk"""
-    return db.get(self.trunk_ref.head)
+    return get_trunk_head(identity_map.ref_key(self, 'trunk_ref'))
 
   def dump_to_dict(self):
     """Returns all attributes of the doc object in a dictionary.
@@ -763,13 +1103,14 @@ class DocModel(BaseContentModel):
       'doc_label': self.label
       }
 
-    if self.trunk_ref:
-      data_dict['doc_trunk_ref'] = str(self.trunk_ref.key())
+    trunk_key = identity_map.ref_key(self, 'trunk_ref')
+    if trunk_key:
+      data_dict['doc_trunk_ref'] = str(trunk_key)
     # collecting content
     content_list = []
 
-    for element_key in self.content:
-      element = db.get(element_key)
+    elements = identity_map.get(self.content)
+    for element_key, element in zip(self.content, elements):
       if element:
         content_list.append(element.dump_to_dict())
       else:
@@ -782,14 +1123,15 @@ class DocModel(BaseContentModel):
   def first_child_after(self, child):
     """Return the target of the first link after a link pointing to the child"""
     if child:
-      skip_until = str(db.get(child.trunk_ref.head).key())
+      skip_until = identity_map.get_ref(child, 'trunk_ref').head
     else:
       skip_until = None
-    for el in self.content:
-      elem = db.get(el)
+    for elem in identity_map.get(self.content):
       if not isinstance(elem, DocLinkModel):
         continue
-      tip = db.get(elem.doc_ref.trunk_ref.head)
+      tip = elem.get_tip()
+      if not tip:
+        continue
       if not skip_until:
         return tip
       if skip_until == str(tip.key()):
@@ -806,15 +1148,16 @@ class DocModel(BaseContentModel):
     child is the last element in self, return None to tell the caller to
     look in our parent.
     """
-    skip_until = str(db.get(child.trunk_ref.head).key())
-    for el in self.content:
-      elem = db.get(el)
+    skip_until = identity_map.get_ref(child, 'trunk_ref').head
+    for elem in identity_map.get(self.content):
       if not isinstance(elem, DocLinkModel):
         # Have we seen child?
         if not skip_until:
           return self
         continue
-      tip = db.get(elem.doc_ref.trunk_ref.head)
+      tip = elem.get_tip()
+      if not tip:
+        continue
       if not skip_until:
         return tip
       if skip_until == str(tip.key()):
@@ -892,37 +1235,25 @@ class DocModel(BaseContentModel):
     return "<div>" + "</div>\n<div>".join(result) + "</div>"
 
   def contentAsComparable(self):
-    return [ComparableSequenceElem(db.get(elem)) for elem in self.content]
+    return [ComparableSequenceElem(elem)
+            for elem in identity_map.get(self.content)]
 
   def outline(self):
-    """Return outline of the document and its subdocuments"""
-    page = { 'doc_id': str(self.key()),
-             'trunk_id': str(self.trunk_ref.key()),
-             'title': self.title,
-             'content': [],
-             }
-    try:
-      content_list = db.get(self.content)
-    except db.BadKeyError:
-      content_list = []
-      for content_id in self.content:
-        try:
-          content = db.get(content_id)
-          content_list.append(content)
-        except BadKeyError:
-          pass
-
-    for doclink in content_list:
-      if (not doclink) or (not isinstance(doclink, DocLinkModel)):
-        continue
-      try:
-        target = db.get(doclink.trunk_ref.head)
-      except (BadKeyError, AttributeError):
-        target = None
-      if (not target) or (not isinstance(target, DocModel)):
-        continue
-      page['content'].append(target.outline())
-    return page
+    """Return outline of the document and its subdocuments.
+
+    See get_outline().
+    """
+    return get_outline(self)
+
+
+# URL of the task indexing the head of a trunk for search, queued by
+# TrunkModel.put() when the head changed; see search.index_trunk().
+SEARCH_INDEX_URL = '/task/indexTrunk'
+
+# URL of the task counting the courses tagged with some tags, queued by
+# TrunkModel.put() when the tags of a course head changed; see
+# update_tag_counts().
+TAG_COUNT_URL = '/task/countTags'
 
 
 class TrunkModel(BaseModel):
@@ -935,6 +1266,13 @@ class TrunkModel(BaseModel):
      head: Pointer to a document representing current version of the trunk.
        This is stored as string to allow atomic transcations while adding
        and creating new trunks/documents.
+     title: Title of the head document.
+     created: Time the trunk was created.
+     has_head: Whether head is set, for listing only the trunks that have one.
+     head_creator: Author of the head document.
+     head_created: Time the head document was created.
+     head_label: Label of the head document, see AllowedLabels.
+     head_tags: Tags of the head document.
      fork_list: List of trunks formed by forking from this trunk.
      fork_commit_messages: Commit message log for each fork instance.
   """
@@ -942,6 +1280,12 @@ class TrunkModel(BaseModel):
   # Probably we need another model to keep fork_list
   head = db.StringProperty()
   title = db.StringProperty()
+  created = db.DateTimeProperty(auto_now_add=True)
+  has_head = db.BooleanProperty(default=False)
+  head_creator = db.UserProperty()
+  head_created = db.DateTimeProperty()
+  head_label = db.StringProperty()
+  head_tags = db.ListProperty(db.Category)
   fork_list = db.ListProperty(db.Key)
   fork_commit_messages = db.StringListProperty()
 
@@ -958,14 +1302,18 @@ class TrunkModel(BaseModel):
 
     Trunk caches some information on the document at its tip, and
     here is the place to update it.  Do not use trunk.head = doc_id directly.
+    The memcached head (see get_trunk_head()) is dropped by put().
 
     Args:
       doc_or_id: A DocModel or an id referencing a DocModel.
     """
+    # Indexed for search by put().
+    self._head_changed = True
     if isinstance(doc_or_id, basestring):
       self.head = doc_or_id
+      self.has_head = True
       try:
-        doc = db.get(doc_or_id)
+        doc = identity_map.get(doc_or_id)
       except (db.BadKeyError, db.BadRequestError):
         # library.createnewdoc runs this inside a transaction
         # and updating doc and trunk at the same time will throw
@@ -975,13 +1323,781 @@ class TrunkModel(BaseModel):
     elif isinstance(doc_or_id, DocModel):
       doc = doc_or_id
       self.head = str(doc.key())
+      self.has_head = True
     else:
       # Unexpected input type. Ignore.
       return
     if isinstance(doc, DocModel):
-      self.title = doc.title
+      self.copyHeadInfo(doc)
     Subscription.notifyChange(self)
 
+  def copyHeadInfo(self, doc):
+    """Copies what the trunk caches of its head document.
+
+    Args:
+      doc: The DocModel at the head of the trunk.
+    """
+    if AllowedLabels.COURSE in (self.head_label, doc.label):
+      # The course catalog is dropped by put().
+      self._catalog_changed = True
+      if (self.head_label, self.head_tags) != (doc.label, doc.tags):
+        # Counted again by a task queued by put().
+        changed = getattr(self, '_changed_tags', set())
+        self._changed_tags = changed.union(self.head_tags + doc.tags)
+    self.title = doc.title
+    self.head_creator = doc.creator
+    self.head_created = doc.created
+    self.head_label = doc.label
+    self.head_tags = list(doc.tags)
+
+  def _listed_state(self):
+    """Returns what the caches and the title index keep of the trunk."""
+    return (self.head, self.title, self.has_head, self.created,
+            self.head_creator, self.head_created, self.head_label,
+            tuple(self.head_tags))
+
+  def listing_changed(self):
+    """Returns whether put() would have listed metadata to write.
+
+    That is, whether anything the caches and the title index keep of the
+    trunk changed since it was read or last saved.
+    """
+    return self._listed_state() != getattr(self, '_stored_state', None)
+
+  @classmethod
+  def from_entity(cls, entity):
+    """Loads a trunk, remembering its state for put() to compare against."""
+    trunk = super(TrunkModel, cls).from_entity(entity)
+    trunk._stored_state = trunk._listed_state()
+    trunk._title_indexed = (trunk.head, trunk.title)
+    return trunk
+
+  def put(self):
+    """Writes the trunk and, if its title or head changed, its index entry.
+
+    The cached head is dropped rather than updated, since this may run inside
+    a transaction that is later rolled back, and only if the head changed;
+    so is the cached trunk list if anything it shows changed. The index
+    entry shares the trunk's entity group, so it can be written in the same
+    transaction. A head set with setHead() is indexed for search by a task,
+    and the tags of course heads are counted by another. Inside a
+    transaction both are queued transactionally, so that they only run if it
+    commits.
+    """
+    stored = getattr(self, '_stored_state', None)
+    state = self._listed_state()
+    key = super(TrunkModel, self).put()
+    self._stored_state = state
+    TrunkTitleIndex.update(self)
+    if stored is None or stored[0] != state[0]:
+      invalidate_trunk_head(key)
+    if stored != state:
+      cache.invalidate(_TRUNK_LIST_NAMESPACE)
+    if getattr(self, '_catalog_changed', False):
+      cache.invalidate(CATALOG_NAMESPACE)
+      self._catalog_changed = False
+    if getattr(self, '_changed_tags', None):
+      # Counting takes queries, which transactions do not allow.
+      taskqueue.add(url=TAG_COUNT_URL,
+                    params={'tags': u'\n'.join(self._changed_tags).encode(
+                        'utf-8')},
+                    transactional=db.is_in_transaction())
+      self._changed_tags = set()
+    if getattr(self, '_head_changed', False):
+      taskqueue.add(url=SEARCH_INDEX_URL, params={'trunk': str(key)},
+                    transactional=db.is_in_transaction())
+      self._head_changed = False
+    return key
+
+
+class TrunkTitleIndex(db.Model):
+  """Title and head of a trunk, for listing trunks by title.
+
+  Each trunk with a head and a title has one entry, a child entity of the
+  trunk kept up to date by TrunkModel.put(). Listing trunks this way needs
+  neither the trunks nor their head documents, and pages are read with
+  query cursors, so a page deep into the list costs as much as the first.
+
+  Attributes:
+    title: Title of the trunk, i.e. of its head document.
+    head: String value of the key of the head document.
+  """
+  KEY_NAME = 'title'
+
+  title = db.StringProperty()
+  head = db.StringProperty()
+
+  @classmethod
+  def update(cls, trunk, force=False):
+    """Writes the entry of trunk, unless it is already up to date.
+
+    The entry of a trunk read from the datastore is taken to be up to date
+    until its title or head change.
+
+    Args:
+      trunk: A saved TrunkModel.
+      force: Whether to write the entry even so, e.g. for trunks stored
+        before the index existed.
+    """
+    state = (trunk.head, trunk.title)
+    if (not trunk.head or trunk.title is None or
+        (not force and getattr(trunk, '_title_indexed', None) == state)):
+      return
+    cls(parent=trunk, key_name=cls.KEY_NAME, title=trunk.title,
+        head=trunk.head).put()
+    trunk._title_indexed = state
+
+  @classmethod
+  def fetch_page(cls, prefix, count, cursor=None, offset=0):
+    """Lists trunks ordered by title.
+
+    Args:
+      prefix: Only list the trunks whose title starts with this, if not empty.
+      count: Maximum number of entries to return.
+      cursor: Cursor returned for the previous page, if any.
+      offset: Number of entries to skip when no cursor is given.
+    Returns:
+      (entries, cursor, at_end): entries is a list of (title, trunk_id,
+      doc_id) tuples, cursor resumes after the last of them and at_end
+      tells whether there are no more entries.
+    Raises:
+      db.BadValueError, db.BadRequestError: If cursor is not valid.
+    """
+    query = cls.all()
+    if prefix:
+      query.filter('title >=', prefix)
+      query.filter('title <', prefix + u'\ufffd')
+    query.order('title')
+    if cursor:
+      query.with_cursor(cursor)
+      offset = 0
+    page = query.fetch(count, offset)
+    cursor = query.cursor()
+    at_end = len(page) < count or not query.with_cursor(cursor).fetch(1)
+    entries = [(entry.title, str(entry.key().parent()), entry.head)
+               for entry in page]
+    return entries, cursor, at_end
+
+
+### Trunk head resolution ###
+
+
+# Cache namespace holding trunk key -> (head doc key, encoded head doc). Not
+# kept locally, as a new head must be visible to all instances at once.
+_TRUNK_HEAD_NAMESPACE = 'trunk_head'
+cache.register(_TRUNK_HEAD_NAMESPACE, local=False)
+
+
+def _encode_entity(entity):
+  """Serializes an entity for memcache."""
+  return db.model_to_protobuf(entity).Encode()
+
+
+def _decode_entity(encoded):
+  """Inverse of _encode_entity()."""
+  return db.model_from_protobuf(entity_pb.EntityProto(encoded))
+
+
+# Memcache namespace of the trunk generations: counters bumped by
+# invalidate_trunk_head(), by which the cached outlines and course sequences
+# tell whether one of the trunks they include has changed.
+_TRUNK_GENERATION_NAMESPACE = 'demo.trunk_generation'
+
+
+def _get_trunk_generations(trunks):
+  """Returns the generations of trunks, given as key strings.
+
+  A generation evicted from memcache starts again from the current time in
+  milliseconds, so that it does not match the generation it replaces.
+
+  Returns:
+    A dict mapping each trunk to its generation. Trunks are missing if
+    memcache is unavailable.
+  """
+  found = memcache.get_multi(trunks, namespace=_TRUNK_GENERATION_NAMESPACE)
+  missing = [trunk for trunk in trunks if trunk not in found]
+  if missing:
+    start = int(time.time() * 1000)
+    memcache.add_multi(dict((trunk, start) for trunk in missing),
+                       namespace=_TRUNK_GENERATION_NAMESPACE)
+    found.update(memcache.get_multi(missing,
+                                    namespace=_TRUNK_GENERATION_NAMESPACE))
+  return found
+
+
+def _get_cached_tree(namespace, doc_key):
+  """Returns a tree stored by _set_cached_tree(), None if it is outdated."""
+  cached = cache.get(namespace, doc_key)
+  if cached is None:
+    return None
+  tree, generations = cached
+  if _get_trunk_generations(generations.keys()) != generations:
+    return None
+  return tree
+
+
+def _set_cached_tree(namespace, doc_key, tree, trunks):
+  """Caches a tree built from trunks until one of them changes."""
+  generations = _get_trunk_generations(trunks)
+  if len(generations) == len(trunks):
+    cache.set_value(namespace, doc_key, (tree, generations))
+
+
+def invalidate_trunk_head(trunk_or_key):
+  """Drops the cached head of a trunk.
+
+  Args:
+    trunk_or_key: A TrunkModel, its key or key string.
+  """
+  if isinstance(trunk_or_key, db.Model):
+    trunk_or_key = trunk_or_key.key()
+  cache.delete(_TRUNK_HEAD_NAMESPACE, str(trunk_or_key))
+  # Outdates the outlines and sequences including this trunk.
+  memcache.incr(str(trunk_or_key), namespace=_TRUNK_GENERATION_NAMESPACE)
+
+
+def get_trunk_heads(trunks):
+  """Resolves a list of trunks to the DocModels at their heads.
+
+  Going from a trunk to its head normally costs two sequential gets. Here
+  the head key (and the head entity itself) is kept in memcache, so that a
+  resolution costs no datastore RPC when cached, and at most two batched
+  gets for the whole list otherwise.
+
+  Args:
+    trunks: List of TrunkModel, trunk keys or key strings.
+  Returns:
+    A list of DocModels (or None where the trunk or its head does not
+    exist or the head is not a DocModel), in the order of trunks.
+  Raises:
+    BadKeyError: If a malformed trunk key string is passed.
+  """
+  trunk_keys = []
+  known_heads = {}
+  for trunk in trunks:
+    if isinstance(trunk, db.Model):
+      trunk_key = str(trunk.key())
+      known_heads[trunk_key] = trunk.head
+    else:
+      trunk_key = str(db.Key(str(trunk)))
+    trunk_keys.append(trunk_key)
+
+  cached = cache.get_multi(
+      _TRUNK_HEAD_NAMESPACE, [k for k in trunk_keys if k not in known_heads])
+  head_of = dict(known_heads)
+  for trunk_key, (head, encoded) in cached.iteritems():
+    head_of[trunk_key] = head
+    if encoded and head and not identity_map.peek(head):
+      identity_map.add(_decode_entity(encoded))
+
+  unresolved = [k for k in trunk_keys if k not in head_of]
+  if unresolved:
+    for trunk_key, trunk in zip(unresolved, identity_map.get(unresolved)):
+      head_of[trunk_key] = trunk and trunk.head
+
+  head_keys = []
+  for trunk_key in trunk_keys:
+    head = head_of[trunk_key]
+    try:
+      if head:
+        head_keys.append(db.Key(head))
+        head_of[trunk_key] = str(head_keys[-1])
+    except db.BadKeyError:
+      # Some old trunks carry a garbage head; treat them as headless.
+      head_of[trunk_key] = None
+  heads = {}
+  for doc in identity_map.get(head_keys):
+    if isinstance(doc, DocModel):
+      heads[str(doc.key())] = doc
+
+  to_cache = {}
+  for trunk_key in trunk_keys:
+    head = head_of[trunk_key]
+    if trunk_key in cached or not head:
+      continue
+    doc = heads.get(head)
+    encoded = None
+    if doc:
+      encoded = _encode_entity(doc)
+    to_cache[trunk_key] = (head, encoded)
+  if to_cache:
+    cache.set_multi(_TRUNK_HEAD_NAMESPACE, to_cache)
+
+  return [heads.get(head_of[k]) for k in trunk_keys]
+
+
+def get_trunk_head(trunk):
+  """Resolves a trunk to the DocModel at its head.
+
+  See get_trunk_heads().
+
+  Args:
+    trunk: A TrunkModel, trunk key or key string.
+  Returns:
+    The DocModel at the head of the trunk, or None.
+  """
+  return get_trunk_heads([trunk])[0]
+
+
+### Trunk listing ###
+
+
+# First pages of get_trunk_list() by order and count. The whole namespace is
+# dropped by TrunkModel.put().
+_TRUNK_LIST_NAMESPACE = 'trunk_list'
+cache.register(_TRUNK_LIST_NAMESPACE)
+
+# Sort orders accepted by get_trunk_list(), newest trunks first by default.
+TRUNK_LIST_ORDERS = {
+    'created': '-created',
+    'title': 'title',
+    }
+
+
+def get_trunk_list(order='created', count=20, cursor=None):
+  """Lists the trunks that have a head, one page at a time.
+
+  Only TrunkModel is queried; what the listing shows of the head document
+  is cached on the trunk by TrunkModel.copyHeadInfo(). The first page of
+  each order is cached, and further pages are read with query cursors, so
+  every page costs the same whatever its position.
+
+  Args:
+    order: One of the keys of TRUNK_LIST_ORDERS.
+    count: Maximum number of trunks to return.
+    cursor: Cursor returned for the previous page, if any.
+  Returns:
+    (entries, cursor, at_end): entries is a list of dicts with 'title',
+    'trunk_id', 'doc_id', 'creator', 'created' (of the trunk) and 'modified'
+    (creation of the head) keys, cursor resumes
+    after the last of them and at_end tells whether there are no more
+    trunks.
+  Raises:
+    ValueError: If order is not a known sort order.
+    db.BadValueError, db.BadRequestError: If cursor is not valid.
+  """
+  if order not in TRUNK_LIST_ORDERS:
+    raise ValueError('Unknown trunk list order %r' % order)
+  cache_key = '%s:%d' % (order, count)
+  if not cursor:
+    cached = cache.get(_TRUNK_LIST_NAMESPACE, cache_key)
+    if cached is not None:
+      return cached
+
+  query = TrunkModel.all().filter('has_head =', True)
+  query.order(TRUNK_LIST_ORDERS[order])
+  if cursor:
+    query.with_cursor(cursor)
+  page = query.fetch(count)
+  next_cursor = query.cursor()
+  at_end = len(page) < count or not query.with_cursor(next_cursor).fetch(1)
+  entries = [{
+      'title': trunk.title,
+      'trunk_id': str(trunk.key()),
+      'doc_id': trunk.head,
+      'creator': trunk.head_creator,
+      'created': trunk.created,
+      'modified': trunk.head_created,
+      } for trunk in page]
+  result = (entries, next_cursor, at_end)
+  if not cursor:
+    cache.set_value(_TRUNK_LIST_NAMESPACE, cache_key, result)
+  return result
+
+
+### Course catalog ###
+
+
+# The course catalog, the tag counts and what is derived from them (see
+# library.get_sitemap()). The whole namespace is dropped by TrunkModel.put()
+# when a trunk gets or loses a course at its head.
+CATALOG_NAMESPACE = 'catalog'
+cache.register(CATALOG_NAMESPACE)
+
+# Number of courses per page of the catalog. Each page is cached as one
+# memcache value, so this keeps them far below its 1MB limit however large
+# the catalog grows.
+CATALOG_PAGE_SIZE = 200
+
+
+def get_course_catalog_page(number, previous=None):
+  """Returns a page of the trunks that have a course at their head, by title.
+
+  Only TrunkModel is queried, on the head metadata cached there by
+  TrunkModel.copyHeadInfo(). Each page is read with a query resuming from
+  the cursor of the page before, and cached on its own.
+
+  Args:
+    number: Number of the page, from 1.
+    previous: The page before, if the caller already has it. Otherwise the
+        pages before are walked from the first one (from the cache, unless
+        evicted) to find its cursor.
+  Returns:
+    An (entries, cursor, at_end) tuple. entries is a list of dicts with
+    'title', 'trunk_id', 'doc_id' and 'modified' (the creation time of the
+    head) keys, cursor resumes the query after them and at_end is True if
+    there are no further pages. Pages past the end are empty.
+  """
+  if previous is None and number > 1:
+    previous = get_course_catalog_page(1)
+    for before in xrange(2, number):
+      if previous[2]:
+        break
+      previous = get_course_catalog_page(before, previous)
+  if previous is not None and previous[2]:
+    return [], None, True
+
+  cache_key = 'courses:%d' % number
+  page = cache.get(CATALOG_NAMESPACE, cache_key)
+  if page is not None:
+    return page
+  query = TrunkModel.all().filter('head_label =', AllowedLabels.COURSE)
+  query.order('title')
+  if previous is not None:
+    query.with_cursor(previous[1])
+  batch = query.fetch(CATALOG_PAGE_SIZE)
+  page = ([{
+      'title': trunk.title,
+      'trunk_id': str(trunk.key()),
+      'doc_id': trunk.head,
+      'modified': trunk.head_created,
+      } for trunk in batch], query.cursor(), len(batch) < CATALOG_PAGE_SIZE)
+  cache.set_value(CATALOG_NAMESPACE, cache_key, page)
+  return page
+
+
+def get_course_catalog():
+  """Lists all the trunks that have a course at their head, by title.
+
+  Reads every page of get_course_catalog_page(), which callers that can
+  work a page at a time should use instead.
+
+  Returns:
+    A list of the entries of the pages.
+  """
+  page = get_course_catalog_page(1)
+  catalog = list(page[0])
+  number = 1
+  while not page[2]:
+    number += 1
+    page = get_course_catalog_page(number, page)
+    catalog.extend(page[0])
+  return catalog
+
+
+### Course tags ###
+
+
+class TagCount(db.Model):
+  """Number of trunks with a course tagged with a tag at their head.
+
+  Keyed by key_name_for(tag). Kept up to date by update_tag_counts(), which
+  a task queued by TrunkModel.put() runs for the tags of the courses it
+  changes.
+
+  Attributes:
+    tag: The tag.
+    count: The number of courses.
+  """
+  tag = db.CategoryProperty(required=True)
+  count = db.IntegerProperty(default=0)
+
+  @staticmethod
+  def key_name_for(tag):
+    """Returns the key name of the count of tag."""
+    return 't:' + tag
+
+
+# Maximum number of courses counted per tag.
+MAX_TAG_COUNT = 1000
+
+
+def update_tag_counts(tags):
+  """Counts again the courses at the heads of trunks having some tags.
+
+  Counting rather than incrementing makes this idempotent, so the task
+  running it may be retried, and lets it run outside of the transaction
+  that changed the trunk.
+
+  Args:
+    tags: The tags whose counts may have changed.
+  """
+  counts = []
+  for tag in tags:
+    query = TrunkModel.all(keys_only=True).filter('head_tags =', tag)
+    query.filter('head_label =', AllowedLabels.COURSE)
+    counts.append(TagCount(key_name=TagCount.key_name_for(tag), tag=tag,
+                           count=query.count(MAX_TAG_COUNT)))
+  db.put(counts)
+  cache.invalidate(CATALOG_NAMESPACE)
+
+
+def get_tag_counts(limit=50):
+  """Returns the most used tags of courses, with their counts.
+
+  The result is cached with the course catalog.
+
+  Args:
+    limit: Maximum number of tags returned.
+  Returns:
+    A list of (tag, count) tuples, most courses first.
+  """
+  cache_key = 'tags:%d' % limit
+  counts = cache.get(CATALOG_NAMESPACE, cache_key)
+  if counts is None:
+    query = TagCount.all().filter('count >', 0).order('-count')
+    counts = [(entry.tag, entry.count) for entry in query.fetch(limit)]
+    cache.set_value(CATALOG_NAMESPACE, cache_key, counts)
+  return counts
+
+
+def get_tagged_courses(tag, count=20, cursor=None):
+  """Lists the courses at the heads of trunks, having a tag.
+
+  Only the current heads are looked at, through the metadata cached on the
+  trunks by TrunkModel.copyHeadInfo(); one query returns a page.
+
+  Args:
+    tag: The tag.
+    count: Maximum number of courses to return.
+    cursor: Cursor returned for the previous page, if any.
+  Returns:
+    (entries, cursor, at_end): entries is a list of dicts with 'title',
+    'trunk_id' and 'doc_id' keys, most recent head first, cursor resumes
+    after the last of them and at_end tells whether the page is the last
+    one. A full last page is followed by an empty one.
+  Raises:
+    db.BadValueError, db.BadRequestError: If cursor is not valid.
+  """
+  query = TrunkModel.all().filter('head_tags =', tag)
+  query.filter('head_label =', AllowedLabels.COURSE)
+  query.order('-head_created')
+  if cursor:
+    query.with_cursor(cursor)
+  page = query.fetch(count)
+  entries = [{
+      'title': trunk.title,
+      'trunk_id': str(trunk.key()),
+      'doc_id': trunk.head,
+      } for trunk in page]
+  return entries, query.cursor(), len(page) < count
+
+
+### Course outlines ###
+
+
+# Outlines by the key of the doc at their root, see _get_cached_tree(). An
+# outline is outdated by invalidate_trunk_head() on any trunk it includes.
+_OUTLINE_NAMESPACE = 'outline'
+cache.register(_OUTLINE_NAMESPACE)
+
+
+def _outline_page(doc):
+  """Returns the outline entry of doc, without its children."""
+  return {'doc_id': str(doc.key()),
+          'trunk_id': str(identity_map.ref_key(doc, 'trunk_ref')),
+          'title': doc.title,
+          'content': [],
+          }
+
+
+def _link_trunk_keys(links):
+  """Returns the trunk key each DocLinkModel points at, or None.
+
+  Links holding only a doc_ref are resolved with a single batched get.
+  """
+  pinned = [identity_map.ref_key(link, 'doc_ref') for link in links
+            if identity_map.ref_key(link, 'trunk_ref') is None]
+  identity_map.get([key for key in pinned if key is not None])
+
+  trunk_keys = []
+  for link in links:
+    trunk_key = identity_map.ref_key(link, 'trunk_ref')
+    if trunk_key is None:
+      doc_key = identity_map.ref_key(link, 'doc_ref')
+      doc = doc_key and identity_map.peek(doc_key)
+      if isinstance(doc, DocModel):
+        trunk_key = identity_map.ref_key(doc, 'trunk_ref')
+    trunk_keys.append(trunk_key)
+  return trunk_keys
+
+
+def get_outline(doc):
+  """Returns the outline of a document and the documents it links to.
+
+  The tree is built one depth at a time: the content of every document of a
+  level is fetched with one get, and the heads of every trunk linked from it
+  are resolved with one get_trunk_heads() call. A trunk linked from several
+  documents appears under each of them; links to an ancestor are skipped,
+  so cyclic links terminate.
+
+  The finished tree is cached until one of its trunks changes; callers must
+  not modify it.
+
+  Args:
+    doc: The DocModel at the root of the outline, usually a course.
+  Returns:
+    A dict with 'doc_id', 'trunk_id', 'title' and 'content', the latter
+    being the list of outlines of the linked documents, in order.
+  """
+  doc_key = str(doc.key())
+  outline = _get_cached_tree(_OUTLINE_NAMESPACE, doc_key)
+  if outline is not None:
+    return outline
+
+  outline = _outline_page(doc)
+  trunks = set([outline['trunk_id']])
+  # Each page comes with the trunks of its ancestors and its own.
+  level = [(outline, doc, frozenset([outline['trunk_id']]))]
+  while level:
+    contents = identity_map.get(
+        [key for _, d, _ in level for key in d.content])
+    links = []
+    parents = []
+    offset = 0
+    for page, d, ancestors in level:
+      for elem in contents[offset:offset + len(d.content)]:
+        if isinstance(elem, DocLinkModel):
+          links.append(elem)
+          parents.append((page, ancestors))
+      offset += len(d.content)
+
+    next_level = []
+    trunk_keys = _link_trunk_keys(links)
+    heads = get_trunk_heads([key for key in trunk_keys if key is not None])
+    heads.reverse()
+    for (page, ancestors), trunk_key in zip(parents, trunk_keys):
+      if trunk_key is None:
+        continue
+      head = heads.pop()
+      trunk = str(trunk_key)
+      trunks.add(trunk)
+      if head is None or trunk in ancestors:
+        continue
+      child = _outline_page(head)
+      page['content'].append(child)
+      next_level.append((child, head, ancestors.union([trunk])))
+    level = next_level
+
+  _set_cached_tree(_OUTLINE_NAMESPACE, doc_key, outline, list(trunks))
+  return outline
+
+
+### Course sequences ###
+
+# Reading orders by the key of the doc at their root, see _get_cached_tree().
+# A sequence is outdated by invalidate_trunk_head() on any trunk it includes.
+_SEQUENCE_NAMESPACE = 'sequence'
+cache.register(_SEQUENCE_NAMESPACE)
+
+
+def _load_link_tree(doc):
+  """Loads the heads reachable from doc through links, one depth at a time.
+
+  Args:
+    doc: The DocModel at the root.
+  Returns:
+    A (docs, elements) tuple. docs maps the key (string) of each trunk
+    reached to its head, that of doc's trunk to doc. elements maps the same
+    keys to the content of the doc, as a list holding the trunk key (string)
+    of each link and None for any other element.
+  """
+  root_trunk = str(identity_map.ref_key(doc, 'trunk_ref'))
+  docs = {root_trunk: doc}
+  elements = {}
+  level = [root_trunk]
+  while level:
+    contents = identity_map.get(
+        [key for trunk in level for key in docs[trunk].content])
+    links = [elem for elem in contents if isinstance(elem, DocLinkModel)]
+    link_trunks = iter(_link_trunk_keys(links))
+    linked = []
+    offset = 0
+    for trunk in level:
+      count = len(docs[trunk].content)
+      elements[trunk] = []
+      for elem in contents[offset:offset + count]:
+        if elem is None:
+          continue
+        if not isinstance(elem, DocLinkModel):
+          elements[trunk].append(None)
+          continue
+        trunk_key = link_trunks.next()
+        if trunk_key is None:
+          continue
+        trunk_key = str(trunk_key)
+        elements[trunk].append(trunk_key)
+        if trunk_key not in docs and trunk_key not in linked:
+          linked.append(trunk_key)
+      offset += count
+
+    level = []
+    for trunk, head in zip(linked, get_trunk_heads(linked)):
+      if head:
+        docs[trunk] = head
+        level.append(trunk)
+  return docs, elements
+
+
+def get_course_sequence(doc):
+  """Returns the reading order of a document and the documents below it.
+
+  The order is the one the "next" links follow: a pre-order walk of the
+  heads reached through links, in which a document comes again, with
+  came_from set to the child just read, when the link to that child is
+  followed by other material. A trunk linked from several documents is
+  walked under each of them; links to a trunk already being walked, i.e.
+  an ancestor, are skipped so that cyclic links terminate.
+
+  The result is cached until one of its trunks changes; callers must not
+  modify it.
+
+  Args:
+    doc: The DocModel at the root, usually a course.
+  Returns:
+    An (entries, positions) tuple. entries is the list of (trunk_id, doc_id,
+    parent_trunk_id, parent_id, came_from_id) tuples of key strings, the
+    last three being None when not applicable. positions maps (trunk_id,
+    parent_trunk_id, trunk id of came_from or None) to the index of the
+    first matching entry.
+  """
+  doc_key = str(doc.key())
+  sequence = _get_cached_tree(_SEQUENCE_NAMESPACE, doc_key)
+  if sequence is not None:
+    return sequence
+
+  docs, elements = _load_link_tree(doc)
+  entries = []
+  positions = {}
+  ancestors = set()
+
+  def enter(trunk, parent_trunk, parent_id):
+    ancestors.add(trunk)
+    doc_id = str(docs[trunk].key())
+    positions.setdefault((trunk, parent_trunk, None), len(entries))
+    entries.append((trunk, doc_id, parent_trunk, parent_id, None))
+    finished = None
+    for child in elements[trunk]:
+      if child is None:
+        if finished:
+          positions.setdefault((trunk, parent_trunk, finished), len(entries))
+          entries.append((trunk, doc_id, parent_trunk, parent_id,
+                          str(docs[finished].key())))
+          finished = None
+      elif child in docs and child not in ancestors:
+        enter(child, trunk, doc_id)
+        finished = child
+    ancestors.remove(trunk)
+
+  enter(str(identity_map.ref_key(doc, 'trunk_ref')), None, None)
+  sequence = (entries, positions)
+  # Linked trunks without a head are included, as they may get one.
+  trunks = set(docs)
+  for children in elements.itervalues():
+    trunks.update([child for child in children if child])
+  _set_cached_tree(_SEQUENCE_NAMESPACE, doc_key, sequence, list(trunks))
+  return sequence
+
 
 class TrunkRevisionModel(BaseContentModel):
   """Stores revision history associated with a trunk.
@@ -1072,12 +2188,27 @@ class DocLinkModel(BaseContentModel):
   def ident(self):
     return str(self.doc_ref.key())
 
+  def get_tip(self):
+    """Returns the DocModel at the tip of the trunk this link points at.
+
+    Resolved through the identity map, so repeated calls within a request
+    cost no datastore RPC.
+    """
+    trunk_key = identity_map.ref_key(self, 'trunk_ref')
+    if trunk_key is None:
+      doc = identity_map.get_ref(self, 'doc_ref')
+      if doc is None:
+        return None
+      trunk_key = identity_map.ref_key(doc, 'trunk_ref')
+    if trunk_key is None:
+      return None
+    return get_trunk_head(trunk_key)
+
   def get_title(self):
     """Grab the up-to-date title for the document"""
-    if self.trunk_ref:
-      doc = db.get(self.trunk_ref.head)
-      if doc and doc.title:
-        return doc.title
+    doc = self.get_tip()
+    if doc and doc.title:
+      return doc.title
 
     if self.doc_ref:
       return self.doc_ref.title
@@ -1085,6 +2216,147 @@ class DocLinkModel(BaseContentModel):
     return self.default_title
 
 
+class TrunkParents(BaseModel):
+  """Reverse link index: the trunks whose documents link to a trunk.
+
+  Keyed by the key (string) of the trunk. Holds one entry per parent trunk,
+  for the latest link from it, most recent first: the linking document and
+  its label. Entries are built from the DocLinkModel table the first time
+  a trunk is looked up, then kept current by add_links(), which every
+  function creating DocLinkModels calls.
+
+  The index also remembers the shortest path from the trunk up to a course,
+  see library.get_course_path(). Adding a parent to a trunk forgets its
+  path; the paths remembered for the trunks below may then no longer be
+  the shortest, but remain valid since links are never deleted.
+
+  Attributes:
+    parent_trunks: Keys of the parent trunks, most recently linked first.
+    parent_docs: Key of the linking document of each parent trunk.
+    parent_labels: Label of each of these documents.
+    course_path: Document keys from the course down to the trunk's parent,
+        as returned by library.get_course_path().
+    has_course_path: Whether course_path was computed.
+  """
+  parent_trunks = db.ListProperty(db.Key)
+  parent_docs = db.ListProperty(db.Key)
+  parent_labels = db.StringListProperty()
+  course_path = db.ListProperty(db.Key)
+  has_course_path = db.BooleanProperty(default=False)
+
+  # Maximum number of links read when building an entry.
+  MAX_LINKS = 1000
+
+  def parents(self):
+    """Returns the (trunk key, doc key, label) of each parent."""
+    return zip(self.parent_trunks, self.parent_docs, self.parent_labels)
+
+  def _add_parent(self, trunk_key, doc_key, label, latest=True):
+    """Records a link from doc_key, dropping older ones from trunk_key."""
+    if trunk_key in self.parent_trunks:
+      if not latest:
+        return
+      i = self.parent_trunks.index(trunk_key)
+      del self.parent_trunks[i], self.parent_docs[i], self.parent_labels[i]
+    if latest:
+      i = 0
+    else:
+      i = len(self.parent_trunks)
+    self.parent_trunks.insert(i, trunk_key)
+    self.parent_docs.insert(i, doc_key)
+    self.parent_labels.insert(i, label)
+
+  @classmethod
+  def _build(cls, trunk_key):
+    """Returns a new, unsaved entry for trunk_key, built from its links."""
+    query = DocLinkModel.all().filter('trunk_ref =', trunk_key).order(
+        '-created')
+    links = [link for link in query.fetch(cls.MAX_LINKS)
+             if identity_map.ref_key(link, 'from_doc_ref')]
+    from_docs = identity_map.get(
+        [identity_map.ref_key(link, 'from_doc_ref') for link in links])
+    entry = cls(key_name=str(trunk_key))
+    for link, from_doc in zip(links, from_docs):
+      from_trunk_key = identity_map.ref_key(link, 'from_trunk_ref')
+      if from_trunk_key and from_doc:
+        entry._add_parent(from_trunk_key, from_doc.key(), from_doc.label,
+                          latest=False)
+    return entry
+
+  @classmethod
+  def get_for_trunks(cls, trunk_keys):
+    """Fetches the entries of several trunks, building the missing ones.
+
+    Args:
+      trunk_keys: List of trunk keys.
+    Returns:
+      The list of entries, in the order of trunk_keys.
+    """
+    entries = identity_map.get(
+        [db.Key.from_path(cls.kind(), str(key)) for key in trunk_keys])
+    built = []
+    for i, trunk_key in enumerate(trunk_keys):
+      if entries[i] is None:
+        entries[i] = cls._build(trunk_key)
+        built.append(entries[i])
+    if built:
+      db.put(built)
+      identity_map.add(built)
+    return entries
+
+  @classmethod
+  def add_links(cls, links):
+    """Records new links in the entries of the trunks they point at.
+
+    Trunks without an entry yet are skipped; their entry is built from the
+    links, these included, when first needed. Each entry is updated in a
+    transaction of its own, so that concurrent saves do not drop parents.
+
+    Args:
+      links: List of newly written DocLinkModels.
+    """
+    by_trunk = {}
+    for link in links:
+      trunk_key = identity_map.ref_key(link, 'trunk_ref')
+      if trunk_key and identity_map.ref_key(link, 'from_trunk_ref'):
+        by_trunk.setdefault(str(trunk_key), []).append(link)
+    if not by_trunk:
+      return
+    from_doc_keys = [identity_map.ref_key(link, 'from_doc_ref')
+                     for link in links]
+    from_docs = dict((str(doc.key()), doc) for doc in identity_map.get(
+        [key for key in from_doc_keys if key]) if doc)
+
+    def txn(trunk, parents):
+      entry = cls.get_by_key_name(trunk)
+      if entry is None:
+        return None
+      for from_trunk_key, from_doc in parents:
+        entry._add_parent(from_trunk_key, from_doc.key(), from_doc.label)
+      entry.course_path = []
+      entry.has_course_path = False
+      entry.put()
+      return entry
+
+    for trunk, trunk_links in by_trunk.iteritems():
+      parents = []
+      for link in trunk_links:
+        from_doc = from_docs.get(
+            str(identity_map.ref_key(link, 'from_doc_ref')))
+        if from_doc:
+          parents.append((identity_map.ref_key(link, 'from_trunk_ref'),
+                          from_doc))
+      if parents:
+        db.run_in_transaction(txn, trunk, parents)
+
+
+def _index_new_links(entities):
+  """Adds the DocLinkModels among newly written entities to TrunkParents."""
+  links = [e for e in entities if isinstance(e, DocLinkModel)]
+  if links:
+    TrunkParents.add_links(links)
+
+
 class VideoModel(BaseContentModel):
   """Stores video id and optional size configuration.
 
@@ -1168,6 +2440,37 @@ class QuizModel(BaseContentModel):
     else:
       return 0
 
+  # Number of quizzes per 'IN' filter; the datastore allows at most 30.
+  _SCORES_QUERY_SIZE = 30
+
+  @classmethod
+  def get_scores(cls, user, quizzes):
+    """Returns the progress scores of several quizzes, like get_score().
+
+    Runs one query per _SCORES_QUERY_SIZE quizzes, over the
+    QuizProgressState entities of user for these quizzes only, rather than
+    one per quiz.
+
+    Args:
+      user: User whose scores are fetched.
+      quizzes: List of saved QuizModel entities.
+    Returns:
+      A dict mapping the key (string) of each quiz to its score.
+    """
+    latest = dict((str(quiz.key()), (None, 0)) for quiz in quizzes)
+    quiz_keys = [db.Key(key) for key in latest]
+    for i in range(0, len(quiz_keys), cls._SCORES_QUERY_SIZE):
+      query = QuizProgressState.all().filter('user =', user).filter(
+          'quiz_ref IN', quiz_keys[i:i + cls._SCORES_QUERY_SIZE])
+      for quiz_state in query:
+        quiz_key = str(QuizProgressState.quiz_ref.get_value_for_datastore(
+            quiz_state))
+        if (latest[quiz_key][0] is None or
+            latest[quiz_key][0] <= quiz_state.time_stamp):
+          latest[quiz_key] = (quiz_state.time_stamp,
+                              quiz_state.progress_score)
+    return dict((key, score) for key, (time_stamp, score) in latest.items())
+
 
 class ComparableSequenceElem(object):
   """An element in a comparable sequence.
@@ -1292,8 +2595,7 @@ class WidgetModel(BaseContentModel):
     except (db.NotSavedError, AttributeError):
       raise InvalidWidgetError('Widget is not valid: it has not been saved')
 
-    widget_state = WidgetProgressState.all().filter('user =', user).filter(
-      'widget_ref =', widget_key).order('-time_stamp').get()
+    widget_state = WidgetProgressState.get_for(user, widget_key)
 
     if widget_state:
       return widget_state.progress_score
@@ -1311,12 +2613,358 @@ class DocVisitState(UserStateModel):
     doc_progress_score: Completion score for the visited doc.
     dirty_bit: Dirty bit is set when the scores down the trunk
       may be stale.
+    score_total: Sum of the scores of the scorable elements of the doc, as
+      used for progress_score. See library.add_to_doc_score().
+    score_count: Number of scorable elements summed in score_total, or 0 if
+      the sum has not been computed.
   """
+  KEY_REFS = ('trunk_ref',)
+  WRITE_BEHIND = True
+
   trunk_ref = db.ReferenceProperty(TrunkModel)
   doc_ref = db.ReferenceProperty(DocModel)
   last_visit = db.DateTimeProperty(auto_now=True)
   progress_score = db.RatingProperty(default=0)
   dirty_bit = db.BooleanProperty(default=False)
+  score_total = db.IntegerProperty(default=0)
+  score_count = db.IntegerProperty(default=0)
+
+  def put(self):
+    """Writes the state, then records its trunk in VisitedTrunks.
+
+    The user's CourseProgress records are not updated, only marked as
+    possibly outdated (see CourseProgress.bump_generation()); writes meant to
+    show in them at once go through library.put_visit_states().
+    """
+    key = super(DocVisitState, self).put()
+    user = self.user or users.get_current_user()
+    trunk_key = identity_map.ref_key(self, 'trunk_ref')
+    if trunk_key:
+      VisitedTrunks.record(user, [trunk_key])
+    CourseProgress.bump_generation(user)
+    return key
+
+
+# Users whose VisitedTrunks filter may lack trunks, by key name of the filter;
+# see VisitedTrunks.record(). Shared by all instances, so memcache only.
+_STALE_FILTER_NAMESPACE = 'stale_visited_trunks'
+cache.register(_STALE_FILTER_NAMESPACE, local=False)
+
+
+class VisitedTrunks(UserStateModel):
+  """Bloom filter of the trunks a user has a DocVisitState for.
+
+  Most links of a course page point at trunks the user never opened; asking
+  may_have_visited() first saves the DocVisitState get for those. The filter
+  has false positives, about 1% with NUM_BITS / 10 trunks recorded and more
+  past that, which only cost the get. DocVisitState.put() and
+  library.put_doc_score() record the trunk of each state they write; when
+  that cannot be stored the filter is marked stale instead, and rebuilt
+  from the DocVisitState entities when next read.
+
+  The filter of a user is read once per request through the identity map.
+  Users whose visits predate it get theirs built from their DocVisitState
+  entities on first use.
+
+  Attributes:
+    bits: The NUM_BITS bits of the filter, little-endian within each byte.
+  """
+  KEY_REFS = ()
+  NUM_BITS = 1 << 14
+  NUM_HASHES = 7
+  # DocVisitState keys read per query when a filter is rebuilt.
+  REBUILD_BATCH_SIZE = 500
+
+  bits = db.BlobProperty()
+
+  @classmethod
+  def _positions(cls, trunk):
+    """Returns the bit positions of trunk, by double hashing its key."""
+    h1, h2 = struct.unpack('<II', md5.new(str(trunk)).digest()[:8])
+    return [(h1 + i * h2) % cls.NUM_BITS for i in range(cls.NUM_HASHES)]
+
+  def contains(self, trunk):
+    """Returns False if trunk was surely never added, True if it may be."""
+    for position in self._positions(trunk):
+      if not ord(self.bits[position >> 3]) & (1 << (position & 7)):
+        return False
+    return True
+
+  def _add(self, trunks):
+    """Sets the bits of trunks. Returns whether any bit changed."""
+    bits = array.array('B', self.bits or '\0' * (self.NUM_BITS >> 3))
+    changed = False
+    for trunk in trunks:
+      for position in self._positions(trunk):
+        mask = 1 << (position & 7)
+        if not bits[position >> 3] & mask:
+          bits[position >> 3] |= mask
+          changed = True
+    if changed or not self.bits:
+      self.bits = db.Blob(bits.tostring())
+    return changed
+
+  @classmethod
+  def _update(cls, user, trunks):
+    """Adds trunks to the stored filter of user in a transaction.
+
+    Returns:
+      The stored filter, created if there was none.
+    """
+    key_name = cls.key_name_for(user)
+
+    def txn():
+      visited = cls.get_by_key_name(key_name)
+      if visited is None:
+        visited = cls.new_for(user)
+      if visited._add(trunks) or not visited.is_saved():
+        visited.put()
+      return visited
+
+    return db.run_in_transaction(txn)
+
+  @classmethod
+  def _visited_trunks(cls, user):
+    """Returns the trunks user has a DocVisitState for.
+
+    The states are queried keys only, REBUILD_BATCH_SIZE at a time, and the
+    trunk is read from their key name. Only states still under a random key
+    name (see library.rekey_user_states()) are fetched for their trunk_ref.
+
+    Returns:
+      A list of trunk keys or key strings.
+    """
+    prefix = cls.key_name_for(user) + '|'
+    trunks = []
+    last_key = None
+    while True:
+      query = DocVisitState.all(keys_only=True).filter('user =', user)
+      if last_key:
+        query.filter('__key__ >', last_key)
+      keys = query.order('__key__').fetch(cls.REBUILD_BATCH_SIZE)
+      if not keys:
+        return trunks
+      unkeyed = []
+      for key in keys:
+        if key.name() and key.name().startswith(prefix):
+          trunks.append(key.name()[len(prefix):])
+        else:
+          unkeyed.append(key)
+      trunks.extend(identity_map.ref_key(visit_state, 'trunk_ref')
+                    for visit_state in db.get(unkeyed) if visit_state)
+      last_key = keys[-1]
+
+  @classmethod
+  def get_filter(cls, user):
+    """Returns the filter of user, building it if there is none yet.
+
+    Args:
+      user: A users.User; callers must handle anonymous users themselves.
+    """
+    key = cls.key_for(user)
+    visited = identity_map.peek(key)
+    if visited is None:
+      visited = cls.get_by_key_name(key.name())
+      if (visited is None or
+          cache.get(_STALE_FILTER_NAMESPACE, key.name())):
+        cache.delete(_STALE_FILTER_NAMESPACE, key.name())
+        # The query only sees the visit states written so far.
+        write_behind.flush_pending()
+        visited = cls._update(user, cls._visited_trunks(user))
+      identity_map.add(visited)
+    return visited
+
+  @classmethod
+  def may_have_visited(cls, user, trunk):
+    """Returns False if user surely has no DocVisitState for trunk.
+
+    Args:
+      user: A users.User, or None.
+      trunk: Trunk key or key string.
+    """
+    if user is None:
+      return False
+    return cls.get_filter(user).contains(trunk)
+
+  @classmethod
+  def record(cls, user, trunks):
+    """Adds trunks to the filter of user, unless they are in it already.
+
+    This is best effort. Inside a transaction (the filter is in an entity
+    group of its own) or if the filter cannot be written, the trunks are
+    only added to the copy of this request and the stored filter is marked
+    stale, so that get_filter() rebuilds it.
+
+    Args:
+      user: A users.User, or None for no-op.
+      trunks: List of trunk keys or key strings.
+    """
+    if user is None:
+      return
+    if not db.is_in_transaction():
+      try:
+        visited = cls.get_filter(user)
+        trunks = [trunk for trunk in trunks if not visited.contains(trunk)]
+        if trunks:
+          identity_map.add(cls._update(user, trunks))
+        return
+      except db.Error, e:
+        logging.warning('Could not record visited trunks: %s', e)
+    key = cls.key_for(user)
+    cache.set_value(_STALE_FILTER_NAMESPACE, key.name(), True)
+    visited = identity_map.peek(key)
+    if visited is not None:
+      visited._add(trunks)
+
+
+# Memcache namespace of the progress generations of users: counters bumped by
+# every DocVisitState write, by which a CourseProgress record tells whether
+# it may be outdated.
+_PROGRESS_GENERATION_NAMESPACE = 'demo.progress_generation'
+
+
+class CourseProgress(UserStateModel):
+  """Progress of a user through the pages of one course, in one entity.
+
+  Maps the trunks of the course to the revision last visited, its score, the
+  time of the visit and a dirty flag, like the DocVisitState of each trunk
+  does, so that a whole course loads with a single get. The map is kept in
+  parallel arrays packed into unindexed properties; use get_entry() and
+  set_entry() rather than the properties.
+
+  Visit states written through library.put_visit_states() are copied into
+  the records of the courses on their visit path as they are written (see
+  library.update_progress_records()). A visit state may also belong to other
+  courses, e.g. a module shared by two of them, so every write of a
+  DocVisitState bumps the progress generation of its user, and a record
+  whose generation differs is brought up to date by
+  library.get_progress_record() before use. A missing record is built from
+  the visit states, also by library.get_progress_record().
+
+  Attributes:
+    course_trunk_ref: Trunk of the course.
+    trunk_ids: Newline separated trunk keys.
+    doc_ids: Newline separated keys of the revisions last visited.
+    packed_scores: array('B') of the scores.
+    packed_visits: array('d') of the last visits, in seconds since the epoch.
+    packed_dirty_bits: array('B') of the dirty flags.
+    generation: Progress generation of the user (see get_generation()) the
+      entries are up to date with.
+  """
+  KEY_REFS = ('course_trunk_ref',)
+  WRITE_BEHIND = True
+
+  course_trunk_ref = db.ReferenceProperty(TrunkModel)
+  generation = db.IntegerProperty(default=0, indexed=False)
+  trunk_ids = db.TextProperty(default='')
+  doc_ids = db.TextProperty(default='')
+  packed_scores = db.BlobProperty(default='')
+  packed_visits = db.BlobProperty(default='')
+  packed_dirty_bits = db.BlobProperty(default='')
+
+  def _unpack(self):
+    """Returns the arrays of the map, unpacking them on first use."""
+    unpacked = getattr(self, '_unpacked', None)
+    if unpacked is None:
+      trunk_ids = self.trunk_ids and self.trunk_ids.split('\n') or []
+      doc_ids = self.doc_ids and self.doc_ids.split('\n') or []
+      scores = array.array('B', self.packed_scores)
+      visits = array.array('d', self.packed_visits)
+      dirty_bits = array.array('B', self.packed_dirty_bits)
+      index = dict((trunk_id, i) for i, trunk_id in enumerate(trunk_ids))
+      unpacked = self._unpacked = (index, trunk_ids, doc_ids, scores, visits,
+                                   dirty_bits)
+    return unpacked
+
+  @staticmethod
+  def get_generation(user):
+    """Returns the progress generation of user.
+
+    A generation evicted from memcache starts again from the current time in
+    milliseconds, so that it does not match the generation it replaces.
+
+    Returns:
+      The generation, or None if memcache is unavailable.
+    """
+    key_name = UserStateModel.key_name_for(user)
+    generation = memcache.get(key_name,
+                              namespace=_PROGRESS_GENERATION_NAMESPACE)
+    if generation is None:
+      memcache.add(key_name, int(time.time() * 1000),
+                   namespace=_PROGRESS_GENERATION_NAMESPACE)
+      generation = memcache.get(key_name,
+                                namespace=_PROGRESS_GENERATION_NAMESPACE)
+    return generation
+
+  @staticmethod
+  def bump_generation(user):
+    """Outdates the progress records of user, after a DocVisitState write.
+
+    Args:
+      user: A users.User, or None for no-op.
+    Returns:
+      The new generation, or None if there was none in memcache.
+    """
+    if user is None:
+      return None
+    return memcache.incr(UserStateModel.key_name_for(user),
+                         namespace=_PROGRESS_GENERATION_NAMESPACE)
+
+  def trunks(self):
+    """Returns the key strings of the trunks having an entry."""
+    return list(self._unpack()[1])
+
+  def get_entry(self, trunk):
+    """Returns the entry of a trunk.
+
+    Args:
+      trunk: Trunk key or key string.
+    Returns:
+      A (doc_id, score, last_visit, dirty_bit) tuple, or None if the trunk
+      has no entry. doc_id is None if the trunk was never visited, and
+      last_visit is a datetime.
+    """
+    index, trunk_ids, doc_ids, scores, visits, dirty_bits = self._unpack()
+    i = index.get(str(trunk))
+    if i is None:
+      return None
+    return (doc_ids[i] or None, scores[i],
+            datetime.datetime.utcfromtimestamp(visits[i]), bool(dirty_bits[i]))
+
+  def set_entry(self, trunk, doc_id, score, dirty_bit=False, last_visit=None):
+    """Adds or replaces the entry of a trunk.
+
+    Args:
+      trunk: Trunk key or key string.
+      doc_id: Key or key string of the revision visited, or '' if none.
+      score: Progress score, between 0 and 100.
+      dirty_bit: Whether the score may be stale.
+      last_visit: Time of the visit, as a UTC datetime; defaults to now.
+    """
+    index, trunk_ids, doc_ids, scores, visits, dirty_bits = self._unpack()
+    if last_visit is None:
+      visit = time.time()
+    else:
+      visit = calendar.timegm(last_visit.utctimetuple())
+    trunk = str(trunk)
+    i = index.get(trunk)
+    if i is None:
+      index[trunk] = len(trunk_ids)
+      trunk_ids.append(trunk)
+      doc_ids.append(str(doc_id))
+      scores.append(score)
+      visits.append(visit)
+      dirty_bits.append(dirty_bit)
+    else:
+      doc_ids[i] = str(doc_id)
+      scores[i] = score
+      visits[i] = visit
+      dirty_bits[i] = dirty_bit
+    self.trunk_ids = db.Text('\n'.join(trunk_ids))
+    self.doc_ids = db.Text('\n'.join(doc_ids))
+    self.packed_scores = db.Blob(scores.tostring())
+    self.packed_visits = db.Blob(visits.tostring())
+    self.packed_dirty_bits = db.Blob(dirty_bits.tostring())
 
 
 class QuizProgressState(UserStateModel):
@@ -1342,6 +2990,9 @@ class WidgetProgressState(UserStateModel):
     user_data: Opaque user data stored as a BlobProperty. This is per-user
         state to be persisted on behalf of the widget.
   """
+  KEY_REFS = ('widget_ref',)
+  WRITE_BEHIND = True
+
   widget_ref = db.ReferenceProperty(WidgetModel)
   progress_score = db.RatingProperty(default=0)
   time_stamp = db.DateTimeProperty(auto_now=True)
@@ -1359,6 +3010,8 @@ class AnnotationState(UserStateModel):
       and kept in text form.
     last_modified: Time for last modification.
   """
+  KEY_REFS = ('trunk_ref', 'doc_ref', 'object_ref')
+
   object_ref = db.ReferenceProperty(reference_class=None)
   trunk_ref = db.ReferenceProperty(TrunkModel, collection_name='annotation')
   doc_ref = db.ReferenceProperty(DocModel, collection_name='annotation')
@@ -1373,6 +3026,8 @@ class NotePadState(UserStateModel):
     object_ref: Reference to the NotePad object.
     notepad_data: User generated rich-text data.
   """
+  KEY_REFS = ('object_ref',)
+
   object_ref = db.ReferenceProperty(reference_class=NotePadModel)
   notepad_data = db.TextProperty()
 
@@ -1389,6 +3044,8 @@ class RecentCourseState(UserStateModel):
     course_score = Course progress state.
     last_visited_doc_ref = Doc last visited for the course.
   """
+  KEY_REFS = ('course_trunk_ref',)
+
   time_stamp = db.DateTimeProperty(auto_now=True)
   course_trunk_ref = db.ReferenceProperty(TrunkModel)
   course_doc_ref = db.ReferenceProperty(DocModel)
@@ -1402,16 +3059,51 @@ class TraversalPath(UserStateModel):
   Sequential list of doc_ids, referring to the path down the
   tree followed to reach the current doc.
 
-  NOTE(mukundjha): We no longer are required to store trunk ids,
-  because all the docs in the path are added based on the history.
+  The trunk of each doc is kept alongside, so that cycle checks, scores
+  and links along the path need not fetch the docs. Change the path with
+  set_path(); paths stored before path_trunks existed are completed by
+  trunk_keys(), see library.backfill_path_trunks().
 
   Attributes:
     current_doc: Id for the document for which path is stored.
     path: Ordered list of doc_ids.
+    path_trunks: Trunk key of each doc in path.
   """
+  KEY_REFS = ('current_trunk',)
+
   current_doc = db.ReferenceProperty(DocModel)
   current_trunk = db.ReferenceProperty(TrunkModel)
   path = db.ListProperty(db.Key)
+  path_trunks = db.ListProperty(db.Key)
+
+  def set_path(self, path, trunks=None):
+    """Replaces the path.
+
+    Args:
+      path: List of doc keys.
+      trunks: Trunk key of each doc, if known; else resolved on put().
+    """
+    self.path = path
+    self.path_trunks = trunks or []
+
+  def trunk_keys(self):
+    """Returns the trunk key of each doc in the path.
+
+    Missing trunks are resolved with a single get of the docs; docs that no
+    longer exist yield None.
+    """
+    if len(self.path_trunks) == len(self.path):
+      return self.path_trunks
+    trunks = [doc and identity_map.ref_key(doc, 'trunk_ref')
+              for doc in identity_map.get(self.path)]
+    if None not in trunks:
+      self.path_trunks = trunks
+    return trunks
+
+  def put(self):
+    """Writes the path, resolving path_trunks first if needed."""
+    self.trunk_keys()
+    return super(TraversalPath, self).put()
 
 
 class VideoState(UserStateModel):
@@ -1421,6 +3113,8 @@ class VideoState(UserStateModel):
     video_ref : Id for the video object
     paused_time: Float value for seconds.
   """
+  KEY_REFS = ('video_ref',)
+
   video_ref = db.ReferenceProperty(VideoModel)
   paused_time = db.FloatProperty(default=0)
 
@@ -1563,3 +3257,40 @@ class ChangesSeen(db.Model):
   user = db.UserProperty(auto_current_user_add=True, required=True)
   doc = db.ReferenceProperty(DocModel, required=True)
   timestamp = db.DateTimeProperty(required=True)
+
+
+class SearchPosting(db.Model):
+  """Entry of the search index: a term appears in the head of a trunk.
+
+  The posting list of a term is the set of its entries, found by querying
+  on term. Entries are keyed by key_name_for(), so that reindexing a trunk
+  overwrites or deletes them without a query. See demo.search.
+
+  Attributes:
+    term: The indexed term.
+    trunk: The trunk whose head document contains the term.
+    weight: How much the term counts in the document, see
+        search.tokenize_doc().
+  """
+  term = db.StringProperty(required=True)
+  trunk = db.ReferenceProperty(TrunkModel, required=True)
+  weight = db.IntegerProperty(default=1)
+
+  @staticmethod
+  def key_name_for(term, trunk_key):
+    """Returns the key name of the entry for term and trunk_key."""
+    return '%s|%s' % (term, trunk_key)
+
+
+class SearchTerms(db.Model):
+  """The terms a trunk is indexed under, keyed by the trunk key string.
+
+  Lets search.index_doc() find the postings to delete when the head of the
+  trunk changes.
+
+  Attributes:
+    doc_id: String value of the key of the indexed head document.
+    terms: The terms, in no particular order.
+  """
+  doc_id = db.StringProperty()
+  terms = db.StringListProperty(indexed=False)
@@ -0,0 +1,308 @@
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Full-text search over the documents at the heads of trunks.
+
+The title, tags and rich text (with markup stripped) of a head document are
+split into terms; each (term, trunk) pair is a models.SearchPosting entity,
+and models.SearchTerms remembers the terms of every indexed trunk so that
+they can be removed again when the head changes. TrunkModel.put() queues a
+task calling index_trunk() whenever the head of a trunk changes. Postings are written with
+batched puts and deletes, and entities are never shared between trunks, so
+indexing needs neither transactions nor queries.
+
+A search fetches the posting list of every query term, heaviest postings
+first and cached in memcache until a document containing the term is
+reindexed or for POSTINGS_TIME seconds at most, intersects them and ranks
+the trunks found by tf-idf.
+
+Everything is stored in the datastore and memcache, so it works on the
+development server and its stubs.
+
+Methods:
+  strip_html(): Returns the text of an HTML fragment.
+  tokenize(): Splits text into terms.
+  index_doc(): (Re)indexes the head document of a trunk.
+  index_trunk(): (Re)indexes the current head of a trunk.
+  index_batch(): Indexes the heads of a batch of trunks.
+  search(): Returns the trunks matching all the terms of a query.
+"""
+
+import htmlentitydefs
+import math
+import re
+
+from google.appengine.ext import db
+
+from common import cache
+import identity_map
+import models
+
+
+# Weight of an occurrence of a term, by where it occurs.
+TITLE_WEIGHT = 3
+TAG_WEIGHT = 2
+CONTENT_WEIGHT = 1
+
+# Terms shorter or longer than this are not indexed.
+MIN_TERM_LENGTH = 2
+MAX_TERM_LENGTH = 40
+
+# Maximum number of postings read per term; the postings of the longest
+# lists where the term weighs least are ignored.
+MAX_POSTINGS = 1000
+
+# Seconds a posting list stays cached. Bounds how long a list read while
+# the term was being reindexed can be served.
+POSTINGS_TIME = 600
+
+# Maximum number of entities per datastore put or delete.
+_BATCH_SIZE = 200
+
+# Posting lists by term, as (number of postings, list of (trunk key string,
+# weight)), and the number of indexed trunks under _DOCUMENT_COUNT_KEY.
+_POSTINGS_NAMESPACE = 'search.postings'
+cache.register(_POSTINGS_NAMESPACE)
+
+# Not a term, since terms are made of word characters only.
+_DOCUMENT_COUNT_KEY = ' documents'
+
+_TAG_RE = re.compile(r'<(script|style)\b.*?</\1\s*>|<[^>]*>',
+                     re.DOTALL | re.IGNORECASE)
+_ENTITY_RE = re.compile(r'&(#x[0-9a-f]+|#[0-9]+|[a-z]+);', re.IGNORECASE)
+_TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _replace_entity(match):
+  """Returns the character an HTML entity match stands for."""
+  name = match.group(1)
+  try:
+    if name[:2].lower() == '#x':
+      return unichr(int(name[2:], 16))
+    if name[0] == '#':
+      return unichr(int(name[1:]))
+    return unichr(htmlentitydefs.name2codepoint[name])
+  except (KeyError, ValueError, OverflowError):
+    return ' '
+
+
+def strip_html(html):
+  """Returns the text of an HTML fragment, unicode or UTF-8 encoded."""
+  if not isinstance(html, unicode):
+    html = unicode(html, 'utf-8', 'replace')
+  return _ENTITY_RE.sub(_replace_entity, _TAG_RE.sub(' ', html))
+
+
+def tokenize(text):
+  """Splits text into terms.
+
+  Args:
+    text: A unicode or UTF-8 encoded string.
+  Returns:
+    The list of lowercase terms, in order of occurrence, with repetitions.
+  """
+  if not isinstance(text, unicode):
+    text = unicode(text, 'utf-8', 'replace')
+  return [term for term in _TERM_RE.findall(text.lower())
+          if MIN_TERM_LENGTH <= len(term) <= MAX_TERM_LENGTH]
+
+
+def tokenize_doc(doc):
+  """Returns the weighted terms of a document.
+
+  Args:
+    doc: A DocModel.
+  Returns:
+    A dict mapping each term to the sum of the weights of its occurrences.
+  """
+  weights = {}
+
+  def add(text, weight):
+    for term in tokenize(text):
+      weights[term] = weights.get(term, 0) + weight
+
+  add(doc.title or '', TITLE_WEIGHT)
+  for tag in doc.tags:
+    add(tag, TAG_WEIGHT)
+  for element in identity_map.get(doc.content):
+    if isinstance(element, models.RichTextModel) and element.data:
+      add(strip_html(element.data), CONTENT_WEIGHT)
+  return weights
+
+
+def _in_batches(function, items):
+  """Calls function on consecutive slices of items, _BATCH_SIZE long."""
+  for start in range(0, len(items), _BATCH_SIZE):
+    function(items[start:start + _BATCH_SIZE])
+
+
+def index_doc(doc, trunk=None):
+  """Indexes doc as the head of its trunk, replacing what was indexed before.
+
+  Args:
+    doc: The DocModel at the head of the trunk.
+    trunk: The trunk or its key; defaults to the trunk of doc.
+  """
+  trunk_key = trunk or identity_map.ref_key(doc, 'trunk_ref')
+  if isinstance(trunk_key, db.Model):
+    trunk_key = trunk_key.key()
+  trunk_id = str(trunk_key)
+  weights = tokenize_doc(doc)
+
+  previous = models.SearchTerms.get_by_key_name(trunk_id)
+  old_terms = previous and set(previous.terms) or set()
+  removed = old_terms.difference(weights)
+
+  postings = [models.SearchPosting(
+      key_name=models.SearchPosting.key_name_for(term, trunk_id),
+      term=term, trunk=trunk_key, weight=weight)
+      for term, weight in weights.iteritems()]
+  _in_batches(db.put, postings)
+  _in_batches(db.delete, [
+      db.Key.from_path('SearchPosting',
+                       models.SearchPosting.key_name_for(term, trunk_id))
+      for term in removed])
+  models.SearchTerms(key_name=trunk_id, doc_id=str(doc.key()),
+                     terms=weights.keys()).put()
+  cache.delete_multi(_POSTINGS_NAMESPACE, list(old_terms.union(weights)))
+
+
+def index_trunk(trunk_key):
+  """Indexes the current head of a trunk, replacing what was indexed before.
+
+  Args:
+    trunk_key: Key or key string of the trunk.
+  Returns:
+    The head indexed, or None if the trunk has no head.
+  """
+  head = models.get_trunk_heads([db.Key(str(trunk_key))])[0]
+  if head:
+    index_doc(head, db.Key(str(trunk_key)))
+  return head
+
+
+def index_batch(start_key=None, batch_size=20):
+  """Indexes the heads of one batch of trunks.
+
+  Documents saved before the index existed cannot be found until their
+  trunk gets a new head. This indexes the heads of existing trunks.
+
+  Args:
+    start_key: Key to resume after, as returned by the previous call.
+    batch_size: Number of trunks to examine.
+
+  Returns:
+    (next_start_key, indexed), where next_start_key is None once all the
+    trunks have been processed and indexed is the number of heads indexed.
+  """
+  query = models.TrunkModel.all().order('__key__')
+  if start_key:
+    query.filter('__key__ >', db.Key(str(start_key)))
+  batch = query.fetch(batch_size)
+  if not batch:
+    return None, 0
+
+  heads = models.get_trunk_heads(batch)
+  # Fetches the contents of all the heads at once.
+  identity_map.get([key for head in heads if head for key in head.content])
+  indexed = 0
+  for trunk, head in zip(batch, heads):
+    if head:
+      index_doc(head, trunk)
+      indexed += 1
+  return batch[-1].key(), indexed
+
+
+def _get_postings(terms):
+  """Returns the posting lists of terms.
+
+  Returns:
+    A dict mapping each of terms to (count, postings): postings lists the
+    (trunk key string, weight) of the MAX_POSTINGS trunks where the term
+    weighs most, and count is the number of trunks containing the term.
+  """
+  postings = cache.get_multi(_POSTINGS_NAMESPACE, terms)
+  missing = {}
+  for term in terms:
+    if term not in postings:
+      query = models.SearchPosting.all().filter('term =', term).order(
+          '-weight')
+      found = [
+          (str(models.SearchPosting.trunk.get_value_for_datastore(posting)),
+           posting.weight)
+          for posting in query.fetch(MAX_POSTINGS)]
+      count = len(found)
+      if count == MAX_POSTINGS:
+        count = models.SearchPosting.all(keys_only=True).filter(
+            'term =', term).count()
+      missing[term] = (count, found)
+  if missing:
+    cache.set_multi(_POSTINGS_NAMESPACE, missing, expires=POSTINGS_TIME)
+    postings.update(missing)
+  return postings
+
+
+def _get_document_count():
+  """Returns the number of indexed trunks, cached for POSTINGS_TIME."""
+  count = cache.get(_POSTINGS_NAMESPACE, _DOCUMENT_COUNT_KEY)
+  if count is None:
+    count = models.SearchTerms.all(keys_only=True).count()
+    cache.set_value(_POSTINGS_NAMESPACE, _DOCUMENT_COUNT_KEY, count,
+                    expires=POSTINGS_TIME)
+  return count
+
+
+def search(query, limit=20):
+  """Finds the trunks whose head contains all the terms of query.
+
+  Args:
+    query: Text of the query.
+    limit: Maximum number of results.
+  Returns:
+    A list of dicts with 'title', 'trunk_id', 'doc_id' and 'score' keys,
+    best match first.
+  """
+  terms = list(set(tokenize(query)))
+  if not terms:
+    return []
+  postings = _get_postings(terms)
+  documents = _get_document_count()
+
+  # Intersect, starting from the shortest posting list.
+  terms.sort(key=lambda term: postings[term][0])
+  scores = None
+  for term in terms:
+    count, term_postings = postings[term]
+    idf = math.log(1.0 + float(documents) / max(count, 1))
+    previous = scores or {}
+    scores_with_term = {}
+    for trunk_id, weight in term_postings:
+      if scores is None or trunk_id in scores:
+        scores_with_term[trunk_id] = previous.get(trunk_id, 0) + weight * idf
+    scores = scores_with_term
+    if not scores:
+      return []
+
+  ranked = sorted(scores.iteritems(), key=lambda item: -item[1])[:limit]
+  trunks = identity_map.get([trunk_id for trunk_id, score in ranked])
+  results = []
+  for (trunk_id, score), trunk in zip(ranked, trunks):
+    if trunk and trunk.head:
+      results.append({
+          'title': trunk.title,
+          'trunk_id': trunk_id,
+          'doc_id': trunk.head,
+          'score': score,
+          })
+  return results
@@ -0,0 +1,94 @@
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""XML sitemaps, as described on sitemaps.org.
+
+A sitemap file may list at most MAX_URLS URLs and be at most MAX_BYTES long.
+generate() consumes an iterable of URLs and yields complete files as soon as
+the next URL would not fit, so the URLs are never all held in memory; sites
+needing more than one file publish them through a sitemap index, see
+generate_index().
+
+Methods:
+  generate(): Yields the sitemap files listing some URLs.
+  generate_index(): Returns the sitemap index listing sitemap files.
+"""
+
+from xml.sax import saxutils
+
+
+# Limits of a single file set by the sitemap protocol.
+MAX_URLS = 50000
+MAX_BYTES = 10 * 1024 * 1024
+
+_URLSET_HEAD = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+_URLSET_TAIL = '</urlset>\n'
+
+_INDEX_HEAD = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<sitemapindex '
+               'xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+_INDEX_TAIL = '</sitemapindex>\n'
+
+
+def _entry(tag, loc, lastmod):
+  """Returns the <url> or <sitemap> element of a location, UTF-8 encoded."""
+  parts = ['  <%s><loc>%s</loc>' % (tag, saxutils.escape(loc))]
+  if lastmod:
+    parts.append('<lastmod>%s</lastmod>' % lastmod.strftime('%Y-%m-%d'))
+  parts.append('</%s>\n' % tag)
+  entry = ''.join(parts)
+  if isinstance(entry, unicode):
+    entry = entry.encode('utf-8')
+  return entry
+
+
+def generate(urls, max_urls=MAX_URLS, max_bytes=MAX_BYTES):
+  """Yields the sitemap files listing urls.
+
+  Args:
+    urls: Iterable of (loc, lastmod) pairs, where loc is an absolute URL and
+        lastmod a datetime or None.
+    max_urls: Maximum number of URLs per file.
+    max_bytes: Maximum length of a file.
+  Yields:
+    The UTF-8 encoded files, in order. A single empty file is yielded if
+    urls is empty.
+  """
+  empty = len(_URLSET_HEAD) + len(_URLSET_TAIL)
+  entries = []
+  size = empty
+  for loc, lastmod in urls:
+    entry = _entry('url', loc, lastmod)
+    if entries and (len(entries) >= max_urls or
+                    size + len(entry) > max_bytes):
+      yield _URLSET_HEAD + ''.join(entries) + _URLSET_TAIL
+      entries = []
+      size = empty
+    entries.append(entry)
+    size += len(entry)
+  yield _URLSET_HEAD + ''.join(entries) + _URLSET_TAIL
+
+
+def generate_index(locations):
+  """Returns the sitemap index listing sitemap files.
+
+  Args:
+    locations: Iterable of the absolute URLs of the files.
+  Returns:
+    The UTF-8 encoded index.
+  """
+  return (_INDEX_HEAD +
+          ''.join([_entry('sitemap', loc, None) for loc in locations]) +
+          _INDEX_TAIL)
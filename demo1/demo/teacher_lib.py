@@ -119,6 +119,12 @@ def enroll_student(classroom, student_email):
   Returns:
     Account or ProvisionalAccount.
   """
+  return library.insert_with_new_key(
+      models.Enrollment, **_enrollment_values(classroom, student_email))
+
+
+def _enrollment_values(classroom, student_email):
+  """Returns the property values of a new Enrollment, see enroll_student()."""
   accounts = models.Account.get_accounts_for_email(student_email)
   if accounts:
     # TODO(vchen): What do we really do if there are more than one?
@@ -127,12 +133,11 @@ def enroll_student(classroom, student_email):
     account = models.ProvisionalAccount.get_or_create_account_for_email(
         student_email)
     account_key = _PROVISIONAL_PREFIX + account.key().name()
-  entry = library.insert_with_new_key(
-      models.Enrollment,
-      classroom=classroom,
-      account_key=account_key,
-      email=student_email)
-  return entry
+  return {
+      'classroom': classroom,
+      'account_key': account_key,
+      'email': student_email,
+      }
 
 
 def enroll_students(classroom, students):
@@ -161,11 +166,10 @@ def enroll_students(classroom, students):
     raise MaxEnrollmentError(
         'Total enrollment of %d would exceed maximum of %d. Please change the '
         'limit or remove some entries' % (total, classroom.max_enrollment))
-  new_entries = []
-  for email in new_students:
-    entry = enroll_student(classroom, email)
-    new_entries.append(entry)
-  return new_entries
+  # All the new Enrollment entries are written with a single put.
+  return library.insert_many_with_new_keys(
+      models.Enrollment,
+      [_enrollment_values(classroom, email) for email in new_students])
 
 
 def get_enrollment(classroom, enrolled_only=False):
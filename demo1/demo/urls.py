@@ -31,8 +31,10 @@ urlpatterns = defaults.patterns(
     (r'^submitEdits$', 'submit_edits'),
     (r'^temp$', 'temp'),
     (r'^fetchFromTags$', 'fetch_from_tags'),
+    (r'^search$', 'search_docs'),
     (r'^subjectsDemo$', 'subjectsDemo'),
     (r'^sitemap$', 'sitemap'),
+    (r'^sitemap\.xml$', 'sitemap_xml'),
 
     (r'^admin/upload$', 'upload_file'),
     (r'^admin/notifyAll$', 'notify_all'),
@@ -42,7 +42,6 @@ import random
 import re
 import urllib
 import urlparse
-import operator
 from cStringIO import StringIO
 from xml.etree import ElementTree
 
@@ -52,6 +51,7 @@ from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.api import urlfetch
 from google.appengine.api import xmpp
+from google.appengine.api.labs import taskqueue
 from google.appengine.ext import db
 from google.appengine.ext.db import djangoforms
 from google.appengine.runtime import DeadlineExceededError
@@ -75,8 +75,10 @@ from django.core.urlresolvers import reverse
 from common import subjects
 import constants
 import forms
+import identity_map
 import library
 import models
+import search
 import settings
 import upload
 import notify
@@ -380,6 +382,28 @@ def create_doc(data_dict):
     doc.tags = []
   doc.score_weight = [1.0]
 
+  # Warm the identity map with every doc, trunk and notepad referred to by
+  # the contents, so that the loop below does not fetch them one by one.
+  referred = []
+  for element in data_dict['doc_contents']:
+    if element.get('obj_type') == 'doc_link':
+      link = urlparse.urlparse(element.get('val'))
+      if link.query:
+        params = dict([query.split('=') for query in link.query.split('&')])
+        referred.extend([params.get('doc_id'), params.get('trunk_id')])
+    elif element.get('obj_type') == 'notepad':
+      referred.append(element.get('val'))
+  try:
+    identity_map.get([key for key in referred if key])
+  except db.BadKeyError:
+    pass  # Reported per element below.
+
+  # Content-addressed objects are collected as (model_class, kwargs) specs
+  # and inserted together; contents holds either a key or an index into
+  # specs.
+  specs = []
+  contents = []
+
   # Tracks the number of occurrences of the same widget with the same title
   # Keys are (widget_url, title) tuples.
   widget_index_map = {}
@@ -387,32 +411,33 @@ def create_doc(data_dict):
 
     if element.get('obj_type') == 'rich_text':
       text = element.get('val').encode('utf-8')
-      object = models.RichTextModel.insert(data=text)
-      doc.content.append(object.key())
+      contents.append(len(specs))
+      specs.append((models.RichTextModel, {'data': text}))
 
     elif element.get('obj_type') == 'video':
       video_id = element.get('val').encode('utf-8').strip()
       title = element.get('title').encode('utf-8')
       height = str(element.get('height'))
       width = str(element.get('width'))
-      object = models.VideoModel.insert(video_id=video_id, width=width,
-                                        height=height, title=title)
-      doc.content.append(object.key())
+      contents.append(len(specs))
+      specs.append((models.VideoModel, {
+          'video_id': video_id, 'width': width, 'height': height,
+          'title': title}))
 
     elif element.get('obj_type') == 'doc_link':
       link = urlparse.urlparse(element.get('val'))
       if link.query:
         params = dict([query.split('=') for query in link.query.split('&')])
 
-        referred_doc = db.get(params.get('doc_id'))
-        referred_trunk = db.get(params.get('trunk_id'))
-
-        doc_link_object = models.DocLinkModel.insert(
-            trunk_ref=referred_trunk.key(), doc_ref=referred_doc.key(),
-            default_title=referred_doc.title, from_trunk_ref=doc.trunk_ref.key(),
-            from_doc_ref=doc.key())
+        referred_doc, referred_trunk = identity_map.get(
+            [params.get('doc_id'), params.get('trunk_id')])
 
-        doc.content.append(doc_link_object.key())
+        contents.append(len(specs))
+        specs.append((models.DocLinkModel, {
+            'trunk_ref': referred_trunk.key(), 'doc_ref': referred_doc.key(),
+            'default_title': referred_doc.title,
+            'from_trunk_ref': identity_map.ref_key(doc, 'trunk_ref'),
+            'from_doc_ref': doc.key()}))
 
     elif element.get('obj_type') == 'widget':
       widget_url = element.get('val').encode('utf-8').strip()
@@ -425,39 +450,44 @@ def create_doc(data_dict):
       if is_shared_str.lower() in ('0', 'false'):
         is_shared = False
 
-      if is_shared:
-        widget_object = models.WidgetModel.insert(
-            widget_url=widget_url, height=height, width=width, title=title,
-            is_shared=is_shared)
-      else:
+      widget_args = {
+          'widget_url': widget_url, 'height': height, 'width': width,
+          'title': title, 'is_shared': is_shared}
+      if not is_shared:
         # Determine how many times the same (widget, title) has appeared on
         # the page
         index_key = (widget_url, title)
         widget_index = widget_index_map.setdefault(index_key, 0)
         widget_index_map[index_key] += 1
 
-        widget_object = models.WidgetModel.insert(
-            widget_url=widget_url, height=height, width=width, title=title,
-            is_shared=is_shared, widget_index=widget_index, trunk_id=trunk)
-      doc.content.append(widget_object.key())
+        widget_args['widget_index'] = widget_index
+        widget_args['trunk_id'] = trunk
+      contents.append(len(specs))
+      specs.append((models.WidgetModel, widget_args))
 
     elif element.get('obj_type') == 'notepad':
       try:
         key = element.get('val')
-        object = db.get(key)
+        object = identity_map.get(key)
       except db.BadKeyError:
         object = None
       if not object:
         object = models.NotePadModel.insert_with_new_key()
-      doc.content.append(object.key())
+      contents.append(object.key())
 
     else:
       raise UnknownContentTypeError("What kind of object is that??? %r" % element)
 
+  objects = models.BaseContentModel.insert_many(specs)
+  for content in contents:
+    if isinstance(content, int):
+      content = objects[content].key()
+    doc.content.append(content)
+
   doc.put()
 
   # If we are at the tip of a trunk, we would need to update cached data.
-  trunk = doc.trunk_ref
+  trunk = identity_map.get_ref(doc, 'trunk_ref')
   if trunk.head == str(doc.key()):
     trunk.setHead(str(doc.key()))
     trunk.put()
@@ -487,14 +517,29 @@ def index(request):
         break
 
   # Fetching the latest version
-  for entry in recently_finished + recently_touched:
-    entry.doc = library.fetch_doc(entry.trunk_ref.key())
-    doc_path_entry = models.TraversalPath.all().filter(
-      'current_trunk =', entry.trunk_ref).filter(
-      'user =', users.get_current_user()).get()
+  entries = recently_finished + recently_touched
+  trunk_keys = [identity_map.ref_key(entry, 'trunk_ref') for entry in entries]
+  heads = models.get_trunk_heads(trunk_keys)
+  # The template links to each doc through its trunk.
+  identity_map.prefetch_refs(heads, 'trunk_ref')
+  for entry, head in zip(entries, heads):
+    entry.doc = head
+  # Pages whose trunk lost its head are left out.
+  recently_finished = [entry for entry in recently_finished if entry.doc]
+  recently_touched = [entry for entry in recently_touched if entry.doc]
+  entries = recently_finished + recently_touched
+  trunk_keys = [identity_map.ref_key(entry, 'trunk_ref') for entry in entries]
+  path_entries = models.TraversalPath.get_by_key_name(
+      [models.TraversalPath.key_name_for(users.get_current_user(), trunk_key)
+       for trunk_key in trunk_keys])
+
+  # The docs of all the paths are resolved together.
+  paths = library.expand_paths([e for e in path_entries if e],
+                               users.get_current_user(), False)
+  paths.reverse()
+  for entry, doc_path_entry in zip(entries, path_entries):
     if doc_path_entry:
-      entry.path = library.expand_path(doc_path_entry.path, False, False,
-                                       users.get_current_user())
+      entry.path = paths.pop()
     else:
       entry.path = []
 
@@ -510,26 +555,29 @@ def index(request):
 
 
 def list_docs(request):
-  """Presents a list of existing document/module in the datastore.
+  """Presents a page of the documents in the datastore, one per trunk.
 
-  List is reverse sorted by creation date and includes all the documents.
+  Args:
+    order: 'created' (newest first, the default) or 'title'.
+    cursor: resume after the page that returned this cursor.
   TODO(mukundjha): Move this function to another module.
   """
-  doc_list = []
-  seen = {}
-  for doc in models.DocModel.all():
-    t = doc.trunk_ref
-    k = t.key()
-    if k not in seen:
-      seen[k] = t.head
-      d = db.get(t.head)
-      doc_list.append({
-          'doc': d,
-          'trunk_id': str(k),
-          'doc_id': str(d.key()),
-          })
+  order = request.REQUEST.get('order', 'created')
+  if order not in models.TRUNK_LIST_ORDERS:
+    order = 'created'
+  cursor = request.REQUEST.get('cursor') or None
+  try:
+    doc_list, next_cursor, at_end = models.get_trunk_list(order,
+                                                          cursor=cursor)
+  except (db.BadValueError, db.BadRequestError):
+    doc_list, next_cursor, at_end = models.get_trunk_list(order)
+    cursor = None
   return respond(request, constants.DEFAULT_TITLE, "list.html",
-        {'data': doc_list})
+        {'data': doc_list,
+         'order': order,
+         'first_page': not cursor,
+         'next_cursor': not at_end and next_cursor or None,
+        })
 
 
 def _ReadTemplate(template):
@@ -604,7 +652,7 @@ def edit(request):
        'doc_contents': doc_contents,
        'data_valid_range': constants.VALID_GRADE_RANGE,
        'doc_id': str(doc.key()),
-       'trunk_id': str(doc.trunk_ref.key()),
+       'trunk_id': str(identity_map.ref_key(doc, 'trunk_ref')),
        'tags': tags,
        'allowed_labels': models.AllowedLabels.dump_to_list(),
        })
@@ -629,7 +677,7 @@ def duplicate(request):
   clone = doc.clone()
   clone.setClonedTitle()
   clone.placeInNewTrunk()
-  goto_trunk = clone.trunk_ref.key()
+  goto_trunk = identity_map.ref_key(clone, 'trunk_ref')
   goto_id = clone.key()
 
   parent_trunk = request.GET.get('parent_trunk')
@@ -707,9 +755,15 @@ def view_doc(request):
     return HttpResponse("No such document exists", status=404)
 
 
+  # A course page reads the progress of all its pages from a single entity.
+  progress = None
+  if doc.label == models.AllowedLabels.COURSE:
+    progress = library.get_progress_record(users.get_current_user(), doc)
+
   doc_contents = library.get_doc_contents(
       doc, users.get_current_user(), resolve_links=True,
-      use_history=use_history, fetch_score=True, fetch_video_state=True)
+      use_history=use_history, fetch_score=True, fetch_video_state=True,
+      progress=progress)
 
   current_doc_score = doc.get_score(users.get_current_user())
 
@@ -723,7 +777,7 @@ def view_doc(request):
   if current_doc_score == 100:
     library.put_doc_score(doc, users.get_current_user(), 100)
     doc_score = 100
-  trunk = doc.trunk_ref
+  trunk_key = identity_map.ref_key(doc, 'trunk_ref')
 
   if parent_trunk:
     parent = library.fetch_doc(parent_trunk, parent_id)
@@ -738,19 +792,25 @@ def view_doc(request):
   if doc.label == models.AllowedLabels.COURSE:
     library.update_recent_course_entry(doc, doc,
                                        users.get_current_user())
+  traversed_path = []
   if updated_stack.path:
-    traversed_path = library.expand_path(updated_stack.path, use_history,
-                                         use_absolute_mapping_for_path,
-                                         users.get_current_user())
+    try:
+      traversed_path = library.expand_path(updated_stack.path,
+                                           users.get_current_user(),
+                                           use_history,
+                                           use_absolute_mapping_for_path,
+                                           trunks=updated_stack.trunk_keys())
+    except models.InvalidDocumentError:
+      # A doc on the path was deleted or lost its head; show no breadcrumb.
+      logging.warning('Cannot expand the path to %s', doc.key())
+  if traversed_path and traversed_path[0]:
     root_doc = traversed_path[0]
     if root_doc.label == models.AllowedLabels.COURSE:
       library.update_recent_course_entry(doc, root_doc,
                                          users.get_current_user())
-  else:
-    traversed_path = []
 
   if came_from:
-    came_from = db.get(came_from)
+    came_from = identity_map.get(came_from)
   (prev_url, next_url) = library.getPrevNextLinks(doc, updated_stack, came_from)
   if prev_url:
     prev_url = '/view?' + urllib.urlencode(prev_url)
@@ -775,11 +835,12 @@ def view_doc(request):
             'prev': prev_url,
             'mainmenu': 1,
             'doc_id': "%s" % doc.key(),
-            'trunk_id': "%s" % trunk.key(),
+            'trunk_id': "%s" % trunk_key,
             }
   if parent:
     params['parent_id'] = "%s" % parent.key();
-    params['parent_trunk_id'] = "%s" % parent.trunk_ref.key();
+    params['parent_trunk_id'] = "%s" % identity_map.ref_key(parent,
+                                                            'trunk_ref');
 
   return respond(request, title, "view.html", params);
 
@@ -787,13 +848,14 @@ def view_doc(request):
 def history(request):
   """Show revisions of a given trunk"""
   trunk_id = request.GET.get('trunk_id')
-  trunk = db.get(trunk_id)
+  trunk = identity_map.get(trunk_id)
   data = []
   revs = [i.obj_ref
           for i in models.TrunkRevisionModel.all().ancestor(trunk).order('-created')]
-  for it, previous in itertools.izip(revs, revs[1:] + [None]):
+  rev_docs = identity_map.get(revs)
+  for it, previous, doc in itertools.izip(revs, revs[1:] + [None], rev_docs):
     datum = {
-        'doc': db.get(it),
+        'doc': doc,
         'previous': previous,
     }
     data.append(datum)
@@ -810,13 +872,12 @@ def changes(request):
   trunk_id = request.GET.get('trunk_id')
   preKey = request.GET.get('pre')
   postKey = request.GET.get('post')
-  pre = db.get(preKey)
-  post = db.get(postKey)
+  pre, post = identity_map.get([preKey, postKey])
   text = library.show_changes(pre, post)
   prevpair = None
   nextpair = None
 
-  trunk = db.get(trunk_id)
+  trunk = identity_map.get(trunk_id)
   revs = [i.obj_ref
           for i in models.TrunkRevisionModel.all().ancestor(trunk).order(
               '-created')]
@@ -848,7 +909,7 @@ def submit_edits(request):
   if not doc:
     return HttpResponse("Error in creating document", status=404)
   else:
-    trunk = doc.trunk_ref
+    trunk = identity_map.get_ref(doc, 'trunk_ref')
     library.auto_subscribe(users.get_current_user(), trunk)
 
     # redirect to view mode
@@ -864,7 +925,7 @@ def get_session_for_widget(request):
   NOTE: BadKeyError was not checked on purpose, so that exception is raised.
   """
   widget_id = request.GET.get('widget_id')
-  widget = db.get(widget_id)
+  widget = identity_map.get(widget_id)
 
   session = library.get_or_create_session(widget, users.get_current_user())
   if session:
@@ -918,9 +979,10 @@ def update_doc_score(request):
   """Updates score for the widget and the doc and returns updated doc score.
 
   Function receives updated status (both score and progress) from widget and
-  updates score record for associated user and widget. It also recomputes
-  accumulated score for the document from which updates are recieved and
-  sends back updated score for the document.
+  updates score record for associated user and widget. It also applies the
+  change to the score of the document from which updates are recieved and of
+  its parents (see library.add_to_doc_score()), and sends back updated score
+  for the document.
 
   NOTE(mukundjha): Doc id passed to the widget is of the same doc that is
   presented to the user, so we can use absolute binding to update the score.
@@ -949,17 +1011,14 @@ def update_doc_score(request):
   parent_trunk =  request.GET.get('parent_trunk')
   parent_doc = request.GET.get('parent_doc')
 
-  widget = db.get(widget_id)
-  library.put_widget_score(widget, users.get_current_user(), progress)
+  widget = identity_map.get(widget_id)
+  previous = library.put_widget_score(widget, users.get_current_user(),
+                                      progress)
 
   # Using absolute addressing
   doc = library.fetch_doc(trunk_id, doc_id)
-  doc_contents = library.get_doc_contents_simple(doc, users.get_current_user())
-
-  # No recursive
-  doc_score = library.get_accumulated_score(doc, users.get_current_user(),
-                                            doc_contents)
-  library.set_dirty_bits_for_doc(doc, users.get_current_user())
+  doc_score = library.add_to_doc_score(doc, users.get_current_user(),
+                                       previous, progress)
 
   return HttpResponse(simplejson.dumps({'doc_score' : doc_score}))
 
@@ -1004,29 +1063,32 @@ def update_widget_session(request):
   progress = request.POST.get('progress')
   score = request.POST.get('score')
 
-  widget = db.get(widget_id)
+  widget = identity_map.get(widget_id)
   if progress:
-    library.put_widget_score(widget, users.get_current_user(), int(progress),
-                             user_data=user_data)
+    previous = library.put_widget_score(widget, users.get_current_user(),
+                                        int(progress), user_data=user_data)
     doc = library.fetch_doc(trunk_id, doc_id)
-    library.set_dirty_bits_for_doc(doc, users.get_current_user())
+    library.add_to_doc_score(doc, users.get_current_user(), previous,
+                             int(progress))
   else:  # Do not update progress
     library.put_widget_score(widget, users.get_current_user(), None,
                              user_data=user_data)
   return HttpResponse('True')
 
 
+@admin_required
 def update_trunk_title(request):
-  query = models.TrunkModel.all()
-  for trunk in query:
-    try:
-      head = db.get(trunk.head)
-      if not head or not isinstance(head, models.DocModel):
-        continue
-      trunk.title = head.title
-      trunk.put()
-    except BadKeyError:
-      pass
+  """Queues the copy of the head metadata onto every trunk, then lists them.
+
+  The task runs library.backfill_trunk_metadata() one batch per request, so
+  the listing does not include the trunks it has yet to reach. It is named,
+  so it is only ever queued once.
+  """
+  try:
+    taskqueue.add(name=library.BACKFILL_TRUNK_METADATA_TASK,
+                  url=library.BACKFILL_TRUNK_METADATA_URL)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
   return get_list_ajax(request)
 
 
@@ -1034,14 +1096,17 @@ def get_list_ajax(request):
   """Sends a list of documents present in data store.
 
   Useful in populating list for Link Picker while editing the document.
+  Reads models.TrunkTitleIndex only, and never writes.
 
   Args:
     q: limit the response with prefix match on titles
-    s: return the list starting at this index (i.e. skip this many)
+    s: index of the first entry returned; entries are skipped up to there
+      only when no cursor is given
     c: return only this many entries
+    cursor: resume after the page that returned this cursor
   """
-  query = models.TrunkModel.all()
-  search = request.REQUEST.get('q', '')
+  prefix = request.REQUEST.get('q', '')
+  cursor = request.REQUEST.get('cursor') or None
 
   def asInt(request, field, defval):
     try:
@@ -1051,49 +1116,28 @@ def get_list_ajax(request):
       val = defval
     return val
 
-  startAt = asInt(request, 's', 0)
+  startAt = max(asInt(request, 's', 0), 0)
   count = asInt(request, 'c', 8)
+  if count <= 0:
+    count = 8
 
-  if search != '':
-    query = query.filter("title >=", search)
-    query = query.filter("title <", search + u"\ufffd")
-  query.order("title")
-
-  doc_list = []
-  atEnd = 0
-  for trunk in query:
-    try:
-      head = db.get(trunk.head)
-      if not head or not isinstance(head, models.DocModel):
-        continue
-      doc_list.append({
-          'doc_title': head.title,
-          'trunk_id': str(trunk.key()),
-          'doc_id': str(head.key()),
-          })
-      # Self-correction.  For some unknown reason (NEEDSWORK),
-      # the index will go out of sync immediately after editing
-      # a document.
-      if True and (head.title != trunk.title):
-        trunk.title = head.title
-        trunk.put()
-    except db.BadKeyError:
-      pass
-    if startAt + count < len(doc_list):
-      break
-  else:
-    atEnd = 1
+  try:
+    entries, cursor, atEnd = models.TrunkTitleIndex.fetch_page(
+        prefix, count, cursor=cursor, offset=startAt)
+  except (db.BadValueError, db.BadRequestError):
+    # Stale or mangled cursor; fall back to skipping entries.
+    entries, cursor, atEnd = models.TrunkTitleIndex.fetch_page(
+        prefix, count, offset=startAt)
 
-  if startAt:
-    doc_list = doc_list[startAt:]
-  if count:
-    doc_list = doc_list[0:count]
+  doc_list = [{'doc_title': title, 'trunk_id': trunk_id, 'doc_id': doc_id}
+              for title, trunk_id, doc_id in entries]
 
   return HttpResponse(simplejson.dumps({
       'doc_list': doc_list,
       'startAt': startAt,
       'count': len(doc_list),
-      'atEnd': atEnd,
+      'atEnd': int(atEnd),
+      'cursor': cursor,
       }))
 
 
@@ -1108,7 +1152,7 @@ def new_document_ajax(request):
   one.placeInNewTrunk()
   result = {
       'doc_title': one.title,
-      'trunk_id': str(one.trunk_ref.key()),
+      'trunk_id': str(identity_map.ref_key(one, 'trunk_ref')),
       'doc_id': str(one.key()),
       };
   return HttpResponse(simplejson.dumps(result))
@@ -1142,23 +1186,38 @@ def xsrf_token(request):
 def fetch_from_tags(request):
   """Fetches courses with given tag.
 
-  TODO(mukundjha): Pick unique courses.
+  Args:
+    tag: the tag
+    cursor: resume after the page that returned this cursor
   """
   tag = request.GET.get('tag')
+  cursor = request.GET.get('cursor') or None
   course_list = []
-  courses = models.DocModel.all().filter('tags =', tag).filter(
-      'label =', models.AllowedLabels.COURSE).order('-created').fetch(20)
-  seen = {}
-  for doc in courses:
-    t = doc.trunk_ref
-    k = t.key()
-    if k not in seen:
-      seen[k] = t.head
-      d = db.get(t.head)
-      course_list.append(d)
+  next_cursor = None
+  if tag:
+    try:
+      course_list, next_cursor, at_end = models.get_tagged_courses(
+          tag, cursor=cursor)
+    except (db.BadValueError, db.BadRequestError):
+      course_list, next_cursor, at_end = models.get_tagged_courses(tag)
+    if at_end:
+      next_cursor = None
 
   return respond(request, constants.DEFAULT_TITLE, "course_list.html",
-                 {'course_list' : course_list, 'tag': tag})
+                 {'course_list' : course_list, 'tag': tag,
+                  'next_cursor': next_cursor,
+                  'tag_counts': models.get_tag_counts()})
+
+
+def search_docs(request):
+  """Lists the documents containing all the words of a query.
+
+  Args:
+    q: the query
+  """
+  query = request.GET.get('q', '')
+  return respond(request, constants.DEFAULT_TITLE, "search.html",
+                 {'query': query, 'results': search.search(query)})
 
 
 def subjectsDemo(request):
@@ -1200,8 +1259,9 @@ def mark_as_read(request):
   doc_id = request.GET.get('doc_id')
   doc = library.fetch_doc(trunk_id, doc_id)
 
+  previous = doc.get_score(users.get_current_user())
   library.put_doc_score(doc, users.get_current_user(), 100)
-  library.set_dirty_bits_for_doc(doc, users.get_current_user())
+  library.propagate_doc_score(doc, users.get_current_user(), previous, 100)
   return HttpResponse("True")
 
 
@@ -1210,17 +1270,10 @@ def store_video_state(request):
   video_id = request.GET.get('video_id')
   current_time = request.GET.get('current_time', 0.0)
 
-  video = db.get(video_id)
-  video_state = models.VideoState.all().filter(
-      'video_ref =', video).filter('user =', users.get_current_user()).get()
-
-  if video_state:
-    video_state.paused_time = float(current_time)
-    video_state.put()
-  else:
-    library.insert_with_new_key(
-        models.VideoState, video_ref=video, user=users.get_current_user(),
-        paused_time=float(current_time))
+  video_state = models.VideoState.get_or_new(users.get_current_user(),
+                                             video_id)
+  video_state.paused_time = float(current_time)
+  video_state.put()
   return HttpResponse('True')
 
 
@@ -1230,8 +1283,9 @@ def reset_score_for_page(request):
   doc_id = request.GET.get('doc_id')
   doc = library.fetch_doc(trunk_id, doc_id)
 
+  previous = doc.get_score(users.get_current_user())
   library.put_doc_score(doc, users.get_current_user(), 0)
-  library.set_dirty_bits_for_doc(doc, users.get_current_user())
+  library.propagate_doc_score(doc, users.get_current_user(), previous, 0)
   return HttpResponse("True")
 
 
@@ -1376,7 +1430,7 @@ def get_subscription(request):
   status = 'Subscribed?'
   try:
     data = simplejson.loads(request.POST.get('data'))
-    trunk = db.get(data.get('trunk_id'))
+    trunk = identity_map.get(data.get('trunk_id'))
     if notify.isPageWatched(request.user, trunk):
       status = 1
     else:
@@ -1403,7 +1457,7 @@ def update_subscription(request):
   errors = ''
   try:
     data = simplejson.loads(request.POST.get('data'))
-    trunk = db.get(data.get('trunk_id'))
+    trunk = identity_map.get(data.get('trunk_id'))
     status = data.get('status')
     result = notify.setSubscription(request.user, trunk, status)
   except Exception, e:
@@ -1417,11 +1471,10 @@ def update_subscription(request):
 def coursemap(request, course_trunk_id):
   """Show detailed map of a given course specified by its trunk id"""
   try:
-    course = db.get(course_trunk_id)
-    course = db.get(course.head)
-    if (not course) or (not isinstance(course, models.DocModel)):
-      raise BadKeyError('Not a course %r' % course)
-  except BadKeyError:
+    course = models.get_trunk_head(course_trunk_id)
+    if not course:
+      raise db.BadKeyError('Not a course %r' % course)
+  except db.BadKeyError:
     return HttpResponse('No such course', status=404)
   return respond(request, 'Course Map for %s' % course.title,
                  'coursemap.html', { 'data': course.outline() })
@@ -1433,24 +1486,25 @@ def sitemap(request):
   if course:
     return coursemap(request, course)
 
-  course = []
-  for trunk in models.TrunkModel.all():
-    try:
-      head = db.get(trunk.head)
-      if (not head) or (not isinstance(head, models.DocModel)):
-        continue
-      if head.label != models.AllowedLabels.COURSE:
-        continue
-      course.append({
-          'title': head.title,
-          'doc_id': str(head.key()),
-          'trunk_id': str(trunk.key()),
-          })
-    except BadKeyError:
-      pass
-  data = sorted(course, key=operator.itemgetter('title'))
   return respond(request, 'Site Map', "sitemap.html",
-                 { 'data': data })
+                 { 'data': models.get_course_catalog() })
+
+
+def sitemap_xml(request):
+  """XML sitemap of the courses, for crawlers.
+
+  Args:
+    part: Number of the sitemap file, when the site needs several; they are
+      listed by the sitemap index returned without it.
+  """
+  try:
+    part = int(request.GET.get('part', ''))
+  except ValueError:
+    part = None
+  rendered = library.get_sitemap(part)
+  if rendered is None:
+    return HttpResponse('No such sitemap', status=404)
+  return HttpResponse(rendered, mimetype='application/xml')
 
 
 # -------- Admin ----------
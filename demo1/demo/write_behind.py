@@ -0,0 +1,333 @@
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Write-behind buffer for user state entities that are rewritten often.
+
+Progress scores and visit timestamps are written on nearly every page view
+and AJAX call. While ENABLED, put() stores such entities in memcache only and
+lists them under the current FLUSH_INTERVAL-second bucket. A task enqueued
+once per bucket (task_process.FlushWrites) then writes everything listed
+there with batched puts. Repeated updates of an entity within a bucket cost
+a single datastore write. Entries listed after the flush of their bucket
+started get a task of their own.
+
+get() overlays the buffered entities on what the datastore holds, so readers
+see the latest values; UserStateModel.get_by_key_name() goes through it for
+the models that set WRITE_BEHIND. Once flushed, an entity's buffered copy is
+cleared and readers go back to the datastore. Queries only see buffered
+values once they are flushed; code rebuilding state from a query calls
+flush_pending() first.
+
+An entity written to the datastore directly must have its buffered copy
+dropped with discard(), or readers keep being served the copy and a later
+flush overwrites the update with it; UserStateModel.put() does so.
+
+Buffered writes are lost if memcache evicts both the entity and its entry in
+the bucket before the flush, which is why buffering is off unless ENABLED is
+set. Entities are flushed as encoded by put(), so auto_now properties keep
+the time of put() rather than that of the flush.
+
+Methods:
+  put(): Buffers entities, or writes them right away if not ENABLED.
+  get(): Drop-in replacement for db.get() that sees buffered entities.
+  discard(): Drops the buffered copies of entities written directly.
+  flush(): Writes the entities listed under a bucket.
+  flush_pending(): Writes all the entities still buffered.
+"""
+
+import logging
+import time
+
+from google.appengine.api import datastore
+from google.appengine.api import memcache
+from google.appengine.api.labs import taskqueue
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import db
+
+
+# Whether put() buffers writes at all. Off by default, as buffered writes
+# can be lost to memcache evictions; deployments trading that risk for fewer
+# datastore writes set it at startup.
+ENABLED = False
+
+# Seconds covered by a bucket, i.e. for how long writes are coalesced.
+FLUSH_INTERVAL = 10
+
+# Seconds buffered entities and bucket lists stay in memcache at most, i.e.
+# how long a bucket whose flush task keeps failing can wait.
+ENTRY_TIME = 3600
+
+# URL of the task handler calling flush().
+FLUSH_URL = '/task/flushWrites'
+
+# Maximum number of entities per datastore put.
+_PUT_BATCH_SIZE = 100
+
+_MEMCACHE_NAMESPACE = 'demo.write_behind'
+
+# Last bucket this instance enqueued the flush task of.
+_enqueued_bucket = None
+
+
+def _entity_key(key):
+  """Returns the memcache key of the buffered copy of the entity at key."""
+  return 'e:' + str(key)
+
+
+def _counter_key(bucket):
+  """Returns the memcache key counting the entries listed under bucket."""
+  return 'n:%d' % bucket
+
+
+def _slot_key(bucket, index):
+  """Returns the memcache key of the index-th entry listed under bucket.
+
+  The entry holds the encoded entity, so that it survives the eviction of
+  the buffered copy and outlives its removal once flushed.
+  """
+  return 's:%d:%d' % (bucket, index)
+
+
+def _started_key(bucket):
+  """Returns the memcache key set once the flush of bucket has started."""
+  return 'f:%d' % bucket
+
+
+def _add_flush_task(name, bucket, start=0, countdown=0):
+  """Queues a task flushing the entries of bucket listed after start.
+
+  Raises:
+    taskqueue.Error: If the task could not be queued, unless it already was.
+  """
+  try:
+    taskqueue.add(name=name, url=FLUSH_URL,
+                  params={'bucket': bucket, 'start': start},
+                  countdown=max(countdown, 0))
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def _enqueue_flush(bucket):
+  """Makes sure the task flushing bucket is queued, once per instance.
+
+  Raises:
+    taskqueue.Error: If the task could not be queued.
+  """
+  global _enqueued_bucket
+  if bucket == _enqueued_bucket:
+    return
+  _add_flush_task('flush-writes-%d' % bucket, bucket,
+                  countdown=(bucket + 1) * FLUSH_INTERVAL - int(time.time()) + 1)
+  _enqueued_bucket = bucket
+
+
+def put(entities):
+  """Writes entities to the datastore, possibly behind.
+
+  Falls back to a plain db.put() whenever memcache refuses a write.
+
+  Args:
+    entities: A model instance or a list of them. Their keys must be
+        complete, i.e. they must have a key name.
+  """
+  if not isinstance(entities, (list, tuple)):
+    entities = [entities]
+  if not entities:
+    return
+  if not ENABLED:
+    db.put(entities)
+    return
+
+  bucket = int(time.time()) // FLUSH_INTERVAL
+  # The flush is queued before anything is listed, so that no listed entry
+  # is left without one.
+  try:
+    _enqueue_flush(bucket)
+  except taskqueue.Error, e:
+    logging.warning('write_behind: cannot queue the flush of bucket %d: %s',
+                    bucket, e)
+    db.put(entities)
+    return
+
+  buffered = dict((_entity_key(entity.key()),
+                   db.model_to_protobuf(entity).Encode())
+                  for entity in entities)
+  if memcache.set_multi(buffered, time=ENTRY_TIME,
+                        namespace=_MEMCACHE_NAMESPACE):
+    db.put(entities)
+    return
+
+  memcache.add(_counter_key(bucket), 0, time=ENTRY_TIME,
+               namespace=_MEMCACHE_NAMESPACE)
+  last = memcache.incr(_counter_key(bucket), delta=len(buffered),
+                       namespace=_MEMCACHE_NAMESPACE)
+  slots = {}
+  if last is not None:
+    for offset, encoded in enumerate(buffered.itervalues()):
+      slots[_slot_key(bucket, last - offset)] = encoded
+  if last is None or memcache.set_multi(slots, time=ENTRY_TIME,
+                                        namespace=_MEMCACHE_NAMESPACE):
+    # The entities could not be listed for flushing.
+    db.put(entities)
+    return
+
+  if memcache.get(_started_key(bucket),
+                  namespace=_MEMCACHE_NAMESPACE) is not None:
+    # The flush of the bucket may have missed these entries. The task is
+    # named after them, so it is not the one already run.
+    start = last - len(buffered)
+    try:
+      _add_flush_task('flush-writes-%d-%d' % (bucket, start), bucket,
+                      start=start)
+    except taskqueue.Error, e:
+      logging.warning('write_behind: cannot queue a late flush of bucket '
+                      '%d: %s', bucket, e)
+      db.put(entities)
+
+
+def get(keys):
+  """Fetches entities, preferring their buffered copies.
+
+  Has the same calling convention as db.get(). Only the keys without a
+  buffered copy are fetched from the datastore.
+
+  Args:
+    keys: A db.Key or key string, or a list of them.
+  Returns:
+    An entity or None, or a list of entities/None in the order of keys.
+  """
+  multiple = isinstance(keys, (list, tuple))
+  if not multiple:
+    keys = [keys]
+  keys = [isinstance(key, basestring) and db.Key(key) or key for key in keys]
+
+  buffered = {}
+  if ENABLED and keys:
+    buffered = memcache.get_multi([_entity_key(key) for key in keys],
+                                  namespace=_MEMCACHE_NAMESPACE)
+  missing = [key for key in keys if not buffered.get(_entity_key(key))]
+  stored = dict(zip(missing, db.get(missing)))
+
+  results = []
+  for key in keys:
+    encoded = buffered.get(_entity_key(key))
+    if encoded:
+      results.append(db.model_from_protobuf(entity_pb.EntityProto(encoded)))
+    else:
+      results.append(stored[key])
+  if multiple:
+    return results
+  return results[0]
+
+
+def discard(keys):
+  """Drops the buffered copies of entities, e.g. after a direct db.put().
+
+  The copies are replaced by an empty marker, so that the entries still
+  listing them are skipped when flushing.
+
+  Args:
+    keys: A db.Key or key string, or a list of them.
+  """
+  if not isinstance(keys, (list, tuple)):
+    keys = [keys]
+  if ENABLED and keys:
+    memcache.set_multi(dict((_entity_key(key), '') for key in keys),
+                       time=ENTRY_TIME, namespace=_MEMCACHE_NAMESPACE)
+
+
+def flush(bucket, start=0):
+  """Writes the entities buffered during bucket to the datastore.
+
+  Entries listed while the flush runs are picked up as well. Each entity is
+  written as last buffered, or as listed if its buffered copy was evicted,
+  and skipped if it was discarded. The entries written are then removed,
+  and the buffered copies that were not replaced meanwhile are cleared like
+  discard() does, which also keeps the flush of an older bucket running late
+  from writing its stale entries.
+
+  Args:
+    bucket: Bucket number, as passed to the task.
+    start: Number of entries of the bucket to skip, as passed to the task.
+  Returns:
+    The number of entities written.
+  """
+  memcache.set(_started_key(bucket), 1, time=ENTRY_TIME,
+               namespace=_MEMCACHE_NAMESPACE)
+  written = 0
+  done = start
+  while True:
+    count = memcache.get(_counter_key(bucket),
+                         namespace=_MEMCACHE_NAMESPACE) or 0
+    if count <= done:
+      break
+    slot_keys = [_slot_key(bucket, index)
+                 for index in range(done + 1, count + 1)]
+    slots = memcache.get_multi(slot_keys, namespace=_MEMCACHE_NAMESPACE)
+    done = count
+    listed = {}
+    for slot_key in slot_keys:
+      if slot_key in slots:
+        entity = datastore.Entity.FromPb(
+            entity_pb.EntityProto(slots[slot_key]))
+        listed[_entity_key(entity.key())] = slots[slot_key]
+    buffered = memcache.get_multi(listed.keys(),
+                                  namespace=_MEMCACHE_NAMESPACE)
+    to_write = {}
+    for entity_key, encoded in listed.iteritems():
+      encoded = buffered.get(entity_key, encoded)
+      if encoded:
+        to_write[entity_key] = encoded
+    if len(to_write) < len(listed):
+      logging.info('write_behind: %d entities of bucket %d were discarded',
+                   len(listed) - len(to_write), bucket)
+    entities = [datastore.Entity.FromPb(entity_pb.EntityProto(encoded))
+                for encoded in to_write.itervalues()]
+    for batch_start in range(0, len(entities), _PUT_BATCH_SIZE):
+      datastore.Put(entities[batch_start:batch_start + _PUT_BATCH_SIZE])
+    written += len(entities)
+
+    memcache.delete_multi(slots.keys(), namespace=_MEMCACHE_NAMESPACE)
+    # A copy buffered again since it was read stays, along with its entry.
+    current = memcache.get_multi(to_write.keys(),
+                                 namespace=_MEMCACHE_NAMESPACE)
+    flushed = dict((entity_key, '') for entity_key, encoded
+                   in current.iteritems() if encoded == to_write[entity_key])
+    if flushed:
+      memcache.set_multi(flushed, time=ENTRY_TIME,
+                         namespace=_MEMCACHE_NAMESPACE)
+  return written
+
+
+def flush_pending():
+  """Writes all the entities still buffered, e.g. before running a query.
+
+  Flushes every bucket of the last ENTRY_TIME seconds that has entries
+  listed. Entries already flushed are removed, so this does not write them
+  again.
+
+  Returns:
+    The number of entities written.
+  """
+  if not ENABLED:
+    return 0
+  last = int(time.time()) // FLUSH_INTERVAL
+  buckets = range(last - ENTRY_TIME // FLUSH_INTERVAL, last + 1)
+  counts = memcache.get_multi([_counter_key(bucket) for bucket in buckets],
+                              namespace=_MEMCACHE_NAMESPACE)
+  written = 0
+  for bucket in buckets:
+    if counts.get(_counter_key(bucket)):
+      written += flush(bucket)
+  return written
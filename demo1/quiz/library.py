@@ -31,6 +31,7 @@ from django.utils import simplejson
 from django.core.urlresolvers import reverse
 
 import quiz.models as models
+from common import key_allocation
 
 # For registering filter and tag libs.
 register = django.template.Library()
@@ -100,27 +101,17 @@ def create_temp_session_id():
 
 
 def insert_with_new_key(cls, parent=None, **kwargs):
-  """Insert model into datastore with a random key.
+  """Insert model into datastore with a new, unique key.
 
   Args:
     cls: Data model class (ex. models.DocModel).
     parent: optional parent argument to bind models in same entity group.
-      NOTE: If parent argument is passed, key_name may not be unique across
-      all entities.
   Returns:
     Data model entity or None if error.
-
-  TODO(mukundjha): Check for race condition.
   """
-  while True:
-    key_name = gen_random_string()
-    entity = cls.get_by_key_name(key_name, parent=parent)
-    if entity is None:
-      entity = cls(key_name=key_name, parent=parent, **kwargs)
-      entity.put()
-      break
-    else:
-      logging.info("Entity with key "+key_name+" exists")
+  entity = cls(key_name=key_allocation.allocate_key_names(cls)[0],
+               parent=parent, **kwargs)
+  entity.put()
   return entity
 
 
@@ -397,11 +388,6 @@ def increment_score(session_id, quiz, question, attempts):
 def create_new_trunk_with_quiz(quiz_id, **kwargs):
   """Creates a new trunk with given quiz as head.
 
-  WARNING: Since we are passing parent parameter in insert_with_new_key,
-  function will only check for uniqueness of key among entities having 'trunk'
-  as an ancestor. This no longer guarantees unique key_name across all 
-  entities.
-
   NOTE(mukundjha): No check is done on quiz_id, it's responsibility of
   other functions calling create_new_trunk_with_quiz to check the parameter
   before its passed.
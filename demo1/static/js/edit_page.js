@@ -200,9 +200,10 @@ lantern.edit.LinkPicker = function() {
   goog.dom.classes.add(this.dialog_.getContentElement(), 'linkpicker');
   this.dialog_.setTitle('Link Picker');
 
-  // initial paging index and entries per page
-  this.startAt_ = 0;
+  // initial page, entries per page and the cursor starting each page
+  this.page_ = 0;
   this.count_ = 8;
+  this.cursors_ = [''];
 };
 goog.inherits(lantern.edit.LinkPicker, goog.Disposable);
 
@@ -284,19 +285,24 @@ lantern.edit.LinkPicker.prototype.activateDocLinkList = function(
 
 /**
  * Make an asynchronous request to find small number of documents
- * starting at startAt whose name begins with contents of limitDocString.
+ * on the given page whose name begins with contents of limitDocString.
+ * Pages are requested with the cursor returned for the previous one.
  */
 lantern.edit.LinkPicker.prototype.updateDocLinkList_ = function(
-    docLinkCallback, limitDocString, startAt) {
-  if (startAt < 0) {
-    startAt = 0;
+    docLinkCallback, limitDocString, page) {
+  if (page <= 0) {
+    page = 0;
+    this.cursors_ = [''];
   }
 
   /* TODO: perhaps use goog.uri.Uri() */
-  var uri = '/getListAjax?s=' + encodeURIComponent(startAt);
-  uri = uri + "&amp;c=" + this.count_;
+  var uri = '/getListAjax?s=' + encodeURIComponent(page * this.count_);
+  uri = uri + "&c=" + this.count_;
   if (limitDocString.value != "") {
-    uri = uri +"&amp;q=" + encodeURIComponent(limitDocString.value);
+    uri = uri +"&q=" + encodeURIComponent(limitDocString.value);
+  }
+  if (this.cursors_[page]) {
+    uri = uri + "&cursor=" + encodeURIComponent(this.cursors_[page]);
   }
   this.sendRequest(uri,
                    goog.bind(this.processDocLinkList_, this, docLinkCallback));
@@ -347,7 +353,8 @@ lantern.edit.LinkPicker.prototype.processDocLinkList_ = function(
   dialogContent.appendChild(newDocRow);
   dialogContent.appendChild(limitDocRow);
 
-  this.startAt_ = obj.startAt + 0;
+  this.page_ = Math.floor(obj.startAt / this.count_);
+  this.cursors_[this.page_ + 1] = obj.cursor;
 
   var docList = obj.doc_list;
 
@@ -389,13 +396,13 @@ lantern.edit.LinkPicker.prototype.processDocLinkList_ = function(
   row.appendChild(goog.dom.createDom('td', null, nextButton));
   dialogContent.appendChild(row);
 
-  if (this.startAt_ == 0) {
+  if (this.page_ == 0) {
     prevButton.disabled = true;
   } else {
     handler.listen(prevButton, goog.events.EventType.CLICK,
                    goog.bind(this.updateDocLinkList_, this,
                              docLinkCallback, limitDocString,
-                             this.startAt_ - this.count_));
+                             this.page_ - 1));
   }
 
   if (obj.atEnd) {
@@ -404,7 +411,7 @@ lantern.edit.LinkPicker.prototype.processDocLinkList_ = function(
     handler.listen(nextButton, goog.events.EventType.CLICK,
                    goog.bind(this.updateDocLinkList_, this,
                              docLinkCallback, limitDocString,
-                             this.startAt_ + this.count_));
+                             this.page_ + 1));
   }
 
   limitDocString.focus();
@@ -26,15 +26,20 @@ from google.appengine.dist import use_library
 use_library('django', '1.1')
 
 # AppEngine
+from google.appengine.api.labs import taskqueue
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp.util import run_wsgi_app
 from google.appengine.ext import db
 
 from django.utils import simplejson
 
+from demo import identity_map
+from demo import library
 from demo import models
 from demo import upload
 from demo import notify
+from demo import search
+from demo import write_behind
 
 
 class ImportVideos(webapp.RequestHandler):
@@ -47,6 +52,7 @@ class ImportVideos(webapp.RequestHandler):
   }
   """
   def post(self):
+    identity_map.clear()
     logging.info('=======ImportVideos')
     response = []
     payload_json  = self.request.body
@@ -68,6 +74,7 @@ class ImportVideos(webapp.RequestHandler):
 class NotifyUser(webapp.RequestHandler):
   """Notify recent changes to the pages the user watches"""
   def post(self):
+    identity_map.clear()
     subscription = self.request.get('s')
     if not subscription:
       logging.warning("notify_user request without a subscription?")
@@ -81,9 +88,169 @@ class NotifyUser(webapp.RequestHandler):
 
   get = post
 
+
+class BatchTask(webapp.RequestHandler):
+  """Base of the tasks processing entities one batch per request.
+
+  Each request calls BATCH_FUNCTION for the batch after the key it was given
+  and queues the task again at URL for the next batch, until BATCH_FUNCTION
+  returns no key. Start such a task by visiting its URL.
+
+  Class Attributes:
+    URL: URL the task is served at.
+    BATCH_FUNCTION: Function called with the arguments returned by
+      batch_args(), the key to resume after and BATCH_SIZE. Returns
+      (next_start_key, count), next_start_key being None when done.
+    BATCH_SIZE: Number of entities per batch.
+    COUNT_MESSAGE: Logged with the count returned for each batch.
+
+  Parameters:
+    start: Key to resume after.
+  """
+  URL = None
+  BATCH_FUNCTION = None
+  BATCH_SIZE = 100
+  COUNT_MESSAGE = 'processed %d entities'
+
+  def batch_args(self):
+    """Returns the arguments passed to BATCH_FUNCTION before the key."""
+    return ()
+
+  def next_params(self, next_start):
+    """Returns the parameters of the next request, or None when done."""
+    if next_start:
+      return {'start': str(next_start)}
+    return None
+
+  def post(self):
+    identity_map.clear()
+    start = self.request.get('start') or None
+    next_start, count = self.BATCH_FUNCTION(
+        *(self.batch_args() + (start, self.BATCH_SIZE)))
+    name = self.__class__.__name__
+    logging.info('%s: ' + self.COUNT_MESSAGE, name, count)
+    params = self.next_params(next_start)
+    if params is None:
+      logging.info('%s: done', name)
+      return 'Done'
+    taskqueue.add(url=self.URL, params=params)
+    return 'Queued'
+
+  get = post
+
+
+class RekeyUserStates(BatchTask):
+  """Moves user state entities to their deterministic key names.
+
+  Processes the kinds in library.KEYED_USER_STATE_MODELS one after the
+  other.
+
+  Parameters:
+    kind: Index into library.KEYED_USER_STATE_MODELS (defaults to 0).
+    start: Key to resume after.
+  """
+  URL = '/task/rekeyUserStates'
+  BATCH_FUNCTION = staticmethod(library.rekey_user_states)
+  COUNT_MESSAGE = 'moved %d entities'
+
+  def _kind(self):
+    return int(self.request.get('kind') or 0)
+
+  def batch_args(self):
+    return (library.KEYED_USER_STATE_MODELS[self._kind()],)
+
+  def next_params(self, next_start):
+    kind = self._kind()
+    if next_start:
+      return {'kind': kind, 'start': str(next_start)}
+    if kind + 1 < len(library.KEYED_USER_STATE_MODELS):
+      return {'kind': kind + 1}
+    return None
+
+
+class BackfillPathTrunks(BatchTask):
+  """Stores the trunk keys of TraversalPath entities that lack them."""
+  URL = '/task/backfillPathTrunks'
+  BATCH_FUNCTION = staticmethod(library.backfill_path_trunks)
+  COUNT_MESSAGE = 'updated %d paths'
+
+
+class BackfillTrunkMetadata(BatchTask):
+  """Stores the head metadata and TrunkTitleIndex entries of old trunks."""
+  URL = library.BACKFILL_TRUNK_METADATA_URL
+  BATCH_FUNCTION = staticmethod(library.backfill_trunk_metadata)
+  COUNT_MESSAGE = 'updated %d trunks'
+
+
+class IndexSearch(BatchTask):
+  """Adds the heads of existing trunks to the search index."""
+  URL = '/task/indexSearch'
+  BATCH_FUNCTION = staticmethod(search.index_batch)
+  BATCH_SIZE = 20
+  COUNT_MESSAGE = 'indexed %d documents'
+
+
+class IndexTrunk(webapp.RequestHandler):
+  """Indexes the new head of a trunk for search.
+
+  Queued by models.TrunkModel.put() whenever the head changes.
+
+  Parameters:
+    trunk: Key of the trunk.
+  """
+  def post(self):
+    identity_map.clear()
+    search.index_trunk(self.request.get('trunk'))
+    return 'Done'
+
+
+class CountTags(webapp.RequestHandler):
+  """Counts again the courses tagged with some tags.
+
+  Queued by models.TrunkModel.put() whenever the tags of a course head
+  change.
+
+  Parameters:
+    tags: Newline separated tags.
+  """
+  def post(self):
+    identity_map.clear()
+    tags = [db.Category(tag) for tag in self.request.get('tags').split('\n')
+            if tag]
+    models.update_tag_counts(tags)
+    return 'Done'
+
+
+class FlushWrites(webapp.RequestHandler):
+  """Writes the user state entities buffered by demo.write_behind.
+
+  Queued by write_behind.put(), once per bucket and for the entries listed
+  after the flush of their bucket started.
+
+  Parameters:
+    bucket: Number of the bucket to flush.
+    start: Number of entries of the bucket to skip.
+  """
+  def post(self):
+    identity_map.clear()
+    bucket = int(self.request.get('bucket'))
+    start = int(self.request.get('start') or 0)
+    written = write_behind.flush(bucket, start=start)
+    logging.info('FlushWrites: wrote %d entities of bucket %d', written,
+                 bucket)
+    return 'Done'
+
+
 application = webapp.WSGIApplication([
     ('/task/importVideos', ImportVideos),
     ('/task/notifyUser', NotifyUser),
+    (RekeyUserStates.URL, RekeyUserStates),
+    (BackfillPathTrunks.URL, BackfillPathTrunks),
+    (BackfillTrunkMetadata.URL, BackfillTrunkMetadata),
+    (IndexSearch.URL, IndexSearch),
+    (models.SEARCH_INDEX_URL, IndexTrunk),
+    (models.TAG_COUNT_URL, CountTags),
+    (write_behind.FLUSH_URL, FlushWrites),
     ],
     debug=True)
 